@@ -0,0 +1,69 @@
+"""
+Measure CSSInliner on messages rendered from one template: the first
+document parses the stylesheet and matches the elements, the next ones only
+look up the cached matches.
+
+Run from the root of the repository:
+
+    python benchmarks/css_inlining.py [count]
+"""
+import sys
+import timeit
+
+from fastapi_mailman.css import CSSInliner, Stylesheet, parse_stylesheet
+
+STYLESHEET = "\n".join(
+    [
+        "body { margin: 0; padding: 0; background: #f4f4f4 }",
+        "table.wrapper { width: 100%; border-collapse: collapse }",
+        ".content > tr > td { padding: 12px 24px; font-family: Helvetica, Arial, sans-serif }",
+        "h1 { font-size: 22px; color: #111 }",
+        "p { font-size: 14px; line-height: 1.5; color: #333 }",
+        "td.item p { margin: 0 }",
+        "td.price { text-align: right; font-weight: bold }",
+        "a.button { display: inline-block; padding: 8px 16px; background: #0a66c2; color: #fff !important }",
+        "a:hover { text-decoration: underline }",
+        "@media (max-width: 600px) { .content > tr > td { padding: 8px } }",
+    ]
+    # A stylesheet of a realistic size, mostly rules that match nothing here.
+    + [".unused-%d p span { color: #%06x }" % (index, index) for index in range(200)]
+)
+
+
+def render(customer):
+    items = "".join(
+        '<tr><td class="item"><p>Item %d for %s</p></td><td class="price">%d.00</td></tr>' % (index, customer, index)
+        for index in range(10)
+    )
+    return (
+        "<html><head><style>%s</style></head><body>"
+        '<table class="wrapper content"><tr><td><h1>Hello %s</h1><p>Your order:</p></td></tr>%s'
+        '<tr><td><a class="button" href="https://example.com/%s">View order</a></td></tr></table>'
+        "</body></html>" % (STYLESHEET, customer, items, customer)
+    )
+
+
+def main(count):
+    documents = [render("customer-%d" % index) for index in range(count)]
+    inliner = CSSInliner()
+
+    def uncached():
+        for document in documents:
+            parse_stylesheet.cache_clear()
+            inliner.inline(document)
+
+    def cached():
+        for document in documents:
+            inliner.inline(document)
+
+    def parse_only():
+        for _ in documents:
+            Stylesheet(STYLESHEET)
+
+    for name, function in (("stylesheet parsing", parse_only), ("uncached", uncached), ("cached", cached)):
+        duration = min(timeit.repeat(function, number=1, repeat=3))
+        print("%-20s %8.1f us per message" % (name, duration / count * 1e6))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,46 @@
+"""
+Measure building and streaming messages embedding the same inline image: the
+first message hashes and encodes the image, the next ones reuse its cached
+encoding.
+
+Run from the root of the repository:
+
+    python benchmarks/inline_images.py [count]
+"""
+import os
+import sys
+import timeit
+
+from fastapi_mailman import EmailMultiAlternatives, Mail
+from fastapi_mailman.config import ConnectionConfig
+from fastapi_mailman.message import _encode_inline_image
+
+# The size of a typical logo or banner.
+IMAGE = os.urandom(200 * 1024)
+
+
+def main(count):
+    mail = Mail(ConnectionConfig(MAIL_USERNAME='', MAIL_PASSWORD='', MAIL_SERVER='localhost', MAIL_BACKEND='locmem'))
+
+    def build(index):
+        email = EmailMultiAlternatives('Hello', 'Hello', to=['to-%d@example.com' % index], mailman=mail)
+        cid = email.attach_inline_image(IMAGE, 'banner.png')
+        email.attach_alternative('<p>Hello</p><img src="cid:%s">' % cid, 'text/html')
+        b''.join(email.message().as_stream(linesep='\r\n'))
+
+    def uncached():
+        for index in range(count):
+            _encode_inline_image.cache_clear()
+            build(index)
+
+    def cached():
+        for index in range(count):
+            build(index)
+
+    for name, function in (('uncached', uncached), ('cached', cached)):
+        duration = min(timeit.repeat(function, number=1, repeat=3))
+        print('%-20s %8.1f us per message' % (name, duration / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,78 @@
+"""
+Compare encode_message() with pickle and raw MIME for handing messages to
+other processes: size of the encoded message and time to encode and decode it.
+
+Run from the root of the repository:
+
+    python benchmarks/message_codec.py [count]
+"""
+import email
+import pickle
+import sys
+import tempfile
+import timeit
+
+from fastapi_mailman import EmailMultiAlternatives, Mail
+from fastapi_mailman.config import ConnectionConfig
+from fastapi_mailman.message import AttachmentStore, decode_message, encode_message
+
+mail = Mail(
+    ConnectionConfig(
+        MAIL_USERNAME="username",
+        MAIL_PASSWORD="password",
+        MAIL_SERVER="localhost",
+        MAIL_BACKEND="locmem",
+        MAIL_DEFAULT_SENDER="sender@example.com",
+    )
+)
+
+
+def make_message(attachment_size):
+    message = EmailMultiAlternatives(
+        "Your invoice #1234",
+        "Hello,\n\nplease find your invoice attached.\n" * 5,
+        to=["customer@example.com"],
+        headers={"X-Customer": "1234"},
+        mailman=mail,
+    )
+    message.attach_alternative("<p>Hello,</p><p>please find your invoice attached.</p>" * 5, "text/html")
+    if attachment_size:
+        message.attach("invoice.pdf", bytes(range(256)) * (attachment_size // 256), "application/pdf")
+    return message
+
+
+def pickle_message(message):
+    # An EmailMessage references its Mail object, which can't be pickled.
+    state = {key: value for key, value in message.__dict__.items() if key not in ("mailman", "connection")}
+    return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+
+def run(name, encode, decode, count):
+    data = encode()
+    encode_time = timeit.timeit(encode, number=count) / count * 1e6
+    decode_time = timeit.timeit(lambda: decode(data), number=count) / count * 1e6
+    print("  %-28s %9d bytes %9.1f us encode %9.1f us decode" % (name, len(data), encode_time, decode_time))
+
+
+def main(count):
+    store = AttachmentStore(tempfile.mkdtemp())
+    for attachment_size in (0, 100_000):
+        message = make_message(attachment_size)
+        spec = message.to_spec()
+        assert decode_message(encode_message(spec)) == spec
+        print("Message with a %d bytes attachment:" % attachment_size)
+        run("encode_message", lambda: encode_message(spec), decode_message, count)
+        if attachment_size:
+            run(
+                "encode_message (store)",
+                lambda: encode_message(spec, store.store),
+                lambda data: decode_message(data, store.load),
+                count,
+            )
+        run("pickle (MessageSpec)", lambda: pickle.dumps(spec, pickle.HIGHEST_PROTOCOL), pickle.loads, count)
+        run("pickle (EmailMessage state)", lambda: pickle_message(message), pickle.loads, count)
+        run("MIME", lambda: message.message().as_bytes(), email.message_from_bytes, count)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
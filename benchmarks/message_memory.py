@@ -0,0 +1,68 @@
+"""
+Compare the memory held by queued EmailMessage objects and MessageSpec objects.
+
+Run from the root of the repository:
+
+    python benchmarks/message_memory.py [count]
+"""
+import gc
+import sys
+import tracemalloc
+
+from fastapi_mailman import EmailMessage, Mail, MessageSpec
+from fastapi_mailman.config import ConnectionConfig
+
+mail = Mail(
+    ConnectionConfig(
+        MAIL_USERNAME="username",
+        MAIL_PASSWORD="password",
+        MAIL_SERVER="localhost",
+        MAIL_BACKEND="locmem",
+        MAIL_DEFAULT_SENDER="sender@example.com",
+    )
+)
+
+
+def make_fields(i):
+    return (
+        "Your order #%d has shipped" % i,
+        "Hello,\n\nyour order #%d is on its way.\n" % i,
+        "customer%d@example.com" % i,
+        str(i),
+    )
+
+
+def make_message(fields):
+    subject, body, to, order = fields
+    return EmailMessage(subject, body, to=[to], headers={"X-Order": order}, mailman=mail)
+
+
+def make_spec(fields):
+    subject, body, to, order = fields
+    return MessageSpec(subject, body, mail.default_sender, to=(to,), headers=(("X-Order", order),))
+
+
+def measure(build, fields):
+    gc.collect()
+    tracemalloc.start()
+    objects = [build(f) for f in fields]
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size / len(fields)
+
+
+def main(count):
+    # The strings are built beforehand, as they are shared by both representations.
+    fields = [make_fields(i) for i in range(count)]
+    assert make_message(fields[0]).to_spec() == make_spec(fields[0])
+    message_size = measure(make_message, fields)
+    spec_size = measure(make_spec, fields)
+    print("EmailMessage: %7.1f bytes per message" % message_size)
+    print("MessageSpec:  %7.1f bytes per message" % spec_size)
+    print("Saved:        %7.1f%%" % (100 * (1 - spec_size / message_size)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,39 @@
+"""
+Measure sanitizing the recipients of a mass send: plain strings are parsed by
+sanitize_address() for every message, the addresses from
+validate_recipients() are parsed once and only formatted afterwards.
+
+Run from the root of the repository:
+
+    python benchmarks/recipient_validation.py [count]
+"""
+import sys
+import timeit
+
+from fastapi_mailman.addresses import validate_recipients
+from fastapi_mailman.message import sanitize_address
+
+DOMAINS = ["example.com", "example.org", "exämple.de", "mail.example.net"]
+
+
+def main(count):
+    addresses = ["user.%d@%s" % (index, DOMAINS[index % len(DOMAINS)]) for index in range(count)]
+    addresses += ["User %d <user.%d@example.com>" % (index, index) for index in range(count // 10)]
+
+    def sanitize(recipients):
+        for addr in recipients:
+            sanitize_address(addr, "utf-8")
+
+    validated = validate_recipients(addresses).valid
+    sanitize(validated)
+    for name, function in (
+        ("validate", lambda: validate_recipients(addresses)),
+        ("sanitize strings", lambda: sanitize(addresses)),
+        ("sanitize validated", lambda: sanitize(validated)),
+    ):
+        duration = min(timeit.repeat(function, number=1, repeat=3))
+        print("%-20s %8.2f us per address" % (name, duration / len(addresses) * 1e6))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,19 +1,24 @@
 """
 Tools for sending email.
 """
+import asyncio
+import datetime
+import ssl
 import types as ty
 import typing as t
+from contextlib import contextmanager
 from importlib import import_module
 
 from pydantic import EmailStr
 
-from fastapi_mailman.utils import DNS_NAME, CachedDnsName
+from fastapi_mailman.utils import DNS_NAME, CachedDnsName, aiterate, create_ssl_context
 
 from .message import (
     DEFAULT_ATTACHMENT_MIME_TYPE,
     BadHeaderError,
     EmailMessage,
     EmailMultiAlternatives,
+    MessageSpec,
     SafeMIMEMultipart,
     SafeMIMEText,
     forbid_multi_line_headers,
@@ -21,6 +26,8 @@ from .message import (
 )
 
 if t.TYPE_CHECKING:
+    from jinja2 import Environment
+
     from fastapi_mailman.backends.base import BaseEmailBackend
 
     from .config import ConnectionConfig
@@ -28,12 +35,25 @@ if t.TYPE_CHECKING:
     Mailman = t.TypeVar("Mailman", bound="Mail")
 
 from . import globals
+from .addresses import RecipientValidation, SanitizedAddress, validate_recipients
+from .batching import BatchSender
+from .concurrency import AdaptiveSender, AIMDLimiter
+from .css import CSSInliner
+from .lifespan import MailLifespan
+from .priority import Lane, PriorityScheduler
+from .profiling import MessageProfiler, SlowMessageReport
+from .relays import Relay, RelayPool
+from .rendering import RenderedMessage, RenderPipeline
+from .results import MessageResult, RecipientResult, SendResult
+from .scheduling import DelayedSender, ScheduledMessage, ScheduleStore
+from .tracing import get_tracer, start_span
 
 __all__ = [
     'CachedDnsName',
     'DNS_NAME',
     'EmailMessage',
     'EmailMultiAlternatives',
+    'MessageSpec',
     'SafeMIMEText',
     'SafeMIMEMultipart',
     'DEFAULT_ATTACHMENT_MIME_TYPE',
@@ -41,10 +61,34 @@ __all__ = [
     'BadHeaderError',
     'forbid_multi_line_headers',
     'Mail',
+    'get_mail',
+    'mail_dependency',
+    'MailLifespan',
+    'BatchSender',
+    'RenderPipeline',
+    'RenderedMessage',
+    'AdaptiveSender',
+    'AIMDLimiter',
+    'Lane',
+    'PriorityScheduler',
+    'DelayedSender',
+    'ScheduledMessage',
+    'ScheduleStore',
+    'MessageProfiler',
+    'SlowMessageReport',
+    'Relay',
+    'RelayPool',
+    'SendResult',
+    'MessageResult',
+    'RecipientResult',
+    'CSSInliner',
+    'SanitizedAddress',
+    'RecipientValidation',
+    'validate_recipients',
 ]
 
 
-available_backends = ['console', 'dummy', 'file', 'smtp', 'locmem']
+available_backends = ['console', 'dummy', 'file', 'smtp', 'lmtp', 'locmem']
 
 
 class _MailMixin(object):
@@ -100,11 +144,8 @@ class _MailMixin(object):
         Both fail_silently and other keyword arguments are used in the
         constructor of the backend.
         """
-        if globals.MAILMAN is None:
-            raise NotImplementedError("Default Mail object isn't created yet.")
-
         try:
-            backend = backend or globals.MAILMAN.backend
+            backend = backend or self.backend
 
             klass: "BaseEmailBackend" = self.import_backend(backend)
 
@@ -115,7 +156,8 @@ class _MailMixin(object):
             )
             raise RuntimeError(err_msg)
 
-        return klass(mailman=globals.MAILMAN, fail_silently=fail_silently, **kwds)
+        with start_span(self, 'mail.get_connection', **{'mail.backend': str(backend)}):
+            return klass(mailman=self, fail_silently=fail_silently, **kwds)
 
     async def send_mail(
         self,
@@ -128,6 +170,7 @@ class _MailMixin(object):
         auth_password: t.Optional[str] = None,
         connection: t.Optional["BaseEmailBackend"] = None,
         html_message: t.Optional[str] = None,
+        priority: t.Optional[str] = None,
     ) -> t.Coroutine:
         """
         Easy wrapper for sending a single message to a recipient list. All members
@@ -135,26 +178,42 @@ class _MailMixin(object):
 
         If auth_user is None, use the MAIL_USERNAME setting.
         If auth_password is None, use the MAIL_PASSWORD setting.
-        """
-        if globals.MAILMAN is None:
-            raise NotImplementedError("Default Mail object isn't created yet.")
 
-        connection = connection or self.get_connection(
-            username=auth_user,
-            password=auth_password,
-            fail_silently=fail_silently,
-        )
-        mail = EmailMultiAlternatives(
-            subject, message, from_email, recipient_list, connection=connection, mailman=globals.MAILMAN
-        )
+        If priority lanes are enabled and neither a connection nor credentials
+        are given, the message is sent in the lane of ``priority``, see
+        enable_priority_lanes(). Otherwise, if batching is enabled, it is sent
+        with the next batch, see enable_batching().
+        """
+        default = connection is None and auth_user is None and auth_password is None
+        scheduled = self.scheduler is not None and default
+        batched = self.batch_sender is not None and default and not scheduled
+        if not batched and not scheduled:
+            connection = connection or self.get_connection(
+                username=auth_user,
+                password=auth_password,
+                fail_silently=fail_silently,
+            )
+        mail = EmailMultiAlternatives(subject, message, from_email, recipient_list, connection=connection, mailman=self)
+        mail.priority = priority
         if html_message:
             mail.attach_alternative(html_message, 'text/html')
 
-        return await mail.send()
+        if batched and mail.recipients():
+            try:
+                return await self.batch_sender.submit(mail)
+            except Exception:
+                if not fail_silently:
+                    raise
+                return 0
+
+        return await mail.send(fail_silently)
 
     async def send_mass_mail(
         self,
-        datatuple: t.Tuple[str, str, str, t.List[EmailStr]],
+        datatuple: t.Union[
+            t.Iterable[t.Tuple[str, str, str, t.List[EmailStr]]],
+            t.AsyncIterable[t.Tuple[str, str, str, t.List[EmailStr]]],
+        ],
         fail_silently: bool = False,
         auth_user: t.Optional[str] = None,
         auth_password: t.Optional[str] = None,
@@ -169,32 +228,83 @@ class _MailMixin(object):
         If auth_user is None, use the MAIL_USERNAME setting.
         If auth_password is None, use the MAIL_PASSWORD setting.
 
+        datatuple may be any iterable or async iterable, it is consumed chunk
+        by chunk, see iter_send_mass_mail().
+
         Note: The API for this method is frozen. New code wanting to extend the
         functionality should use the EmailMessage class directly.
         """
-        if globals.MAILMAN is None:
-            raise NotImplementedError("Default Mail object isn't created yet.")
-
+        num_sent = 0
+        async for sent in self.iter_send_mass_mail(
+            datatuple,
+            fail_silently=fail_silently,
+            auth_user=auth_user,
+            auth_password=auth_password,
+            connection=connection,
+        ):
+            num_sent += sent
+        return num_sent
+
+    async def iter_send_mass_mail(
+        self,
+        datatuple: t.Union[
+            t.Iterable[t.Tuple[str, str, str, t.List[EmailStr]]],
+            t.AsyncIterable[t.Tuple[str, str, str, t.List[EmailStr]]],
+        ],
+        fail_silently: bool = False,
+        auth_user: t.Optional[str] = None,
+        auth_password: t.Optional[str] = None,
+        connection: "BaseEmailBackend" = None,
+        chunk_size: int = 100,
+    ) -> t.AsyncIterator[int]:
+        """
+        Like send_mass_mail(), but build and send the messages ``chunk_size``
+        at a time over one connection, yielding the number of emails sent of
+        each chunk. Only one chunk of messages is held in memory, so datatuple
+        can be e.g. an async generator over a database cursor.
+        """
         connection = connection or self.get_connection(
             username=auth_user,
             password=auth_password,
             fail_silently=fail_silently,
         )
-        messages = [
-            EmailMessage(subject, message, sender, recipient, connection=connection, mailman=globals.MAILMAN)
-            for subject, message, sender, recipient in datatuple
-        ]
-        return await connection.send_messages(messages)
+        messages = (
+            EmailMessage(subject, message, sender, recipient, connection=connection, mailman=self)
+            async for subject, message, sender, recipient in aiterate(datatuple)
+        )
+        with self.track_send():
+            async for sent in connection.iter_send_messages(messages, chunk_size=chunk_size):
+                yield sent
 
 
 class Mail(_MailMixin):
     """Manages email messaging
 
+    Every Mail object is registered under its name, so that several of them
+    (e.g. one per tenant, each with its own relay and credentials) can be used
+    side by side. The Mail object created without a name is the default one.
+
     :param config: Default ConnectionConfig pydantic instance
+
+    :param name: The name to register this Mail object under.
     """
 
-    def __init__(self, config: "ConnectionConfig"):
+    def __init__(self, config: "ConnectionConfig", name: t.Optional[str] = None):
         self.config: "ConnectionConfig" = config
+        self.name: str = name or globals.DEFAULT_MAILMAN_NAME
+        # Connections opened ahead of time by startup(), keyed by the backend
+        # settings they were opened with, waiting to be picked up by open().
+        self.warm_connections: t.Dict[t.Hashable, t.List[t.Any]] = {}
+        self._pending_sends = 0
+        self._drained: t.Optional[asyncio.Event] = None
+        self._template_engine: t.Optional["Environment"] = None
+        self.batch_sender: t.Optional[BatchSender] = None
+        self.scheduler: t.Optional[PriorityScheduler] = None
+        self.delayed_sender: t.Optional[DelayedSender] = None
+        self.tracer: t.Any = None
+        self.profiler: t.Optional[MessageProfiler] = None
+        self.css_inliner: t.Optional[CSSInliner] = None
+        self._ssl_contexts: t.Dict[t.Tuple[t.Optional[str], t.Optional[str], bool], ssl.SSLContext] = {}
         self.state = self.initIns()
 
     def init_mail(self, config: "ConnectionConfig") -> "Mail":
@@ -210,14 +320,279 @@ class Mail(_MailMixin):
         self.timeout = config_dict.get('MAIL_TIMEOUT')
         self.ssl_keyfile = config_dict.get('MAIL_SSL_KEYFILE')
         self.ssl_certfile = config_dict.get('MAIL_SSL_CERTFILE')
+        self.validate_certs = config_dict.get('MAIL_VALIDATE_CERTS')
         self.use_localtime = config_dict.get('MAIL_USE_LOCALTIME')
         self.file_path = config_dict.get('MAIL_FILE_PATH')
         self.default_charset = config_dict.get('MAIL_DEFAULT_CHARSET')
         self.backend = config_dict.get('MAIL_BACKEND')
+        self.use_smtputf8 = config_dict.get('MAIL_USE_SMTPUTF8')
+        self.streaming = config_dict.get('MAIL_STREAMING')
+        self.attachment_spool_threshold = config_dict.get('MAIL_ATTACHMENT_SPOOL_THRESHOLD')
+        self.keep_alive = config_dict.get('MAIL_KEEP_ALIVE')
+        self.keep_alive_idle_timeout = config_dict.get('MAIL_KEEP_ALIVE_IDLE_TIMEOUT')
+        self.keep_alive_noop_interval = config_dict.get('MAIL_KEEP_ALIVE_NOOP_INTERVAL')
+        self.socket_path = config_dict.get('MAIL_SOCKET_PATH')
+        self.use_lmtp = config_dict.get('MAIL_USE_LMTP')
+        relays = config_dict.get('MAIL_RELAYS')
+        self.relay_pool: t.Optional[RelayPool] = None
+        if relays:
+            self.relay_pool = RelayPool(
+                relays,
+                strategy=config_dict.get('MAIL_RELAY_STRATEGY'),
+                retry_interval=config_dict.get('MAIL_RELAY_RETRY_INTERVAL'),
+                default_port=self.port,
+            )
         return self
 
     def initIns(self) -> "Mail":
         state: "Mail" = self.init_mail(self.config)
-        # global MAILMAN
-        globals.MAILMAN = state
+        globals.MAILMEN[self.name] = state
+        if self.name == globals.DEFAULT_MAILMAN_NAME:
+            # global MAILMAN
+            globals.MAILMAN = state
         return state
+
+    def template_engine(self) -> "Environment":
+        """Return the template environment, created once per Mail object."""
+        if self._template_engine is None:
+            self._template_engine = self.config.template_engine()
+        return self._template_engine
+
+    def validate_templates(self) -> None:
+        """
+        Load and compile every template of the TEMPLATE_FOLDER, so syntax errors
+        surface at startup and the compiled templates are cached for later use.
+        """
+        if not self.config.TEMPLATE_FOLDER:
+            return
+        engine = self.template_engine()
+        for template_name in engine.list_templates():
+            engine.get_template(template_name)
+
+    def get_ssl_context(
+        self,
+        keyfile: t.Optional[str] = None,
+        certfile: t.Optional[str] = None,
+        validate_certs: bool = True,
+    ) -> ssl.SSLContext:
+        """
+        Return the SSL context for the given client certificate and verification
+        settings. It is built once, so the key and certificate files are read a
+        single time, and it resumes the TLS sessions of previous connections.
+        """
+        key = (keyfile, certfile, validate_certs)
+        if key not in self._ssl_contexts:
+            self._ssl_contexts[key] = create_ssl_context(keyfile, certfile, validate_certs)
+        return self._ssl_contexts[key]
+
+    def enable_batching(self, max_batch_size: int = 100, max_delay: float = 0.05) -> BatchSender:
+        """
+        Coalesce the messages sent with send_mail() within ``max_delay``
+        seconds (or up to ``max_batch_size`` of them) into one connection.
+        """
+        self.batch_sender = BatchSender(self, max_batch_size=max_batch_size, max_delay=max_delay)
+        return self.batch_sender
+
+    def enable_priority_lanes(self, lanes: t.Optional[t.List[Lane]] = None, **kwargs: t.Any) -> PriorityScheduler:
+        """
+        Send the messages without an explicit connection through priority
+        lanes, see PriorityScheduler for the arguments.
+        """
+        self.scheduler = PriorityScheduler(self, lanes, **kwargs)
+        return self.scheduler
+
+    def enable_delayed_sending(
+        self, store: t.Optional[ScheduleStore] = None, max_rate: t.Optional[float] = None, **kwargs: t.Any
+    ) -> DelayedSender:
+        """
+        Hold the messages passed to schedule() and schedule_mail() until their
+        time, see DelayedSender for the arguments. Messages persisted in
+        ``store`` are scheduled again by startup().
+        """
+        self.delayed_sender = DelayedSender(self, store=store, max_rate=max_rate, **kwargs)
+        return self.delayed_sender
+
+    def schedule(
+        self,
+        message: EmailMessage,
+        send_at: t.Union[datetime.datetime, float, None] = None,
+        delay: t.Union[datetime.timedelta, float, None] = None,
+    ) -> ScheduledMessage:
+        """
+        Send a message at ``send_at`` (a datetime or a timestamp) or after
+        ``delay`` (a timedelta or seconds). Delayed sending is enabled with its
+        defaults if it wasn't, see enable_delayed_sending().
+        """
+        if self.delayed_sender is None:
+            self.enable_delayed_sending()
+        return self.delayed_sender.schedule(message, send_at, delay)
+
+    def schedule_mail(
+        self,
+        subject: str,
+        message: str,
+        from_email: t.Optional[EmailStr] = None,
+        recipient_list: t.Optional[t.List[EmailStr]] = None,
+        send_at: t.Union[datetime.datetime, float, None] = None,
+        delay: t.Union[datetime.timedelta, float, None] = None,
+        html_message: t.Optional[str] = None,
+        priority: t.Optional[str] = None,
+    ) -> ScheduledMessage:
+        """Like send_mail(), but send the message later, see schedule()."""
+        mail = EmailMultiAlternatives(subject, message, from_email, recipient_list, mailman=self)
+        mail.priority = priority
+        if html_message:
+            mail.attach_alternative(html_message, 'text/html')
+        return self.schedule(mail, send_at, delay)
+
+    def enable_tracing(self, tracer: t.Any = None) -> t.Any:
+        """
+        Open spans for the steps of sending a message with ``tracer``, an
+        OpenTelemetry tracer or any object with its start_as_current_span()
+        method. Defaults to the tracer of the opentelemetry-api package.
+        """
+        self.tracer = get_tracer(tracer)
+        return self.tracer
+
+    def enable_profiling(self, **kwargs: t.Any) -> MessageProfiler:
+        """
+        Profile a sample of the sends and keep reports of the slowest ones, see
+        MessageProfiler for the arguments. The reports are returned by
+        ``mail.profiler.reports()``.
+        """
+        self.profiler = MessageProfiler(**kwargs)
+        return self.profiler
+
+    def enable_css_inlining(self, **kwargs: t.Any) -> CSSInliner:
+        """
+        Inline the CSS of the HTML alternatives attached to messages of this
+        Mail object, see CSSInliner for the arguments.
+        """
+        self.css_inliner = CSSInliner(**kwargs)
+        return self.css_inliner
+
+    def render_pipeline(self, **kwargs: t.Any) -> RenderPipeline:
+        """
+        Return a RenderPipeline rendering the messages of this Mail object in
+        worker processes, see RenderPipeline for the arguments.
+        """
+        return RenderPipeline(self, **kwargs)
+
+    def adaptive_sender(self, **kwargs: t.Any) -> AdaptiveSender:
+        """
+        Return an AdaptiveSender sending the messages of this Mail object over
+        concurrent connections, see AdaptiveSender for the arguments.
+        """
+        return AdaptiveSender(self, **kwargs)
+
+    @contextmanager
+    def track_send(self) -> t.Iterator[None]:
+        """Count a send as outstanding until the block exits, see wait_for_pending_sends()."""
+        self._pending_sends += 1
+        try:
+            yield
+        finally:
+            self._pending_sends -= 1
+            if not self._pending_sends and self._drained is not None:
+                self._drained.set()
+
+    async def wait_for_pending_sends(self, timeout: t.Optional[float] = None) -> bool:
+        """
+        Wait until every outstanding send has finished. Return False if they
+        were still running when the timeout expired.
+        """
+        if not self._pending_sends:
+            return True
+        if self._drained is None:
+            self._drained = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._drained = None
+        return True
+
+    async def startup(self, warm_connections: int = 1) -> None:
+        """
+        Prepare this Mail object for serving requests: resolve the cached FQDN,
+        compile the templates and open ``warm_connections`` connections with the
+        default backend, so the first messages don't pay for connect, TLS and
+        AUTH. Then schedule the messages persisted by delayed sending again.
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, DNS_NAME.get_fqdn)
+        await loop.run_in_executor(None, self.validate_templates)
+        for _ in range(warm_connections):
+            await self.get_connection().warm_up()
+        if self.delayed_sender is not None:
+            await self.delayed_sender.restore()
+
+    async def shutdown(self, timeout: t.Optional[float] = 10.0) -> bool:
+        """
+        Wait up to ``timeout`` seconds for outstanding sends, then close the
+        warm connections nobody picked up. Return False if sends were still
+        running at the deadline.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        drained = True
+        if self.delayed_sender is not None:
+            self.delayed_sender.close()
+        if self.batch_sender is not None:
+            drained = await self.batch_sender.flush(timeout)
+        if drained and self.scheduler is not None:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            drained = await self.scheduler.flush(remaining)
+        if drained:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            drained = await self.wait_for_pending_sends(remaining)
+        if self.delayed_sender is not None:
+            # The scheduled messages being written to the store or released.
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            drained = await self.delayed_sender.flush(remaining) and drained
+        if self.batch_sender is not None:
+            await self.batch_sender.close()
+        if self.scheduler is not None:
+            await self.scheduler.close()
+        warm_connections, self.warm_connections = self.warm_connections, {}
+        for connections in warm_connections.values():
+            for connection in connections:
+                try:
+                    await connection.quit()
+                except Exception:
+                    connection.close()
+        return drained
+
+    def lifespan(self, app: t.Any = None) -> MailLifespan:
+        """
+        Return an async context manager running startup() and shutdown(), to be
+        used as the lifespan of a FastAPI application::
+
+            app = FastAPI(lifespan=mail.lifespan)
+        """
+        return MailLifespan(self)(app)
+
+
+def get_mail(name: t.Optional[str] = None) -> "Mail":
+    """
+    Return the Mail object registered under the given name, or the default
+    Mail object if no name is given.
+    """
+    return globals.get_mailman(name)
+
+
+def mail_dependency(name: t.Optional[str] = None) -> t.Callable[[], "Mail"]:
+    """
+    Build a FastAPI dependency which resolves the Mail object registered under
+    the given name::
+
+        @app.post("/tenant-a/welcome")
+        async def welcome(mail: Mail = Depends(mail_dependency("tenant-a"))):
+            await mail.send_mail(...)
+    """
+
+    def dependency() -> "Mail":
+        return get_mail(name)
+
+    return dependency
@@ -0,0 +1,156 @@
+"""
+Validation of large recipient lists.
+"""
+import re
+import typing as t
+from email.errors import HeaderParseError, NonASCIILocalPartDefect
+from email.headerregistry import Address, parser
+
+from fastapi_mailman.utils import force_str, punycode
+
+# The common case of a bare ASCII dot-atom address, which doesn't need the
+# full RFC 5322 parser.
+ATOM = r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+"
+ASCII_ADDRESS_RE = re.compile(r'%s(?:\.%s)*@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*' % (ATOM, ATOM))
+DOMAIN_LABEL_RE = re.compile(r'[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?')
+
+
+class SanitizedAddress(str):
+    """
+    An email address already parsed and validated by validate_recipients().
+
+    It is the address as a string, so it can be used wherever an address is
+    expected, and keeps the parsed ``display_name``, ``local_part`` and
+    ``domain`` so that sanitize_address() formats it for the envelope and the
+    headers without parsing it again.
+    """
+
+    display_name: str
+    local_part: str
+    domain: str
+    idna_domain: str
+
+    def __new__(cls, display_name: str, local_part: str, domain: str, idna_domain: str) -> "SanitizedAddress":
+        self = super().__new__(cls, str(Address(display_name, local_part, domain)))
+        self.display_name = display_name
+        self.local_part = local_part
+        self.domain = domain
+        self.idna_domain = idna_domain
+        # The formatted address by (encoding, smtputf8), see sanitize_address().
+        self._sanitized = {}
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (self.display_name, self.local_part, self.domain, self.idna_domain))
+
+    @property
+    def key(self) -> t.Tuple[str, str]:
+        """The mailbox of the address, ignoring the display name and the case of the domain."""
+        return (self.local_part, self.idna_domain.lower())
+
+    @classmethod
+    def __get_validators__(cls):
+        # Pydantic fields typed as SanitizedAddress keep the validated
+        # addresses as they are.
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value: t.Any) -> "SanitizedAddress":
+        if isinstance(value, cls):
+            return value
+        return parse_address(value)
+
+
+class RecipientValidation(t.NamedTuple):
+    """
+    What validate_recipients() returns: the ``valid`` addresses in their
+    original order, the ``invalid`` entries as (entry, reason) pairs and the
+    number of ``duplicates`` that were dropped.
+    """
+
+    valid: t.List[SanitizedAddress]
+    invalid: t.List[t.Tuple[t.Any, str]]
+    duplicates: int = 0
+
+
+def parse_address(addr: t.Union[str, t.Tuple[str, str]]) -> SanitizedAddress:
+    """
+    Parse and validate an email address string or a pair of (name, address),
+    raising ValueError if it's invalid.
+    """
+    if isinstance(addr, tuple):
+        display_name, address = addr
+        display_name = force_str(display_name)
+        name, local_part, domain = _parse_mailbox(force_str(address).strip())
+        if name:
+            raise ValueError('Invalid address "%s"; the name must not be part of the address' % address)
+    else:
+        display_name, local_part, domain = _parse_mailbox(force_str(addr).strip())
+
+    if not local_part or not domain:
+        raise ValueError('Invalid address "%s"; the local part and the domain are required' % (addr,))
+    if any(char in part for part in (display_name, local_part, domain) for char in '\r\n'):
+        raise ValueError('Invalid address; address parts cannot contain newlines.')
+    if domain.startswith('['):
+        # A domain literal, e.g. [192.0.2.1].
+        idna_domain = domain
+    else:
+        try:
+            idna_domain = punycode(domain)
+        except UnicodeError:
+            raise ValueError('Invalid domain "%s"' % domain)
+        if not all(DOMAIN_LABEL_RE.fullmatch(label) for label in idna_domain.split('.')):
+            raise ValueError('Invalid domain "%s"' % domain)
+    return SanitizedAddress(display_name, local_part, domain, idna_domain)
+
+
+def _parse_mailbox(addr: str) -> t.Tuple[str, str, str]:
+    """Return the display name, the local part and the domain of an address."""
+    if ASCII_ADDRESS_RE.fullmatch(addr):
+        local_part, domain = addr.rsplit('@', 1)
+        return '', local_part, domain
+    try:
+        token, rest = parser.get_mailbox(addr)
+    except (HeaderParseError, ValueError, IndexError):
+        raise ValueError('Invalid address "%s"' % addr)
+    if rest:
+        raise ValueError('Invalid address; only %s could be parsed from "%s"' % (token, addr))
+    # Non-ASCII local parts are sent with SMTPUTF8, see sanitize_address().
+    defects = [defect for defect in token.all_defects if not isinstance(defect, NonASCIILocalPartDefect)]
+    if defects:
+        raise ValueError('Invalid address "%s": %s' % (addr, defects[0]))
+    return token.display_name or '', token.local_part or '', token.domain or ''
+
+
+def validate_recipients(
+    addresses: t.Iterable[t.Union[str, t.Tuple[str, str]]],
+    dedupe: bool = True,
+) -> RecipientValidation:
+    """
+    Validate a list of recipients once, e.g. before a mass send, and return
+    the valid ones as SanitizedAddress objects that messages and backends
+    use without parsing them again.
+
+    Bare ASCII addresses skip the full address parser, and the Punycode of
+    the domains is cached. With dedupe, the addresses of a mailbox already in
+    the list are dropped, whatever their display name or the case of their
+    domain.
+    """
+    valid = []
+    invalid = []
+    seen = set()
+    duplicates = 0
+    for addr in addresses:
+        if not isinstance(addr, SanitizedAddress):
+            try:
+                addr = parse_address(addr)
+            except ValueError as e:
+                invalid.append((addr, str(e)))
+                continue
+        if dedupe:
+            if addr.key in seen:
+                duplicates += 1
+                continue
+            seen.add(addr.key)
+        valid.append(addr)
+    return RecipientValidation(valid, invalid, duplicates)
@@ -1,4 +1,6 @@
 """Base email backend class."""
+from fastapi_mailman.results import SendResult
+from fastapi_mailman.utils import achunks
 
 
 class BaseEmailBackend:
@@ -15,6 +17,10 @@ class BaseEmailBackend:
            pass
     """
 
+    # Whether send_messages() also accepts RenderedMessage objects, i.e.
+    # messages already rendered to their wire format.
+    accepts_rendered_messages = False
+
     def __init__(self, mailman=None, fail_silently=False, **kwargs):
         self.fail_silently = fail_silently
         try:
@@ -45,6 +51,18 @@ class BaseEmailBackend:
         """Close a network connection."""
         pass
 
+    async def warm_up(self):
+        """
+        Prepare a connection ahead of time, e.g. when the application starts.
+
+        This method can be overwritten by backend implementations that benefit
+        from connecting before the first message is sent. See the warm_up()
+        method of the SMTP backend for a reference implementation.
+
+        The default implementation does nothing.
+        """
+        pass
+
     async def __aenter__(self):
         try:
             await self.open()
@@ -59,6 +77,27 @@ class BaseEmailBackend:
     async def send_messages(self, email_messages):
         """
         Send one or more EmailMessage objects and return the number of email
-        messages sent.
+        messages sent, as a fastapi_mailman.results.SendResult with the result
+        of each message.
+
+        email_messages may be any iterable or async iterable of messages,
+        iterate over it with fastapi_mailman.utils.aiterate().
         """
         raise NotImplementedError('subclasses of BaseEmailBackend must override send_messages() method')
+
+    async def iter_send_messages(self, email_messages, chunk_size=100):
+        """
+        Send the messages of an iterable or async iterable chunk by chunk over
+        one connection, so that only ``chunk_size`` of them are held in memory
+        at a time. Yield the number of messages sent of each chunk, as the
+        SendResult returned by send_messages().
+        """
+        new_conn_created = await self.open()
+        try:
+            async for chunk in achunks(email_messages, chunk_size):
+                sent = await self.send_messages(chunk)
+                # A SendResult is falsy when no message of the chunk was sent.
+                yield SendResult() if sent is None else sent
+        finally:
+            if new_conn_created:
+                await self.close()
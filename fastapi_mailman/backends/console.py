@@ -3,8 +3,12 @@ Email backend that writes messages to console instead of sending them.
 """
 import sys
 import threading
+import time
 
 from fastapi_mailman.backends.base import BaseEmailBackend
+from fastapi_mailman.profiling import profile_send, profile_step, record_size
+from fastapi_mailman.results import MessageResult, SendResult
+from fastapi_mailman.utils import aiterate
 
 
 class EmailBackend(BaseEmailBackend):
@@ -15,7 +19,9 @@ class EmailBackend(BaseEmailBackend):
 
     def write_message(self, message):
         msg = message.message()
-        msg_data = msg.as_bytes()
+        with profile_step('as_bytes'):
+            msg_data = msg.as_bytes()
+        record_size(len(msg_data))
         charset = msg.get_charset().get_output_charset() if msg.get_charset() else 'utf-8'
         msg_data = msg_data.decode(charset)
         self.stream.write('%s\n' % msg_data)
@@ -25,18 +31,29 @@ class EmailBackend(BaseEmailBackend):
     async def send_messages(self, email_messages):
         """Write all messages to the stream in a thread-safe way."""
         if not email_messages:
-            return
-        msg_count = 0
+            return SendResult()
+        results = []
         with self._lock:
             try:
                 stream_created = await self.open()
-                for message in email_messages:
-                    self.write_message(message)
-                    self.stream.flush()  # flush after each message
-                    msg_count += 1
-                if stream_created:
-                    await self.close()
-            except Exception:
+            except Exception as exc:
                 if not self.fail_silently:
                     raise
-        return msg_count
+                return SendResult([MessageResult(message, error=exc) async for message in aiterate(email_messages)])
+            try:
+                async for message in aiterate(email_messages):
+                    start = time.perf_counter()
+                    try:
+                        with profile_send(self.mailman, message):
+                            self.write_message(message)
+                        self.stream.flush()  # flush after each message
+                    except Exception as exc:
+                        if not self.fail_silently:
+                            raise
+                        results.append(MessageResult(message, error=exc, duration=time.perf_counter() - start))
+                    else:
+                        results.append(MessageResult.accepted(message, time.perf_counter() - start))
+            finally:
+                if stream_created:
+                    await self.close()
+        return SendResult(results)
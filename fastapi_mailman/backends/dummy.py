@@ -3,8 +3,13 @@ Dummy email backend that does nothing.
 """
 
 from fastapi_mailman.backends.base import BaseEmailBackend
+from fastapi_mailman.results import MessageResult, SendResult
+from fastapi_mailman.utils import aiterate
 
 
 class EmailBackend(BaseEmailBackend):
     async def send_messages(self, email_messages):
-        return len(list(email_messages))
+        results = []
+        async for message in aiterate(email_messages):
+            results.append(MessageResult.accepted(message))
+        return SendResult(results)
@@ -0,0 +1,92 @@
+"""Email backend delivering to a local MTA over a Unix domain socket, with SMTP or LMTP."""
+
+import typing as t
+
+import aiosmtplib
+
+from fastapi_mailman.backends.smtp import EmailBackend as SMTPEmailBackend
+from fastapi_mailman.tracing import start_span
+from fastapi_mailman.utils import DNS_NAME
+
+
+class LMTP(aiosmtplib.SMTP):
+    """An aiosmtplib client speaking LMTP (RFC 2033), which greets with LHLO instead of EHLO."""
+
+    async def ehlo(self, hostname=None, **kwargs):
+        if hostname is None:
+            hostname = self.source_address
+        response = await self.execute_command(b'LHLO', hostname.encode('ascii'), **kwargs)
+        # Parses the extensions, as after EHLO.
+        self.last_ehlo_response = response
+        if response.code != aiosmtplib.SMTPStatus.completed:
+            raise aiosmtplib.SMTPHeloError(response.code, response.message)
+        return response
+
+
+class EmailBackend(SMTPEmailBackend):
+    """
+    Deliver messages to an MTA running on the same host, e.g. Postfix, over
+    its Unix domain socket: no TCP, TLS nor authentication. Messages are
+    serialized as by the SMTP backend, with the same options.
+
+    With ``lmtp``, the backend speaks LMTP, e.g. to a Dovecot or Cyrus LMTP
+    socket. The server then replies for each recipient once the message is
+    received, and the recipients it failed for are reported like the ones
+    refused by RCPT: the message counts as sent if it was delivered to one
+    recipient at least, SMTPRecipientsRefused is raised otherwise.
+    """
+
+    def __init__(self, socket_path=None, lmtp=None, **kwargs):
+        # The socket is local, there is nothing to encrypt nor log into.
+        kwargs.update(use_tls=False, use_ssl=False, username='', password='')
+        super().__init__(**kwargs)
+        self.socket_path = socket_path or self.mailman.socket_path
+        if not self.socket_path:
+            raise ValueError('The lmtp backend requires MAIL_SOCKET_PATH or the socket_path argument.')
+        self.lmtp = self.mailman.use_lmtp if lmtp is None else lmtp
+        # Not the relays of the Mail object, the socket is the only server.
+        self.relay_pool = None
+
+    @property
+    def connection_class(self) -> t.Type["aiosmtplib.SMTP"]:
+        return LMTP if self.lmtp else aiosmtplib.SMTP
+
+    @property
+    def warm_connection_key(self) -> t.Hashable:
+        return (self.socket_path, self.lmtp)
+
+    async def _open_connection(self):
+        connection_params = {'hostname': None, 'socket_path': self.socket_path, 'source_address': DNS_NAME.get_fqdn()}
+        if self.timeout is not None:
+            connection_params['timeout'] = self.timeout
+        with start_span(self.mailman, 'smtp.open', **{'server.address': self.socket_path}):
+            self.connection = self.connection_class(**connection_params)
+            with start_span(self.mailman, 'smtp.connect'):
+                await self.connection.connect()
+            return True
+
+    async def _sendmail_data(self, from_email, recipients, msg_data, mail_options):
+        if not self.lmtp:
+            return await super()._sendmail_data(from_email, recipients, msg_data, mail_options)
+        # aiosmtplib reads a single reply to DATA, LMTP sends one per recipient.
+        return await self._sendmail_stream(from_email, recipients, [msg_data], len(msg_data), mail_options)
+
+    async def _read_data_replies(self, protocol, recipients):
+        if not self.lmtp:
+            return await super()._read_data_replies(protocol, recipients)
+        failed = {}
+        message = ''
+        for recipient in recipients:
+            # aiosmtplib parses its buffer when data arrives, the replies that
+            # arrived along with the previous one are still waiting in it.
+            response = protocol._read_response_from_buffer()
+            if response is None:
+                response = await protocol.read_response(timeout=self.connection.timeout)
+            if response.code != aiosmtplib.SMTPStatus.completed:
+                failed[recipient] = response
+            message = response.message
+        if len(failed) == len(recipients):
+            raise aiosmtplib.SMTPRecipientsRefused(
+                [aiosmtplib.SMTPRecipientRefused(code, text, recipient) for recipient, (code, text) in failed.items()]
+            )
+        return failed, message
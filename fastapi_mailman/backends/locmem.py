@@ -2,6 +2,8 @@
 Backend for test environment.
 """
 from fastapi_mailman.backends.base import BaseEmailBackend
+from fastapi_mailman.results import MessageResult, SendResult
+from fastapi_mailman.utils import aiterate
 
 
 class EmailBackend(BaseEmailBackend):
@@ -21,9 +23,9 @@ class EmailBackend(BaseEmailBackend):
 
     async def send_messages(self, messages):
         """Redirect messages to the dummy outbox"""
-        msg_count = 0
-        for message in messages:  # .message() triggers header validation
+        results = []
+        async for message in aiterate(messages):  # .message() triggers header validation
             message.message()
             self.mailman.outbox.append(message)
-            msg_count += 1
-        return msg_count
+            results.append(MessageResult.accepted(message))
+        return SendResult(results)
@@ -1,19 +1,52 @@
 """SMTP email backend class."""
+import asyncio
 import ssl
 import threading
+import time
 import typing as t
 
 import aiosmtplib
 
 from fastapi_mailman.backends.base import BaseEmailBackend
+from fastapi_mailman.errors import MessageTooLarge
 from fastapi_mailman.message import sanitize_address
+from fastapi_mailman.profiling import profile_send, profile_step, record_size
+from fastapi_mailman.relays import RelayPool
+from fastapi_mailman.rendering import RenderedMessage
+from fastapi_mailman.results import MessageResult, RecipientResult, SendResult
+from fastapi_mailman.tracing import start_span
+from fastapi_mailman.utils import DNS_NAME, aiterate
 
 
 class EmailBackend(BaseEmailBackend):
     """
     A wrapper that manages the SMTP network connection.
+
+    In keep-alive mode, send_messages() leaves the connection it opened open for
+    the next call on the same backend instance: transactions are separated by
+    RSET, a connection dropped by the server is transparently reopened, idle
+    connections are kept alive with NOOP every ``noop_interval`` seconds and
+    closed after ``idle_timeout`` seconds without a message.
+
+    With ``use_smtputf8``, messages are sent with 8-bit bodies declared as such
+    to servers advertising 8BITMIME, and with UTF-8 headers and addresses
+    written as is to servers also advertising SMTPUTF8.
+
+    A message larger than the SIZE limit advertised by the server isn't
+    uploaded, MessageTooLarge is raised instead.
+
+    In streaming mode, messages are written to the connection chunk by chunk as
+    they are formatted, instead of being formatted into one buffer first.
+
+    With ``relays`` (a RelayPool or a list of relays, defaulting to the
+    MAIL_RELAYS of the Mail object unless ``host`` is given), each connection
+    goes to a relay picked by the pool. A relay that refuses the connection or
+    answers with a 4xx reply is marked unhealthy, and the connection or the
+    transaction fails over to the next relay.
     """
 
+    accepts_rendered_messages = True
+
     def __init__(
         self,
         host=None,
@@ -26,6 +59,13 @@ class EmailBackend(BaseEmailBackend):
         timeout=None,
         ssl_keyfile=None,
         ssl_certfile=None,
+        validate_certs=None,
+        use_smtputf8=None,
+        streaming=None,
+        keep_alive=None,
+        idle_timeout=None,
+        noop_interval=None,
+        relays=None,
         **kwargs,
     ):
         super().__init__(fail_silently=fail_silently, **kwargs)
@@ -38,12 +78,31 @@ class EmailBackend(BaseEmailBackend):
         self.timeout = self.mailman.timeout if timeout is None else timeout
         self.ssl_keyfile = self.mailman.ssl_keyfile if ssl_keyfile is None else ssl_keyfile
         self.ssl_certfile = self.mailman.ssl_certfile if ssl_certfile is None else ssl_certfile
+        self.validate_certs = self.mailman.validate_certs if validate_certs is None else validate_certs
         if self.use_ssl and self.use_tls:
             raise ValueError(
                 "EMAIL_USE_TLS/EMAIL_USE_SSL are mutually exclusive, so only set " "one of those settings to True."
             )
+        self.use_smtputf8 = self.mailman.use_smtputf8 if use_smtputf8 is None else use_smtputf8
+        self.streaming = self.mailman.streaming if streaming is None else streaming
+        self.keep_alive = self.mailman.keep_alive if keep_alive is None else keep_alive
+        self.idle_timeout = self.mailman.keep_alive_idle_timeout if idle_timeout is None else idle_timeout
+        self.noop_interval = self.mailman.keep_alive_noop_interval if noop_interval is None else noop_interval
+        if relays is None and host is None:
+            relays = self.mailman.relay_pool
+        if relays is not None and not isinstance(relays, RelayPool):
+            relays = RelayPool(relays, default_port=self.port)
+        self.relay_pool = relays
+        # The relay of the open connection, in relay mode.
+        self.relay = None
         self.connection = None
         self._lock = threading.RLock()
+        self._keep_alive_lock = None
+        self._idle_task = None
+        self._last_activity = None
+        self._transactions = 0
+        # The error that failed open() silently, reported in the results.
+        self._open_error = None
 
     @property
     def connection_class(self) -> t.Type["aiosmtplib.SMTP"]:
@@ -56,45 +115,151 @@ class EmailBackend(BaseEmailBackend):
         passed silently.
         """
         if self.connection:
-            # Nothing to do if the connection is already open.
-            return False
+            if self.keep_alive and not self.connection.is_connected:
+                # The server dropped the connection while it was idle.
+                self._drop_connection()
+            else:
+                # Nothing to do if the connection is already open.
+                return False
+
+        self._transactions = 0
+        self._open_error = None
+
+        # Pick up a connection opened ahead of time by Mail.startup().
+        warm_connections = self.mailman.warm_connections.get(self.warm_connection_key, [])
+        while warm_connections:
+            connection = warm_connections.pop()
+            if connection.is_connected:
+                self.connection = connection
+                if self.relay_pool is not None:
+                    self._use_relay(self.relay_pool.find(connection.hostname, connection.port))
+                return True
+
+        return await self._connect()
+
+    async def _connect(self):
+        """Open a new connection to the email server, see open()."""
+        if self.relay_pool is not None:
+            return await self._connect_relay()
+        try:
+            return await self._open_connection()
+        except OSError as exc:
+            if not self.fail_silently:
+                raise
+            self._open_error = exc
+
+    async def _connect_relay(self):
+        """Open a new connection to the first relay of the pool that accepts it."""
+        error = None
+        for relay in self.relay_pool.candidates():
+            self.host, self.port = relay.host, relay.port
+            try:
+                await self._open_connection()
+            except (OSError, aiosmtplib.SMTPResponseException) as exc:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                if not _is_relay_failure(exc):
+                    raise
+                self.relay_pool.mark_failed(relay)
+                error = exc
+                continue
+            self.relay_pool.mark_healthy(relay)
+            self._use_relay(relay)
+            return True
+        if not (self.fail_silently and isinstance(error, OSError)):
+            raise error
+        self._open_error = error
+
+    def _use_relay(self, relay):
+        self.relay = relay
+        if relay is not None:
+            self.host, self.port = relay.host, relay.port
+            relay.outstanding += 1
 
-        # If local_hostname is not specified, socket.getfqdn() gets used.
-        # For performance, we use the cached FQDN for local_hostname.
-        # connection_params = {'local_hostname': DNS_NAME.get_fqdn()}
-        connection_params = {}
+    def _release_relay(self):
+        if self.relay is not None:
+            self.relay.outstanding -= 1
+            self.relay = None
+
+    def _drop_connection(self):
+        """Forget a connection that is no longer usable."""
+        self.connection.close()
+        self.connection = None
+        self._release_relay()
+
+    async def _open_connection(self):
+        # If source_address is not specified, socket.getfqdn() gets used.
+        # For performance, we use the cached FQDN for source_address.
+        connection_params = {'source_address': DNS_NAME.get_fqdn()}
         if self.timeout is not None:
             connection_params['timeout'] = self.timeout
         if self.use_ssl:
             connection_params.update(
                 {
-                    'client_key': self.ssl_keyfile,
-                    'client_cert': self.ssl_certfile,
+                    'use_tls': True,
+                    'tls_context': self.tls_context,
                 }
             )
-        try:
+        with start_span(self.mailman, 'smtp.open', **{'server.address': self.host, 'server.port': self.port}):
             self.connection = self.connection_class(self.host, self.port, **connection_params)
             # TLS/SSL are mutually exclusive, so only attempt TLS over
             # non-secure connections.
-            await self.connection.connect()
+            with start_span(self.mailman, 'smtp.connect'):
+                await self.connection.connect()
 
             if not self.use_ssl and self.use_tls:
-                await self.connection.starttls(client_key=self.ssl_keyfile, client_cert=self.ssl_certfile)
+                with start_span(self.mailman, 'smtp.starttls'):
+                    await self.connection.starttls(tls_context=self.tls_context)
 
             if self.username and self.password:
-                await self.connection.login(self.username, self.password)
+                with start_span(self.mailman, 'smtp.login'):
+                    await self.connection.login(self.username, self.password)
 
+            self._save_tls_session()
             return True
 
-        except OSError:
-            if not self.fail_silently:
-                raise
+    @property
+    def tls_context(self) -> ssl.SSLContext:
+        """The SSL context shared by every connection with the same TLS settings."""
+        return self.mailman.get_ssl_context(self.ssl_keyfile, self.ssl_certfile, self.validate_certs)
+
+    def _save_tls_session(self):
+        """Keep the TLS session of the connection, for the next one to resume it."""
+        if self.use_ssl or self.use_tls:
+            ssl_object = self.connection.get_transport_info('ssl_object')
+            self.tls_context.save_session(self.host, ssl_object)
+
+    @property
+    def warm_connection_key(self) -> t.Hashable:
+        """The settings a warm connection must have been opened with to be reused."""
+        # Any relay of the pool will do.
+        address = (self.host, self.port) if self.relay_pool is None else self.relay_pool
+        return (address, self.username, self.password, self.use_tls, self.use_ssl)
+
+    async def warm_up(self):
+        """
+        Open and authenticate a connection, and hand it over to the Mail object
+        for the next call to open() with the same settings.
+        """
+        if self.connection:
+            return
+        if await self._connect():
+            self.mailman.warm_connections.setdefault(self.warm_connection_key, []).append(self.connection)
+            self.connection = None
+            self._release_relay()
 
     async def close(self):
         """Close the connection to the email server."""
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
         if self.connection is None:
             return
         try:
+            if self.connection.is_connected:
+                # TLS 1.3 session tickets arrive after the handshake.
+                self._save_tls_session()
             try:
                 await self.connection.quit()
             except (ssl.SSLError, aiosmtplib.SMTPServerDisconnected):
@@ -108,41 +273,259 @@ class EmailBackend(BaseEmailBackend):
                 raise
         finally:
             self.connection = None
+            self._release_relay()
 
     async def send_messages(self, email_messages) -> int:
         """
         Send one or more EmailMessage objects and return the number of email
-        messages sent.
+        messages sent, a SendResult with the result of each message.
         """
         if not email_messages:
-            return 0
+            return SendResult()
+        if self.keep_alive:
+            # The connection outlives this call, so concurrent calls must not
+            # interleave their transactions on it.
+            if self._keep_alive_lock is None:
+                self._keep_alive_lock = asyncio.Lock()
+            async with self._keep_alive_lock:
+                return await self._send_messages(email_messages)
         with self._lock:
-            new_conn_created = await self.open()
-            if not self.connection or new_conn_created is None:
-                # We failed silently on open().
-                # Trying to send would be pointless.
-                return 0
-            num_sent = 0
-            for message in email_messages:
-                sent = await self._send(message)
-                if sent:
-                    num_sent += 1
-            if new_conn_created:
-                await self.close()
-        return num_sent
+            return await self._send_messages(email_messages)
+
+    async def _send_messages(self, email_messages):
+        new_conn_created = await self.open()
+        if not self.connection or new_conn_created is None:
+            # We failed silently on open().
+            # Trying to send would be pointless.
+            return SendResult(
+                [MessageResult(message, error=self._open_error) async for message in aiterate(email_messages)]
+            )
+        results = []
+        async for message in aiterate(email_messages):
+            results.append(await self._send(message))
+        if self.keep_alive:
+            self._watch_idle_connection()
+        elif new_conn_created:
+            await self.close()
+        return SendResult(results)
+
+    def _get_mail_options(self):
+        """Return the MAIL FROM options enabled by the server extensions."""
+        if not self.use_smtputf8 or not self.connection.supports_extension('8bitmime'):
+            return []
+        if not self.connection.supports_extension('smtputf8'):
+            return ['BODY=8BITMIME']
+        return ['BODY=8BITMIME', 'SMTPUTF8']
+
+    def _check_size(self, size):
+        """Raise MessageTooLarge if the server advertised a lower SIZE limit."""
+        try:
+            limit = int(self.connection.esmtp_extensions.get('size') or 0)
+        except ValueError:
+            return
+        # A limit of 0 means no fixed limit (RFC 1870).
+        if limit and size > limit:
+            raise MessageTooLarge(size, limit)
 
     async def _send(self, email_message):
         """A helper method that does the actual sending."""
         if not email_message.recipients():
-            return False
-        encoding = email_message.encoding or self.mailman.default_charset
-        from_email = sanitize_address(email_message.from_email, encoding)
-        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
-        message = email_message.message()
+            return MessageResult(email_message)
+        start = time.perf_counter()
         try:
-            await self.connection.sendmail(from_email, recipients, message.as_bytes(linesep='\r\n'))
-        except aiosmtplib.SMTPException:
+            with profile_send(self.mailman, email_message):
+                recipients, errors, reply = await self._sendmail(email_message)
+        except aiosmtplib.SMTPException as exc:
             if not self.fail_silently:
                 raise
-            return False
-        return True
+            refused = []
+            if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+                refused = [RecipientResult(error.recipient, error.code, error.message) for error in exc.recipients]
+            return MessageResult(email_message, refused, error=exc, duration=time.perf_counter() - start)
+        results = [RecipientResult(recipient, *errors.get(recipient, (250, reply))) for recipient in recipients]
+        return MessageResult(email_message, results, reply, duration=time.perf_counter() - start)
+
+    async def _sendmail(self, email_message):
+        """Run one mail transaction, reusing a kept alive connection if any."""
+        if not self.keep_alive and self.relay is None:
+            return await self._transaction(email_message)
+        try:
+            if self._transactions:
+                await self.connection.rset()
+            response = await self._transaction(email_message)
+        except (
+            aiosmtplib.SMTPServerDisconnected,
+            aiosmtplib.SMTPResponseException,
+            aiosmtplib.SMTPRecipientsRefused,
+        ) as exc:
+            if not isinstance(exc, aiosmtplib.SMTPServerDisconnected):
+                if self.relay is not None and _is_relay_failure(exc):
+                    # Fail over to another relay.
+                    self.relay_pool.mark_failed(self.relay)
+                elif getattr(exc, 'code', None) != 421:
+                    raise
+            # The server closed the connection since the last transaction,
+            # reconnect and try once more.
+            self._drop_connection()
+            if not await self.open():
+                raise
+            response = await self._transaction(email_message)
+        self._transactions += 1
+        return response
+
+    async def _transaction(self, email_message):
+        """
+        Send a message over the connection. Return its envelope recipients,
+        the replies of the recipients it failed for, and the reply to the
+        message.
+        """
+        if self.connection.is_ehlo_or_helo_needed:
+            # The extensions decide how the message is serialized.
+            await self.connection.ehlo()
+        mail_options = self._get_mail_options()
+        if isinstance(email_message, RenderedMessage):
+            # Already rendered, with or without SMTPUTF8 whatever the server supports.
+            mail_options = [option for option in mail_options if option != 'SMTPUTF8']
+            if email_message.smtputf8:
+                mail_options.append('SMTPUTF8')
+            from_email, recipients, msg_data = email_message.from_email, email_message.to, email_message.data
+        else:
+            smtputf8 = 'SMTPUTF8' in mail_options
+            encoding = email_message.encoding or self.mailman.default_charset
+            from_email = sanitize_address(email_message.from_email, encoding, smtputf8)
+            recipients = [sanitize_address(addr, encoding, smtputf8) for addr in email_message.recipients()]
+            message = email_message.message(smtputf8=smtputf8)
+            if self.streaming:
+                stream = message.as_stream(linesep='\r\n')
+                record_size(len(stream))
+                self._check_size(len(stream))
+                with start_span(self.mailman, 'smtp.sendmail', **self._span_attributes(recipients, len(stream))):
+                    errors, reply = await self._sendmail_stream(
+                        from_email, recipients, stream, len(stream), mail_options
+                    )
+                return recipients, errors, reply
+            with profile_step('as_bytes'):
+                msg_data = message.as_bytes(linesep='\r\n')
+        record_size(len(msg_data))
+        # Fail before uploading the message rather than after the server has
+        # received it all. sendmail() declares SIZE= in MAIL FROM itself.
+        self._check_size(len(msg_data))
+        with start_span(self.mailman, 'smtp.sendmail', **self._span_attributes(recipients, len(msg_data))):
+            errors, reply = await self._sendmail_data(from_email, recipients, msg_data, mail_options)
+        return recipients, errors, reply
+
+    async def _sendmail_data(self, from_email, recipients, msg_data, mail_options):
+        return await self.connection.sendmail(from_email, recipients, msg_data, mail_options)
+
+    def _span_attributes(self, recipients, size):
+        return {'mail.recipients': len(recipients), 'mail.size': size}
+
+    async def _sendmail_stream(self, from_email, recipients, stream, size, mail_options):
+        """
+        Like aiosmtplib's sendmail(), but write the message to the connection
+        chunk by chunk as the stream generates it.
+        """
+        encoding = 'utf-8' if 'SMTPUTF8' in mail_options else 'ascii'
+        if self.connection.supports_extension('size'):
+            mail_options = ['SIZE=%d' % size] + mail_options
+        try:
+            await self.connection.mail(from_email, options=mail_options, encoding=encoding)
+            errors = {}
+            for recipient in recipients:
+                try:
+                    await self.connection.rcpt(recipient, encoding=encoding)
+                except aiosmtplib.SMTPRecipientRefused as exc:
+                    errors[recipient] = exc
+            if len(errors) == len(recipients):
+                raise aiosmtplib.SMTPRecipientsRefused(list(errors.values()))
+            accepted = [recipient for recipient in recipients if recipient not in errors]
+            failed, message = await self._data_stream(stream, accepted)
+        except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+            # Reset the envelope, as sendmail() does.
+            try:
+                await self.connection.rset()
+            except (ConnectionError, aiosmtplib.SMTPResponseException):
+                pass
+            raise
+        errors = {recipient: aiosmtplib.SMTPResponse(exc.code, exc.message) for recipient, exc in errors.items()}
+        errors.update(failed)
+        return errors, message
+
+    async def _data_stream(self, stream, recipients):
+        protocol = self.connection.protocol
+        if protocol is None:
+            raise aiosmtplib.SMTPServerDisconnected('Connection lost')
+        response = await self.connection.execute_command(b'DATA')
+        if response.code != aiosmtplib.SMTPStatus.start_input:
+            raise aiosmtplib.SMTPDataError(response.code, response.message)
+        last_chunk = b'\r\n'
+        for chunk in _dot_stuff(stream):
+            protocol.write(chunk)
+            # Wait for the transport buffer to drain, so that only a chunk or
+            # so of the message is in memory at a time.
+            await protocol._drain_helper()
+            last_chunk = chunk or last_chunk
+        protocol.write(b'.\r\n' if last_chunk.endswith(b'\r\n') else b'\r\n.\r\n')
+        return await self._read_data_replies(protocol, recipients)
+
+    async def _read_data_replies(self, protocol, recipients):
+        """
+        Read the reply to the end of the message data. Return the recipients
+        it failed for, with their reply, and the text of the reply.
+        """
+        response = await protocol.read_response(timeout=self.connection.timeout)
+        if response.code != aiosmtplib.SMTPStatus.completed:
+            raise aiosmtplib.SMTPDataError(response.code, response.message)
+        return {}, response.message
+
+    def _watch_idle_connection(self):
+        """Start (or keep) watching the kept alive connection for idleness."""
+        self._last_activity = asyncio.get_event_loop().time()
+        if self._idle_task is None and (self.idle_timeout is not None or self.noop_interval):
+            self._idle_task = asyncio.ensure_future(self._keep_idle_connection_alive())
+
+    async def _keep_idle_connection_alive(self):
+        loop = asyncio.get_event_loop()
+        interval = min(delay for delay in (self.idle_timeout, self.noop_interval) if delay)
+        while self.connection is not None:
+            await asyncio.sleep(interval)
+            async with self._keep_alive_lock:
+                idle = loop.time() - self._last_activity
+                if self.idle_timeout is not None and idle >= self.idle_timeout:
+                    # Don't let close() cancel the task it is running in.
+                    self._idle_task = None
+                    await self.close()
+                    return
+                if self.noop_interval and idle >= self.noop_interval and self.connection is not None:
+                    try:
+                        await self.connection.noop()
+                    except aiosmtplib.SMTPException:
+                        # The next send reconnects.
+                        self._drop_connection()
+        self._idle_task = None
+
+
+def _is_relay_failure(exc):
+    """Whether an error means the relay is down or overloaded, rather than the message being refused."""
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return 400 <= exc.code < 500
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        # E.g. a 421 or 451 reply to every RCPT.
+        return bool(exc.recipients) and all(400 <= recipient.code < 500 for recipient in exc.recipients)
+    return isinstance(exc, OSError)
+
+
+def _dot_stuff(chunks):
+    """
+    Double the periods starting a line (RFC 5321, section 4.5.2) in a stream of
+    CRLF terminated lines split into chunks.
+    """
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk.replace(b'\n.', b'\n..')
+        if line_start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+        line_start = chunk.endswith(b'\n')
+        yield chunk
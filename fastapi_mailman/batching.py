@@ -0,0 +1,138 @@
+"""
+Coalescing of messages sent from many concurrent requests.
+"""
+import asyncio
+import typing as t
+
+from fastapi_mailman.tracing import capture_context
+
+if t.TYPE_CHECKING:
+    import contextvars
+
+    from . import Mail
+    from .backends.base import BaseEmailBackend
+    from .message import EmailMessage
+
+
+class BatchSender:
+    """
+    Collect the messages submitted within a short window, and send them over a
+    single connection.
+
+    A batch is flushed ``max_delay`` seconds after its first message was
+    submitted, or as soon as it holds ``max_batch_size`` messages, whichever
+    comes first. Every message is sent with its own send_messages() call on the
+    shared connection, so that each caller gets the result (or the exception)
+    of its own message. A backend in keep-alive mode is kept for the following
+    batches instead of being closed after each one.
+
+    :param mailman: the Mail object whose backend sends the batches.
+
+    :param max_batch_size: the number of messages that triggers a flush.
+
+    :param max_delay: how many seconds a message may wait for the batch to fill.
+
+    :param backend: the backend to send with, defaults to the MAIL_BACKEND of
+        the Mail object.
+    """
+
+    def __init__(
+        self,
+        mailman: "Mail",
+        max_batch_size: int = 100,
+        max_delay: float = 0.05,
+        backend: t.Any = None,
+    ):
+        self.mailman = mailman
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.backend = backend
+        self._pending: t.List[t.Tuple["EmailMessage", asyncio.Future, t.Optional["contextvars.Context"]]] = []
+        self._timer: t.Optional[asyncio.TimerHandle] = None
+        self._flushes: t.Set[asyncio.Future] = set()
+        self.connection: t.Optional["BaseEmailBackend"] = None
+
+    def submit(self, message: "EmailMessage") -> asyncio.Future:
+        """
+        Queue a message for the next batch. Return a future resolving to the
+        number of messages sent (0 or 1).
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((message, future, capture_context(self.mailman)))
+        if len(self._pending) >= self.max_batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        return future
+
+    async def flush(self, timeout: t.Optional[float] = None) -> bool:
+        """
+        Send the queued messages now, and wait up to ``timeout`` seconds for
+        every batch in flight. Return False if some were still running at the
+        deadline.
+        """
+        self._start_flush()
+        if not self._flushes:
+            return True
+        _, pending = await asyncio.wait(set(self._flushes), timeout=timeout)
+        return not pending
+
+    async def close(self) -> None:
+        """Close the connection kept between batches, if any."""
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+    def _get_connection(self) -> "BaseEmailBackend":
+        if self.connection is not None:
+            return self.connection
+        connection: "BaseEmailBackend" = self.mailman.get_connection(backend=self.backend)
+        if getattr(connection, 'keep_alive', False):
+            self.connection = connection
+        return connection
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            flush = asyncio.ensure_future(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(
+        self, batch: t.List[t.Tuple["EmailMessage", asyncio.Future, t.Optional["contextvars.Context"]]]
+    ) -> None:
+        connection = self._get_connection()
+        with self.mailman.track_send():
+            try:
+                if connection is not self.connection:
+                    # A kept alive connection is opened on demand by send_messages().
+                    await connection.open()
+            except Exception as exc:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                return
+            try:
+                for message, future, context in batch:
+                    if future.done():
+                        # The caller stopped waiting for it.
+                        continue
+                    try:
+                        send = connection.send_messages([message])
+                        if context is not None:
+                            # Sent in the context of its caller, for tracing.
+                            send = context.run(asyncio.ensure_future, send)
+                        sent = await send
+                    except Exception as exc:
+                        if not future.done():
+                            future.set_exception(exc)
+                    else:
+                        if not future.done():
+                            future.set_result(sent)
+            finally:
+                if connection is not self.connection:
+                    await connection.close()
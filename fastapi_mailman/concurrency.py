@@ -0,0 +1,270 @@
+"""
+Adaptive concurrency for sending messages over several connections.
+"""
+import asyncio
+import time
+import typing as t
+
+import aiosmtplib
+
+from fastapi_mailman.utils import aiterate
+
+if t.TYPE_CHECKING:
+    from . import Mail
+    from .backends.base import BaseEmailBackend
+    from .message import EmailMessage
+
+# Replies by which servers ask clients to slow down: service not available,
+# local error in processing and insufficient system storage.
+THROTTLING_CODES = frozenset({421, 451, 452})
+
+
+def is_throttling(exc: BaseException) -> bool:
+    """
+    Whether an exception raised while sending means that the server is
+    overloaded or throttling the client, rather than rejecting the message.
+    """
+    if isinstance(exc, (asyncio.TimeoutError, aiosmtplib.SMTPTimeoutError, aiosmtplib.SMTPServerDisconnected)):
+        return True
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(error.code in THROTTLING_CODES for error in exc.recipients)
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return exc.code in THROTTLING_CODES
+    return False
+
+
+class AIMDLimiter:
+    """
+    A concurrency limit adjusted with additive increase, multiplicative
+    decrease (AIMD), as in TCP congestion control.
+
+    Every successful transaction raises the limit by ``increase / limit``, that
+    is by ``increase`` per round of ``limit`` transactions. The limit is
+    multiplied by ``decrease_factor`` when the server throttles the client, or
+    when the average latency exceeds ``latency_tolerance`` times the lowest
+    latency seen, a sign that the server is queueing transactions. Throttling
+    signals within one average latency of a decrease are the same congestion
+    event, and don't decrease the limit again.
+
+    :param initial_limit: the number of transactions allowed in flight at first.
+
+    :param min_limit: the lowest limit.
+
+    :param max_limit: the highest limit.
+
+    :param increase: the increase of the limit per round of transactions.
+
+    :param decrease_factor: the factor applied to the limit on congestion.
+
+    :param latency_tolerance: how many times the lowest latency the average
+        latency may reach before the limit is decreased, None to ignore
+        latency.
+
+    :param smoothing: the weight of each new latency in the average.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        latency_tolerance: t.Optional[float] = 2.0,
+        smoothing: float = 0.2,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError('The limits must satisfy 1 <= min_limit <= initial_limit <= max_limit.')
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency: t.Optional[float] = None
+        self.min_latency: t.Optional[float] = None
+        self._limit = float(initial_limit)
+        self._last_decrease = float('-inf')
+        self._condition: t.Optional[asyncio.Condition] = None
+
+    @property
+    def limit(self) -> int:
+        """The number of transactions currently allowed in flight."""
+        return int(self._limit)
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> None:
+        """Wait until a transaction may start, and count it as in flight."""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        """Count a transaction started with acquire() as finished."""
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify(max(self.limit - self.in_flight, 0))
+
+    def on_success(self, latency: float) -> None:
+        """Record a successful transaction that took ``latency`` seconds."""
+        self.latency = latency if self.latency is None else self.latency + self.smoothing * (latency - self.latency)
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        if self.latency_tolerance is not None and self.latency > self.latency_tolerance * self.min_latency > 0:
+            self._decrease()
+        else:
+            self._limit = min(self._limit + self.increase / self._limit, float(self.max_limit))
+
+    def on_throttle(self) -> None:
+        """Record a transaction the server throttled, or that timed out."""
+        self._decrease()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < (self.latency or 0):
+            return
+        self._last_decrease = now
+        self._limit = max(self._limit * self.decrease_factor, float(self.min_limit))
+
+
+class AdaptiveSender:
+    """
+    Send messages over as many concurrent connections as an AIMDLimiter allows,
+    so that throughput grows while the server keeps up and backs off as soon as
+    it throttles or slows down.
+
+    Connections are opened on demand, reused between messages and closed at
+    the end of send_messages(). A message the server throttled is retried up to
+    ``max_retries`` times, once the limit has been decreased.
+
+    :param mailman: the Mail object whose backend sends the messages.
+
+    :param limiter: the concurrency limiter, defaults to an AIMDLimiter with
+        its default settings. It can be shared by several senders to the same
+        server.
+
+    :param backend: the backend to send with, defaults to the MAIL_BACKEND of
+        the Mail object.
+
+    :param fail_silently: whether to count failed messages as not sent instead
+        of raising their exception.
+
+    :param max_retries: the number of times a throttled message is retried.
+
+    Other keyword arguments are passed to the backend.
+    """
+
+    def __init__(
+        self,
+        mailman: "Mail",
+        limiter: t.Optional[AIMDLimiter] = None,
+        backend: t.Any = None,
+        fail_silently: bool = False,
+        max_retries: int = 2,
+        **kwargs: t.Any,
+    ):
+        self.mailman = mailman
+        self.limiter = limiter or AIMDLimiter()
+        self.backend = backend
+        self.fail_silently = fail_silently
+        self.max_retries = max_retries
+        self.backend_kwargs = kwargs
+
+    @property
+    def limit(self) -> int:
+        """The current concurrency limit, for monitoring."""
+        return self.limiter.limit
+
+    async def send_messages(
+        self, email_messages: t.Union[t.Iterable["EmailMessage"], t.AsyncIterable["EmailMessage"]]
+    ) -> int:
+        """
+        Send the messages concurrently and return the number of messages sent.
+
+        Unless the sender fails silently, no message is started after one
+        failed, and the exception of the first failure is raised once the
+        messages in flight are done.
+        """
+        idle: t.List["BaseEmailBackend"] = []
+        tasks: t.Set[asyncio.Future] = set()
+        errors: t.List[BaseException] = []
+        num_sent = 0
+
+        def done(task: asyncio.Future) -> None:
+            nonlocal num_sent
+            tasks.discard(task)
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                errors.append(task.exception())
+            else:
+                num_sent += task.result()
+
+        with self.mailman.track_send():
+            try:
+                async for message in aiterate(email_messages):
+                    await self.limiter.acquire()
+                    if errors and not self.fail_silently:
+                        await self.limiter.release()
+                        break
+                    task = asyncio.ensure_future(self._send(message, idle))
+                    tasks.add(task)
+                    task.add_done_callback(done)
+                if tasks:
+                    await asyncio.wait(set(tasks))
+            finally:
+                for task in tasks:
+                    task.cancel()
+                for connection in idle:
+                    await self._close(connection)
+        if errors and not self.fail_silently:
+            raise errors[0]
+        return num_sent
+
+    async def _send(self, message: "EmailMessage", idle: t.List["BaseEmailBackend"]) -> int:
+        """Send a message in a slot acquired by the caller, and release it."""
+        retries = 0
+        acquired = True
+        try:
+            while True:
+                connection = idle.pop() if idle else self._get_connection()
+                try:
+                    await connection.open()
+                    start = time.monotonic()
+                    sent = await connection.send_messages([message])
+                except Exception as exc:
+                    await self._close(connection)
+                    if is_throttling(exc):
+                        self.limiter.on_throttle()
+                        if retries < self.max_retries:
+                            retries += 1
+                            # Wait for a slot under the decreased limit.
+                            acquired = False
+                            await self.limiter.release()
+                            await self.limiter.acquire()
+                            acquired = True
+                            continue
+                    if self.fail_silently:
+                        return 0
+                    raise
+                self.limiter.on_success(time.monotonic() - start)
+                idle.append(connection)
+                return sent
+        finally:
+            if acquired:
+                await self.limiter.release()
+
+    def _get_connection(self) -> "BaseEmailBackend":
+        return self.mailman.get_connection(backend=self.backend, **self.backend_kwargs)
+
+    async def _close(self, connection: "BaseEmailBackend") -> None:
+        try:
+            await connection.close()
+        except Exception:
+            pass
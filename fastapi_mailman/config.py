@@ -17,10 +17,22 @@ class ConnectionConfig(Settings):
     TEMPLATE_FOLDER: t.Optional[DirectoryPath] = None
     MAIL_SSL_KEYFILE: t.Optional[str] = None
     MAIL_SSL_CERTFILE: t.Optional[str] = None
+    MAIL_VALIDATE_CERTS: bool = True
     MAIL_USE_LOCALTIME: bool = False
     MAIL_FILE_PATH: t.Optional[str] = None
     MAIL_TIMEOUT: t.Optional[int] = None
     MAIL_DEFAULT_CHARSET: str = 'utf-8'
+    MAIL_USE_SMTPUTF8: bool = False
+    MAIL_STREAMING: bool = False
+    MAIL_ATTACHMENT_SPOOL_THRESHOLD: t.Optional[int] = None
+    MAIL_KEEP_ALIVE: bool = False
+    MAIL_KEEP_ALIVE_IDLE_TIMEOUT: t.Optional[float] = 60
+    MAIL_KEEP_ALIVE_NOOP_INTERVAL: t.Optional[float] = 15
+    MAIL_RELAYS: t.Optional[t.List[str]] = None
+    MAIL_RELAY_STRATEGY: str = 'round_robin'
+    MAIL_RELAY_RETRY_INTERVAL: float = 30
+    MAIL_SOCKET_PATH: t.Optional[str] = None
+    MAIL_USE_LMTP: bool = False
 
     def template_engine(self) -> Environment:
         """Return template environment."""
@@ -0,0 +1,415 @@
+"""
+Inlining the CSS of HTML alternatives into style attributes.
+"""
+import functools
+import html
+import re
+import typing as t
+
+# An element as far as selectors can tell: its tag, id, classes, and the
+# attributes the stylesheet selects on.
+ElementKey = t.Tuple[str, t.Optional[str], t.FrozenSet[str], t.Tuple[t.Tuple[str, str], ...]]
+Compound = t.Tuple[t.Optional[str], t.Optional[str], t.FrozenSet[str], t.Tuple[t.Tuple[str, t.Optional[str]], ...]]
+Declarations = t.Dict[str, t.Tuple[str, bool]]
+
+VOID_ELEMENTS = frozenset(
+    ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr')
+)
+
+# The open elements whose end tag is optional in HTML that the start tag of an
+# element closes, and the elements they aren't closed across, e.g. <li>
+# closes the open <li> of its list but not the one of an enclosing list.
+_SCOPE = frozenset(('applet', 'button', 'caption', 'html', 'marquee', 'object', 'table', 'td', 'template', 'th'))
+_CLOSES_P = (frozenset(('p',)), _SCOPE)
+_CELL = frozenset(('td', 'th'))
+IMPLIED_END_TAGS: t.Dict[str, t.Tuple[t.FrozenSet[str], t.FrozenSet[str]]] = {
+    'li': (frozenset(('li',)), _SCOPE | {'ol', 'ul'}),
+    'dt': (frozenset(('dd', 'dt')), _SCOPE | {'dl'}),
+    'dd': (frozenset(('dd', 'dt')), _SCOPE | {'dl'}),
+    'td': (_CELL, frozenset(('table', 'tr'))),
+    'th': (_CELL, frozenset(('table', 'tr'))),
+    'tr': (_CELL | {'tr'}, frozenset(('table', 'tbody', 'tfoot', 'thead'))),
+    'tbody': (_CELL | {'tr', 'tbody', 'tfoot', 'thead'}, frozenset(('table',))),
+    'tfoot': (_CELL | {'tr', 'tbody', 'tfoot', 'thead'}, frozenset(('table',))),
+    'thead': (_CELL | {'tr', 'tbody', 'tfoot', 'thead'}, frozenset(('table',))),
+    'option': (frozenset(('option',)), frozenset(('datalist', 'optgroup', 'select'))),
+    'optgroup': (frozenset(('optgroup', 'option')), frozenset(('datalist', 'select'))),
+}
+# Block elements close an open paragraph.
+IMPLIED_END_TAGS.update(
+    (tag, _CLOSES_P)
+    for tag in (
+        'address article aside blockquote details div dl fieldset figcaption figure footer form '
+        'h1 h2 h3 h4 h5 h6 header hr main menu nav ol p pre section table ul'
+    ).split()
+)
+
+_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_COMBINATOR_RE = re.compile(r'\s*([>+~])\s*|\s+')
+_COMPOUND_RE = re.compile(
+    r'(\*|[a-zA-Z][\w-]*)?((?:[#.][\w-]+|\[\s*[\w-]+\s*(?:=\s*(?:"[^"]*"|\'[^\']*\'|[\w-]+)\s*)?\])*)'
+)
+_SIMPLE_RE = re.compile(r'([#.])([\w-]+)|\[\s*([\w-]+)\s*(?:=\s*("[^"]*"|\'[^\']*\'|[\w-]+)\s*)?\]')
+_DECLARATION_RE = re.compile(r'([\w-]+)\s*:\s*((?:[^;"\'(]|"[^"]*"|\'[^\']*\'|\([^)]*\))+)')
+_IMPORTANT_RE = re.compile(r'\s*!\s*important\s*$', re.I)
+_STYLE_ELEMENT_RE = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.S | re.I)
+_TOKEN_RE = re.compile(
+    r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[!?][^>]*>|<(/)?([a-zA-Z][\w:-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.S
+)
+_ATTRIBUTE_RE = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'=<>`]+))?''')
+
+
+def parse_declarations(text: str) -> t.List[t.Tuple[str, str, bool]]:
+    """Parse a declaration block, e.g. a style attribute, into (property, value, important) tuples."""
+    declarations = []
+    for match in _DECLARATION_RE.finditer(text):
+        value = match.group(2).strip()
+        important = _IMPORTANT_RE.search(value)
+        if important:
+            value = value[: important.start()]
+        if value:
+            declarations.append((match.group(1).lower(), value, bool(important)))
+    return declarations
+
+
+def _unquote(value: t.Optional[str]) -> t.Optional[str]:
+    if value and value[0] in '"\'':
+        value = value[1:-1]
+    return value
+
+
+def _parse_compound(text: str) -> t.Optional[Compound]:
+    match = _COMPOUND_RE.fullmatch(text)
+    if match is None or not text:
+        return None
+    tag = match.group(1)
+    id = None
+    classes = []
+    attributes = []
+    for simple in _SIMPLE_RE.finditer(match.group(2)):
+        if simple.group(1) == '#':
+            id = simple.group(2)
+        elif simple.group(1) == '.':
+            classes.append(simple.group(2))
+        else:
+            attributes.append((simple.group(3).lower(), _unquote(simple.group(4))))
+    return (None if tag in (None, '*') else tag.lower(), id, frozenset(classes), tuple(attributes))
+
+
+class Selector:
+    """A selector made of compound selectors joined by descendant or child combinators."""
+
+    __slots__ = ('compounds', 'specificity')
+
+    def __init__(self, compounds: t.List[t.Tuple[Compound, str]]):
+        # (compound, combinator with the compound on its left), left to right.
+        self.compounds = compounds
+        ids = sum(compound[1] is not None for compound, _ in compounds)
+        classes = sum(len(compound[2]) + len(compound[3]) for compound, _ in compounds)
+        tags = sum(compound[0] is not None for compound, _ in compounds)
+        self.specificity = (ids, classes, tags)
+
+    @classmethod
+    def parse(cls, text: str) -> t.Optional["Selector"]:
+        """Parse a selector, or return None if it can't be matched against an element alone (e.g. :hover)."""
+        parts = _COMBINATOR_RE.split(text.strip())
+        compounds = []
+        combinator = ' '
+        for index, part in enumerate(parts):
+            if index % 2:
+                combinator = part or ' '
+                if combinator not in ' >':
+                    return None
+                continue
+            compound = _parse_compound(part)
+            if compound is None:
+                return None
+            compounds.append((compound, combinator))
+        return cls(compounds)
+
+    def matches(self, chain: t.List[ElementKey]) -> bool:
+        """Whether the selector matches the last element of a chain of elements, from the root."""
+        return self._matches(len(self.compounds) - 1, chain, len(chain) - 1)
+
+    def _matches(self, index: int, chain: t.List[ElementKey], position: int) -> bool:
+        compound, combinator = self.compounds[index]
+        if not _matches_compound(compound, chain[position]):
+            return False
+        if index == 0:
+            return True
+        if combinator == '>':
+            return position > 0 and self._matches(index - 1, chain, position - 1)
+        return any(self._matches(index - 1, chain, ancestor) for ancestor in range(position - 1, -1, -1))
+
+
+def _matches_compound(compound: Compound, key: ElementKey) -> bool:
+    tag, id, classes, attributes = compound
+    if tag is not None and tag != key[0]:
+        return False
+    if id is not None and id != key[1]:
+        return False
+    if classes and not classes <= key[2]:
+        return False
+    if attributes:
+        values = dict(key[3])
+        for name, value in attributes:
+            if name not in values or (value is not None and values[name] != value):
+                return False
+    return True
+
+
+class _Node:
+    """An element of the documents inlined with a stylesheet, by its chain of ancestors."""
+
+    __slots__ = ('parent', 'key', 'children', 'declarations', 'style')
+
+    def __init__(self, parent: t.Optional["_Node"], key: t.Optional[ElementKey]):
+        self.parent = parent
+        self.key = key
+        self.children: t.Dict[ElementKey, _Node] = {}
+        self.declarations: Declarations = {}
+        self.style = ''
+
+
+class Stylesheet:
+    """
+    The rules of a stylesheet that can be inlined, sorted by specificity, and
+    the CSS that can't (at-rules such as @media, and selectors with pseudo
+    classes or sibling combinators), which is left in a style element.
+
+    The declarations matching each element are cached by the element's chain
+    of ancestors, so that elements laid out the same way in every message of a
+    template are only matched once.
+    """
+
+    def __init__(self, css: str, max_cache_nodes: int = 10000):
+        self.rules: t.List[t.Tuple[Selector, int, t.List[t.Tuple[str, str, bool]]]] = []
+        leftover = []
+        for order, (prelude, body) in enumerate(_split_rules(_COMMENT_RE.sub('', css))):
+            if prelude.startswith('@'):
+                leftover.append('%s {%s}' % (prelude, body) if body is not None else prelude + ';')
+                continue
+            declarations = parse_declarations(body)
+            for text in prelude.split(','):
+                selector = Selector.parse(text)
+                if selector is None:
+                    leftover.append('%s {%s}' % (text.strip(), body))
+                elif declarations:
+                    self.rules.append((selector, order, declarations))
+        self.rules.sort(key=lambda rule: (rule[0].specificity, rule[1]))
+        self.leftover = '\n'.join(leftover)
+        self.attributes = frozenset(
+            name for selector, _, _ in self.rules for compound, _ in selector.compounds for name, _ in compound[3]
+        )
+        self.max_cache_nodes = max_cache_nodes
+        self.clear()
+
+    def clear(self) -> None:
+        self.root = _Node(None, None)
+        self._nodes = 0
+
+    def child(self, parent: _Node, key: ElementKey) -> _Node:
+        """Return the node of an element of the given parent, matching it if it's new."""
+        node = parent.children.get(key)
+        if node is not None:
+            return node
+        if self._nodes >= self.max_cache_nodes:
+            # Varying ids or attributes can make the cache grow without bound.
+            return self._match(_Node(parent, key))
+        self._nodes += 1
+        node = parent.children[key] = self._match(_Node(parent, key))
+        return node
+
+    def _match(self, node: _Node) -> _Node:
+        chain = []
+        ancestor = node
+        while ancestor.key is not None:
+            chain.append(ancestor.key)
+            ancestor = ancestor.parent
+        chain.reverse()
+        declarations: Declarations = {}
+        for selector, _, rule_declarations in self.rules:
+            if selector.matches(chain):
+                _merge(declarations, rule_declarations)
+        node.declarations = declarations
+        # Escaped, ready to be written in a style attribute.
+        node.style = html.escape(_format(declarations))
+        return node
+
+
+def _split_rules(css: str) -> t.List[t.Tuple[str, t.Optional[str]]]:
+    """Split a stylesheet into (prelude, block) pairs, with None as the block of statements like @import."""
+    rules: t.List[t.Tuple[str, t.Optional[str]]] = []
+    position = 0
+    while True:
+        start = css.find('{', position)
+        if start == -1:
+            break
+        prelude = css[position:start]
+        *statements, prelude = prelude.split(';')
+        rules.extend((statement.strip(), None) for statement in statements if statement.strip())
+        depth = 1
+        end = start + 1
+        while end < len(css) and depth:
+            if css[end] == '{':
+                depth += 1
+            elif css[end] == '}':
+                depth -= 1
+            end += 1
+        rules.append((prelude.strip(), css[start + 1 : end - 1]))
+        position = end
+    return rules
+
+
+def _merge(declarations: Declarations, other: t.Iterable[t.Tuple[str, str, bool]]) -> None:
+    """Apply declarations of a higher precedence, except over important ones."""
+    for name, value, important in other:
+        current = declarations.get(name)
+        if current is None or important or not current[1]:
+            declarations[name] = (value, important)
+
+
+def _format(declarations: Declarations) -> str:
+    return '; '.join('%s: %s' % (name, value) for name, (value, _) in declarations.items())
+
+
+@functools.lru_cache(maxsize=64)
+def parse_stylesheet(css: str) -> Stylesheet:
+    """Return the Stylesheet of the given CSS, cached with its matches."""
+    return Stylesheet(css)
+
+
+class CSSInliner:
+    """
+    Inline the rules of the style elements of HTML documents, and of
+    ``stylesheets``, into the style attributes of the elements they match, as
+    most email clients ignore style elements.
+
+    Stylesheets are parsed once and kept with the declarations matched by
+    each element, keyed by the tag, id, classes and ancestors of the element,
+    so that for documents rendered from the same template only the variable
+    content is processed, not the CSS.
+
+    Selectors are made of type, class, id and attribute selectors, joined by
+    descendant or child combinators. The other rules (e.g. :hover, or @media
+    queries) are left in a style element, unless there are none.
+
+    :param stylesheets: CSS applied to every document, before the rules of its
+        own style elements.
+
+    :param keep_style_tags: whether to leave the style elements of documents
+        as they are, rather than to only keep the rules that weren't inlined.
+    """
+
+    def __init__(self, stylesheets: t.Iterable[str] = (), keep_style_tags: bool = False):
+        self.stylesheets = '\n'.join(stylesheets)
+        self.keep_style_tags = keep_style_tags
+
+    def inline(self, document: str) -> str:
+        """Return the document with its CSS inlined."""
+        style_elements = list(_STYLE_ELEMENT_RE.finditer(document))
+        css = [self.stylesheets]
+        css.extend(match.group(1) for match in style_elements)
+        stylesheet = parse_stylesheet('\n'.join(css))
+        if style_elements and not self.keep_style_tags:
+            document = self._replace_style_elements(document, style_elements, stylesheet.leftover)
+        if not stylesheet.rules:
+            return document
+        return self._inline(document, stylesheet)
+
+    def _replace_style_elements(self, document: str, style_elements: t.List[t.Match], leftover: str) -> str:
+        """Replace the style elements with the rules left, in place of the first one."""
+        output = [document[: style_elements[0].start()]]
+        if leftover:
+            output.append('<style type="text/css">%s</style>' % leftover)
+        for match, next_match in zip(style_elements, style_elements[1:]):
+            output.append(document[match.end() : next_match.start()])
+        output.append(document[style_elements[-1].end() :])
+        return ''.join(output)
+
+    def _inline(self, document: str, stylesheet: Stylesheet) -> str:
+        output = []
+        stack: t.List[t.Tuple[str, _Node]] = [('', stylesheet.root)]
+        # The end of the output so far, and of the tokens read.
+        position = search = 0
+        while True:
+            match = _TOKEN_RE.search(document, search)
+            if match is None:
+                break
+            search = match.end()
+            closing, tag, attributes = match.groups()
+            if tag is None:
+                continue
+            tag = tag.lower()
+            if closing:
+                for index in range(len(stack) - 1, 0, -1):
+                    if stack[index][0] == tag:
+                        del stack[index:]
+                        break
+                continue
+            if tag in IMPLIED_END_TAGS:
+                _close_implied_elements(stack, *IMPLIED_END_TAGS[tag])
+            output.append(document[position : match.start()])
+            position = match.end()
+            node, inlined = self._inline_element(stylesheet, stack[-1][1], tag, attributes)
+            output.append(match.group() if inlined is None else '<%s%s>' % (match.group(2), inlined))
+            if tag in ('script', 'style'):
+                end = re.compile(r'</%s\b' % tag, re.I).search(document, position)
+                end = len(document) if end is None else end.start()
+                output.append(document[position:end])
+                position = search = end
+            elif tag not in VOID_ELEMENTS and not attributes.rstrip().endswith('/'):
+                stack.append((tag, node))
+        output.append(document[position:])
+        return ''.join(output)
+
+    def _inline_element(
+        self, stylesheet: Stylesheet, parent: _Node, tag: str, attributes: str
+    ) -> t.Tuple[_Node, t.Optional[str]]:
+        """Return the node of an element, and its attributes with the style inlined, or None if unchanged."""
+        id = None
+        classes: t.FrozenSet[str] = frozenset()
+        selected = []
+        style = None
+        for attribute in _ATTRIBUTE_RE.finditer(attributes):
+            name = attribute.group(1).lower()
+            if name == 'style':
+                style = attribute
+            elif name == 'class':
+                classes = frozenset(html.unescape(_unquote(attribute.group(2)) or '').split())
+            elif name == 'id':
+                id = html.unescape(_unquote(attribute.group(2)) or '')
+            if name in stylesheet.attributes:
+                selected.append((name, html.unescape(_unquote(attribute.group(2)) or '')))
+        node = stylesheet.child(parent, (tag, id, classes, tuple(sorted(selected))))
+        if style is None:
+            if not node.style:
+                return node, None
+            end = len(attributes.rstrip())
+            if attributes[:end].endswith('/'):
+                end -= 1
+            attributes = '%s style="%s"%s' % (attributes[:end].rstrip(), node.style, attributes[end:])
+        else:
+            declarations = dict(node.declarations)
+            # The element's own declarations win over the non-important ones
+            # of the stylesheet.
+            _merge(declarations, parse_declarations(html.unescape(_unquote(style.group(2)) or '')))
+            attributes = '%sstyle="%s"%s' % (
+                attributes[: style.start()],
+                html.escape(_format(declarations)),
+                attributes[style.end() :],
+            )
+        return node, attributes
+
+
+def _close_implied_elements(stack: t.List[t.Tuple[str, _Node]], closed: t.FrozenSet[str], scope: t.FrozenSet[str]):
+    """Pop the open elements closed by the start tag of an element, see IMPLIED_END_TAGS."""
+    end = None
+    for index in range(len(stack) - 1, 0, -1):
+        tag = stack[index][0]
+        if tag in closed:
+            end = index
+        elif tag in scope:
+            break
+    if end is not None:
+        del stack[end:]
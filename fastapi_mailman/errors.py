@@ -1,3 +1,6 @@
+import aiosmtplib
+
+
 class ConnectionErrors(Exception):
     def __init__(self, expression):
         self.expression = expression
@@ -16,3 +19,15 @@ class PydanticClassRequired(Exception):
 class TemplateFolderDoesNotExist(Exception):
     def __init__(self, expression):
         self.expression = expression
+
+
+class MessageTooLarge(aiosmtplib.SMTPResponseException):
+    """
+    The message is larger than the limit the SMTP server advertised with the
+    SIZE extension, so it wasn't sent.
+    """
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        super().__init__(552, 'Message size of %d bytes exceeds the server limit of %d bytes' % (size, limit))
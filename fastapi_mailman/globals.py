@@ -5,4 +5,31 @@ if t.TYPE_CHECKING:
 
     Mailman = t.TypeVar("Mailman", bound=Mail)
 
+DEFAULT_MAILMAN_NAME = 'default'
+
 MAILMAN: t.Optional["Mailman"] = None
+
+# Every Mail object created in the process, keyed by its name.
+MAILMEN: t.Dict[str, "Mailman"] = {}
+
+
+def get_mailman(mailman: t.Union["Mailman", str, None] = None) -> "Mailman":
+    """
+    Resolve a Mail object.
+
+    :param mailman:
+        a Mail instance (returned as is), the name a Mail object was registered
+        under, or None for the default Mail object.
+    """
+    if mailman is None:
+        if MAILMAN is None:
+            raise NotImplementedError("Default Mail object isn't created yet.")
+        return MAILMAN
+
+    if isinstance(mailman, str):
+        try:
+            return MAILMEN[mailman]
+        except KeyError:
+            raise RuntimeError(f"No Mail object is registered under the name {mailman!r}.")
+
+    return mailman
@@ -0,0 +1,59 @@
+"""
+FastAPI lifespan integration.
+"""
+import typing as t
+
+from fastapi_mailman import globals
+
+if t.TYPE_CHECKING:
+    from . import Mail
+
+
+class MailLifespan:
+    """
+    An async context manager that starts Mail objects up when the application
+    starts and drains them when it shuts down.
+
+    When no Mail object is given, every registered Mail object is managed. An
+    instance can be passed as the ``lifespan`` of a FastAPI application::
+
+        app = FastAPI(lifespan=MailLifespan(warm_connections=2))
+
+    With FastAPI versions predating lifespan support, register the startup()
+    and shutdown() coroutines as event handlers instead.
+
+    :param mailmen: the Mail objects to manage.
+
+    :param warm_connections: the number of connections to open ahead of time
+        for each Mail object.
+
+    :param drain_timeout: how many seconds the shutdown waits for outstanding
+        sends of each Mail object before closing its connections.
+    """
+
+    def __init__(self, *mailmen: "Mail", warm_connections: int = 1, drain_timeout: t.Optional[float] = 10.0):
+        self.mailmen = mailmen
+        self.warm_connections = warm_connections
+        self.drain_timeout = drain_timeout
+        self.app = None
+
+    def __call__(self, app: t.Any) -> "MailLifespan":
+        self.app = app
+        return self
+
+    def get_mailmen(self) -> t.List["Mail"]:
+        return list(self.mailmen or globals.MAILMEN.values())
+
+    async def startup(self) -> None:
+        for mailman in self.get_mailmen():
+            await mailman.startup(warm_connections=self.warm_connections)
+
+    async def shutdown(self) -> None:
+        for mailman in self.get_mailmen():
+            await mailman.shutdown(timeout=self.drain_timeout)
+
+    async def __aenter__(self) -> None:
+        await self.startup()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.shutdown()
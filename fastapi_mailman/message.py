@@ -1,7 +1,16 @@
+import asyncio
+import functools
+import hashlib
+import math
 import mimetypes
+import os
+import random
+import re
+import shutil
+import sys
 import typing as t
+from base64 import encodebytes
 from email import charset as Charset
-from email import encoders as Encoders
 from email import generator, message_from_string
 from email.errors import HeaderParseError
 from email.header import Header
@@ -11,13 +20,19 @@ from email.mime.base import MIMEBase
 from email.mime.message import MIMEMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import formataddr, formatdate, getaddresses, make_msgid
+from email.parser import BytesParser
+from email.policy import Compat32, compat32
+from email.utils import formataddr, formatdate, getaddresses, make_msgid, quote
 from io import BytesIO, StringIO
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 
 from pydantic.networks import EmailStr
 
 from fastapi_mailman import globals
+from fastapi_mailman.addresses import SanitizedAddress
+from fastapi_mailman.profiling import profile_step
+from fastapi_mailman.tracing import start_span
 from fastapi_mailman.utils import DNS_NAME, force_str, punycode
 
 if t.TYPE_CHECKING:
@@ -37,11 +52,57 @@ DEFAULT_ATTACHMENT_MIME_TYPE = 'application/octet-stream'
 
 RFC5322_EMAIL_LINE_LENGTH_LIMIT = 998
 
+# Size of the chunks of base64 encoded attachments generated by MessageStream.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def guess_mimetype(filename):
+    """
+    Guess the mimetype of an attachment from its filename, defaulting to
+    DEFAULT_ATTACHMENT_MIME_TYPE.
+    """
+    # The guess only depends on the extensions, cache it by extensions.
+    _, dot, extensions = os.path.basename(filename).partition('.')
+    return _guess_mimetype(dot + extensions)
+
+
+@functools.lru_cache(maxsize=256)
+def _guess_mimetype(extensions):
+    return mimetypes.guess_type('attachment' + extensions)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+
+
+@functools.lru_cache(maxsize=16)
+def _encode_inline_image(content):
+    """
+    Return the SHA-256 and the base64 encoding of the content of an inline
+    image. Cached by content, so that an image embedded in many messages
+    (e.g. a logo) is hashed and encoded once.
+    """
+    return hashlib.sha256(content).hexdigest(), encodebytes(content).decode('ascii')
+
 
 class BadHeaderError(ValueError):
     pass
 
 
+class SMTPUTF8Policy(Compat32):
+    """
+    The compat32 policy, except that non-ASCII header values are written as
+    UTF-8 instead of being RFC 2047 encoded, for servers supporting SMTPUTF8.
+    """
+
+    def fold_binary(self, name, value):
+        if isinstance(value, str):
+            try:
+                value.encode('ascii')
+            except UnicodeEncodeError:
+                return (name + ': ' + value + self.linesep).encode('utf-8')
+        return super().fold_binary(name, value)
+
+
+smtputf8_policy = SMTPUTF8Policy()
+
+
 # Header names that contain structured address data (RFC #5322)
 ADDRESS_HEADERS = {
     'from',
@@ -58,13 +119,16 @@ ADDRESS_HEADERS = {
 }
 
 
-def forbid_multi_line_headers(name, val, encoding):
+def forbid_multi_line_headers(name, val, encoding, smtputf8=False):
 
     """Forbid multi-line headers to prevent header injection."""
     encoding = encoding
     val = str(val)  # val may be lazy
     if '\n' in val or '\r' in val:
         raise BadHeaderError("Header values can't contain newlines (got %r for header %r)" % (val, name))
+    if smtputf8:
+        # SMTPUTF8 (RFC 6532) allows UTF-8 in header values as is.
+        return name, val
     try:
         val.encode('ascii')
     except UnicodeEncodeError:
@@ -78,10 +142,23 @@ def forbid_multi_line_headers(name, val, encoding):
     return name, val
 
 
-def sanitize_address(addr, encoding):
+def sanitize_address(addr, encoding, smtputf8=False):
     """
     Format a pair of (name, address) or an email address string.
+
+    With smtputf8, non-ASCII names and addresses are kept as is instead of
+    being encoded. The addresses validated by validate_recipients() aren't
+    parsed again, and are formatted once per encoding.
     """
+    if isinstance(addr, SanitizedAddress):
+        key = (encoding, smtputf8)
+        try:
+            return addr._sanitized[key]
+        except KeyError:
+            sanitized = addr._sanitized[key] = _format_address(
+                addr.display_name, addr.local_part, addr.domain, encoding, smtputf8
+            )
+            return sanitized
     address = None
     if not isinstance(addr, tuple):
         addr = force_str(addr)
@@ -103,6 +180,19 @@ def sanitize_address(addr, encoding):
     address_parts = nm + localpart + domain
     if '\n' in address_parts or '\r' in address_parts:
         raise ValueError('Invalid address; address parts cannot contain newlines.')
+    return _format_address(nm, localpart, domain, encoding, smtputf8)
+
+
+def _format_address(nm, localpart, domain, encoding, smtputf8):
+    if smtputf8:
+        addr_spec = Address(username=localpart, domain=domain).addr_spec
+        if not nm:
+            return addr_spec
+        try:
+            (nm + addr_spec).encode('ascii')
+        except UnicodeEncodeError:
+            return '"%s" <%s>' % (quote(nm), addr_spec)
+        return formataddr((nm, addr_spec))
 
     # Avoid UTF-8 encode, if it's possible.
     try:
@@ -121,6 +211,9 @@ def sanitize_address(addr, encoding):
 
 
 class MIMEMixin:
+    # Whether headers are written as UTF-8, for servers supporting SMTPUTF8.
+    smtputf8 = False
+
     def as_string(self, unixfrom=False, linesep='\n'):
         """Return the entire formatted message as a string.
         Optional `unixfrom' when True, means include the Unix From_ envelope
@@ -143,10 +236,17 @@ class MIMEMixin:
         lines that begin with 'From '. See bug #13433 for details.
         """
         fp = BytesIO()
-        g = generator.BytesGenerator(fp, mangle_from_=False)
+        g = generator.BytesGenerator(fp, mangle_from_=False, policy=smtputf8_policy if self.smtputf8 else None)
         g.flatten(self, unixfrom=unixfrom, linesep=linesep)
         return fp.getvalue()
 
+    def as_stream(self, linesep='\n', chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Return the entire formatted message as a MessageStream, generating the
+        same bytes as as_bytes() chunk by chunk.
+        """
+        return MessageStream(self, linesep, chunk_size)
+
 
 class SafeMIMEMessage(MIMEMixin, MIMEMessage):
     def __setitem__(self, name, val):
@@ -161,34 +261,311 @@ class SafeMIMEText(MIMEMixin, MIMEText):
         MIMEText.__init__(self, _text, _subtype=_subtype, _charset=_charset)
 
     def __setitem__(self, name, val):
-        name, val = forbid_multi_line_headers(name, val, self.encoding)
+        name, val = forbid_multi_line_headers(name, val, self.encoding, self.smtputf8)
         MIMEText.__setitem__(self, name, val)
 
     def set_payload(self, payload, charset=None):
         if charset == 'utf-8' and not isinstance(charset, Charset.Charset):
-            has_long_lines = any(len(line.encode()) > RFC5322_EMAIL_LINE_LENGTH_LIMIT for line in payload.splitlines())
+            has_long_lines = any(_is_long_line(line) for line in payload.splitlines())
             # Quoted-Printable encoding has the side effect of shortening long
             # lines, if any (#22561).
             charset = utf8_charset_qp if has_long_lines else utf8_charset
         MIMEText.set_payload(self, payload, charset=charset)
 
 
+def _is_long_line(line):
+    """Whether the UTF-8 encoded line exceeds the RFC 5322 line length limit."""
+    length = len(line)
+    if length > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+        return True
+    # A character takes at most 4 bytes in UTF-8, so only encode the lines
+    # that could actually be too long.
+    return length * 4 > RFC5322_EMAIL_LINE_LENGTH_LIMIT and len(line.encode()) > RFC5322_EMAIL_LINE_LENGTH_LIMIT
+
+
 class SafeMIMEMultipart(MIMEMixin, MIMEMultipart):
     def __init__(self, _subtype='mixed', boundary=None, _subparts=None, encoding=None, **_params):
         self.encoding = encoding
         MIMEMultipart.__init__(self, _subtype, boundary, _subparts, **_params)
 
     def __setitem__(self, name, val):
-        name, val = forbid_multi_line_headers(name, val, self.encoding)
+        name, val = forbid_multi_line_headers(name, val, self.encoding, self.smtputf8)
         MIMEMultipart.__setitem__(self, name, val)
 
 
+class SafeMIMEAttachment(MIMEMixin, MIMEBase):
+    """
+    A base64 encoded attachment. Its content is only encoded when the message
+    is serialized, chunk by chunk when the message is streamed.
+
+    The content is either bytes or a binary file object (e.g. one spooled by
+    EmailMessage.attach()), which is read when the message is serialized.
+    """
+
+    def __init__(self, content, _maintype, _subtype, **_params):
+        MIMEBase.__init__(self, _maintype, _subtype, **_params)
+        self['Content-Transfer-Encoding'] = 'base64'
+        if isinstance(content, str):
+            # Like Message.get_payload(decode=True) does.
+            try:
+                content = content.encode('ascii', 'surrogateescape')
+            except UnicodeError:
+                content = content.encode('raw-unicode-escape')
+        self.content = content
+
+    @property
+    def content(self):
+        return self.__dict__['_content']
+
+    @content.setter
+    def content(self, value):
+        self.__dict__['_content'] = value
+        self.__dict__.pop('_encoded_payload', None)
+
+    # The generators of the email package read the encoded payload from
+    # _payload, so encode it on first access instead of up front, and only
+    # again once the content changes.
+    @property
+    def _payload(self):
+        payload = self.__dict__.get('_encoded_payload')
+        if payload is None and self.content is not None:
+            payload = self.__dict__['_encoded_payload'] = encodebytes(self.read_content()).decode('ascii')
+        return payload
+
+    @_payload.setter
+    def _payload(self, value):
+        self.content = None
+        self.__dict__['_encoded_payload'] = value
+
+    def is_multipart(self):
+        # Without encoding the content, as Message.is_multipart() does.
+        return False
+
+    def content_size(self):
+        """Return the size of the content, in bytes."""
+        if isinstance(self.content, (bytes, bytearray)):
+            return len(self.content)
+        self.content.seek(0, os.SEEK_END)
+        return self.content.tell()
+
+    def read_content(self, start=0, size=-1):
+        """Return size bytes of the content from start, up to the end by default."""
+        if isinstance(self.content, (bytes, bytearray)):
+            return memoryview(self.content)[start:] if size < 0 else memoryview(self.content)[start : start + size]
+        # Seek every time, in case the message is serialized concurrently.
+        self.content.seek(start)
+        return self.content.read(size)
+
+    def encoded_size(self, linesep='\n'):
+        """Return the size of the encoded content, in bytes."""
+        if self.content is None:
+            return len(_encode_lines(self._payload or '', linesep.encode('ascii')))
+        lines, rest = divmod(self.content_size(), 57)
+        size = lines * (76 + len(linesep))
+        if rest:
+            size += 4 * math.ceil(rest / 3) + len(linesep)
+        return size
+
+    def iter_encoded(self, linesep='\n', chunk_size=STREAM_CHUNK_SIZE):
+        """Generate the encoded content in chunks of about chunk_size bytes."""
+        linesep = linesep.encode('ascii')
+        if self.content is None:
+            yield _encode_lines(self._payload or '', linesep)
+            return
+        # Encode whole lines of 57 bytes (76 characters) at a time.
+        step = max(chunk_size // 76, 1) * 57
+        for start in range(0, self.content_size(), step):
+            chunk = encodebytes(self.read_content(start, step))
+            yield chunk if linesep == b'\n' else chunk.replace(b'\n', linesep)
+
+
+class MessageStream:
+    """
+    A formatted message, generated in chunks of bytes as it is iterated over:
+    the headers and text parts are formatted up front, the attachments are
+    base64 encoded as they are reached, so that the fully formatted message is
+    never held in memory. len() returns the size of the message in bytes.
+    """
+
+    def __init__(self, msg, linesep='\n', chunk_size=STREAM_CHUNK_SIZE):
+        self.linesep = linesep
+        self.chunk_size = chunk_size
+        policy = smtputf8_policy if getattr(msg, 'smtputf8', False) else compat32
+        self.segments = list(_message_segments(msg, policy.clone(linesep=linesep)))
+
+    def __len__(self):
+        return sum(
+            len(segment) if isinstance(segment, bytes) else segment.encoded_size(self.linesep)
+            for segment in self.segments
+        )
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from segment.iter_encoded(self.linesep, self.chunk_size)
+
+
+_NLCRE_BYTES = re.compile(generator.NLCRE.pattern.encode('ascii'))
+
+
+def _encode_lines(text, linesep):
+    """Convert the line endings of text, as the email generators do."""
+    data = text.encode('ascii', 'surrogateescape')
+    if '\r' not in text:
+        # E.g. base64, whose lines all end with \n.
+        return data.replace(b'\n', linesep)
+    return _NLCRE_BYTES.sub(linesep, data)
+
+
+def _message_segments(msg, policy):
+    """
+    Yield the formatted bytes of msg, except for the content of attachments,
+    for which the SafeMIMEAttachment is yielded instead. The output matches
+    the one of BytesGenerator.
+    """
+    is_multipart = msg.get_content_maintype() == 'multipart'
+    if not is_multipart and not isinstance(msg, SafeMIMEAttachment):
+        fp = BytesIO()
+        generator.BytesGenerator(fp, mangle_from_=False, policy=policy).flatten(msg)
+        yield fp.getvalue()
+        return
+    linesep = policy.linesep.encode('ascii')
+    if is_multipart and not msg.get_boundary():
+        # The boundary is part of the headers, so set it before writing them.
+        msg.set_boundary('=' * 15 + '%019d' % random.randrange(sys.maxsize) + '==')
+    yield b''.join(policy.fold_binary(name, value) for name, value in msg.raw_items()) + linesep
+    if not is_multipart:
+        yield msg
+        return
+    boundary = msg.get_boundary().encode('ascii')
+    if msg.preamble is not None:
+        yield _encode_lines(msg.preamble, linesep) + linesep
+    yield b'--' + boundary + linesep
+    for i, part in enumerate(msg.get_payload()):
+        if i:
+            yield linesep + b'--' + boundary + linesep
+        yield from _message_segments(part, policy)
+    yield linesep + b'--' + boundary + b'--' + linesep
+    if msg.epilogue is not None:
+        yield _encode_lines(msg.epilogue, linesep)
+
+
+class MessageSpec:
+    """
+    An immutable and picklable description of an email message, for holding
+    many queued messages in memory or passing them to other processes.
+
+    Compared with an EmailMessage, it has no per-instance dict, stores its
+    sequences as tuples and references neither a Mail object nor a connection.
+    Attachments are (filename, content, mimetype) triples or MIMEBase
+    instances, as in EmailMessage.attachments. Spooled attachments stay on
+    disk and are only read when the spec is pickled. Inline images are
+    (cid, filename, content, mimetype) tuples, as in
+    EmailMultiAlternatives.inline_images.
+    """
+
+    __slots__ = (
+        'subject',
+        'body',
+        'from_email',
+        'to',
+        'cc',
+        'bcc',
+        'reply_to',
+        'headers',
+        'attachments',
+        'alternatives',
+        'content_subtype',
+        'mixed_subtype',
+        'alternative_subtype',
+        'encoding',
+        'inline_images',
+    )
+
+    def __init__(
+        self,
+        subject='',
+        body='',
+        from_email=None,
+        to=(),
+        cc=(),
+        bcc=(),
+        reply_to=(),
+        headers=(),
+        attachments=(),
+        alternatives=(),
+        content_subtype='plain',
+        mixed_subtype='mixed',
+        alternative_subtype='alternative',
+        encoding=None,
+        inline_images=(),
+    ):
+        if isinstance(headers, dict):
+            headers = headers.items()
+        values = (
+            subject,
+            body,
+            from_email,
+            tuple(to),
+            tuple(cc),
+            tuple(bcc),
+            tuple(reply_to),
+            tuple((name, value) for name, value in headers),
+            tuple(attachment if isinstance(attachment, MIMEBase) else tuple(attachment) for attachment in attachments),
+            tuple(tuple(alternative) for alternative in alternatives),
+            content_subtype,
+            mixed_subtype,
+            alternative_subtype,
+            encoding,
+            tuple(tuple(image) for image in inline_images),
+        )
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MessageSpec objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MessageSpec objects are immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, MessageSpec):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return '<MessageSpec subject=%r to=%r>' % (self.subject, self.to)
+
+    def __reduce__(self):
+        values = [getattr(self, name) for name in self.__slots__]
+        values[self.__slots__.index('attachments')] = unspool_attachments(self.attachments)
+        return MessageSpec, tuple(values)
+
+
+def unspool_attachments(attachments):
+    """
+    Return a list of attachments where the content of spooled ones, which are
+    temporary files without a name, is read in memory.
+    """
+    unspooled = []
+    for attachment in attachments:
+        if isinstance(attachment, tuple) and hasattr(attachment[1], 'read'):
+            filename, content, mimetype = attachment
+            content.seek(0)
+            attachment = (filename, content.read(), mimetype)
+        unspooled.append(attachment)
+    return unspooled
+
+
 class EmailMessage:
     """A container for email information."""
 
     content_subtype = 'plain'
     mixed_subtype = 'mixed'
     encoding = None  # None => use settings default
+    priority = None  # None => the default lane of the priority scheduler
 
     def __init__(
         self,
@@ -202,16 +579,13 @@ class EmailMessage:
         attachments: t.Tuple[MIMEBase] = None,
         headers: t.Optional[t.Dict[str, t.Any]] = None,
         connection: t.Type["BaseEmailBackend"] = None,
-        mailman: t.Optional["Mailman"] = None,
+        mailman: t.Union["Mailman", str, None] = None,
     ):
         """
         Initialize a single email message (which can be sent to multiple
         recipients).
         """
-        self.mailman = mailman or globals.MAILMAN
-
-        if self.mailman is None:
-            raise NotImplementedError("Default Mail object isn't created yet.")
+        self.mailman = globals.get_mailman(mailman)
 
         if to:
             if not isinstance(to, (list, tuple)) is True:
@@ -250,6 +624,66 @@ class EmailMessage:
         self.extra_headers = headers or {}
         self.connection = connection
 
+    @classmethod
+    def from_spec(
+        cls,
+        spec: MessageSpec,
+        connection: t.Type["BaseEmailBackend"] = None,
+        mailman: t.Union["Mailman", str, None] = None,
+    ):
+        """
+        Build a message from a MessageSpec. Only EmailMultiAlternatives can be
+        built from a spec with alternatives or inline images.
+        """
+        if (spec.alternatives or spec.inline_images) and not hasattr(cls, 'attach_alternative'):
+            raise ValueError(
+                'A MessageSpec with alternatives or inline images requires EmailMultiAlternatives.from_spec().'
+            )
+        message = cls(
+            spec.subject,
+            spec.body,
+            spec.from_email,
+            spec.to,
+            spec.cc,
+            spec.bcc,
+            spec.reply_to,
+            headers=dict(spec.headers),
+            connection=connection,
+            mailman=mailman,
+        )
+        # The attachments were already processed by attach().
+        message.attachments = list(spec.attachments)
+        if spec.alternatives:
+            message.alternatives = list(spec.alternatives)
+        if spec.inline_images:
+            message.inline_images = list(spec.inline_images)
+        message.content_subtype = spec.content_subtype
+        message.mixed_subtype = spec.mixed_subtype
+        if hasattr(cls, 'alternative_subtype'):
+            message.alternative_subtype = spec.alternative_subtype
+        message.encoding = spec.encoding
+        return message
+
+    def to_spec(self) -> MessageSpec:
+        """Return the MessageSpec describing this message."""
+        return MessageSpec(
+            self.subject,
+            self.body,
+            self.from_email,
+            self.to,
+            self.cc,
+            self.bcc,
+            self.reply_to,
+            self.extra_headers,
+            self.attachments,
+            getattr(self, 'alternatives', ()),
+            self.content_subtype,
+            self.mixed_subtype,
+            getattr(self, 'alternative_subtype', 'alternative'),
+            self.encoding,
+            getattr(self, 'inline_images', ()),
+        )
+
     def get_connection(self, fail_silently=False) -> "BaseEmailBackend":
         if not self.connection:
             try:
@@ -258,10 +692,21 @@ class EmailMessage:
                 raise RuntimeError("The current application was not configured with Fastapi-Mailman")
         return self.connection
 
-    def message(self):
+    def message(self, smtputf8=False):
+        """
+        Build the MIME message. With smtputf8, non-ASCII headers are written as
+        UTF-8 instead of being encoded, which requires a server supporting the
+        SMTPUTF8 extension.
+        """
+        with start_span(self.mailman, 'mail.message', **{'mail.attachments': len(self.attachments)}):
+            with profile_step('message'):
+                return self._build_message(smtputf8)
+
+    def _build_message(self, smtputf8):
         encoding = self.encoding or self.mailman.default_charset
         msg = SafeMIMEText(self.body, self.content_subtype, encoding)
         msg = self._create_message(msg)
+        msg.smtputf8 = smtputf8
         msg['Subject'] = self.subject
         msg['From'] = self.extra_headers.get('From', self.from_email)
         self._set_list_header_if_not_empty(msg, 'To', self.to)
@@ -293,13 +738,25 @@ class EmailMessage:
         return [email for email in (self.to + self.cc + self.bcc) if email]
 
     async def send(self, fail_silently: bool = False):
-        """Send the email message."""
+        """
+        Send the email message. Without a connection of its own, the message is
+        sent in its priority lane if priority lanes are enabled.
+        """
         if not self.recipients():
             # Don't bother creating the network connection if there's nobody to
             # send to.
             return 0
-        async with self.get_connection(fail_silently) as conn:
-            return await conn.send_messages([self])
+        with start_span(self.mailman, 'mail.send', **{'mail.recipients': len(self.recipients())}):
+            if self.connection is None and getattr(self.mailman, 'scheduler', None) is not None:
+                try:
+                    return await self.mailman.scheduler.submit(self)
+                except Exception:
+                    if not fail_silently:
+                        raise
+                    return 0
+            with self.mailman.track_send():
+                async with self.get_connection(fail_silently) as conn:
+                    return await conn.send_messages([self])
 
     def attach(self, filename=None, content=None, mimetype=None):
         """
@@ -320,7 +777,7 @@ class EmailMessage:
         elif content is None:
             raise ValueError('content must be provided.')
         else:
-            mimetype = mimetype or mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+            mimetype = mimetype or guess_mimetype(filename)
             basetype, subtype = mimetype.split('/', 1)
 
             if basetype == 'text':
@@ -332,6 +789,11 @@ class EmailMessage:
                         # actually binary, read() raises a UnicodeDecodeError.
                         mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
 
+            if self._spools(content, mimetype, len(content) if isinstance(content, bytes) else 0):
+                spooled = SpooledTemporaryFile(max_size=self.mailman.attachment_spool_threshold)
+                spooled.write(content)
+                content = spooled
+
             self.attachments.append((filename, content, mimetype))
 
     def attach_file(self, path, mimetype=None):
@@ -345,16 +807,62 @@ class EmailMessage:
         as UTF-8. If that fails, set the mimetype to
         DEFAULT_ATTACHMENT_MIME_TYPE and don't decode the content.
         """
+        self.attach(*self._read_file(path, mimetype))
+
+    async def aattach_file(self, path, mimetype=None, executor=None):
+        """
+        Like attach_file(), but read the file in ``executor`` (the loop's
+        default executor if None), without blocking the event loop.
+        """
+        await self.aattach_files([path], mimetype, executor)
+
+    async def aattach_files(self, paths, mimetype=None, executor=None):
+        """
+        Attach several files from the filesystem, read in parallel in
+        ``executor`` (the loop's default executor if None). The attachments
+        are added in the order of ``paths``, once all the files are read.
+        """
+        loop = asyncio.get_event_loop()
+        files = await asyncio.gather(
+            *(loop.run_in_executor(executor, self._read_file, path, mimetype) for path in paths)
+        )
+        for file in files:
+            self.attach(*file)
+
+    def _read_file(self, path, mimetype=None):
+        """
+        Read a file to attach and return the arguments of attach(). Files
+        spooled to a temporary file are copied without reading them all in
+        memory.
+        """
         path = Path(path)
         with path.open('rb') as file:
-            content = file.read()
-            self.attach(path.name, content, mimetype)
+            guessed_mimetype = mimetype or guess_mimetype(path.name)
+            if self._spools(file, guessed_mimetype, os.fstat(file.fileno()).st_size):
+                spooled = SpooledTemporaryFile(max_size=self.mailman.attachment_spool_threshold)
+                shutil.copyfileobj(file, spooled)
+                return path.name, spooled, guessed_mimetype
+            return path.name, file.read(), mimetype
+
+    def _spools(self, content, mimetype, size):
+        """
+        Whether to move the content of an attachment to a temporary file:
+        MAIL_ATTACHMENT_SPOOL_THRESHOLD is set and exceeded by the content of
+        a base64 encoded attachment.
+        """
+        threshold = getattr(self.mailman, 'attachment_spool_threshold', None)
+        if threshold is None or isinstance(content, str) or size <= threshold:
+            return False
+        basetype, subtype = mimetype.split('/', 1)
+        return basetype != 'text' and (basetype, subtype) != ('message', 'rfc822')
 
     def _create_message(self, msg):
         return self._create_attachments(msg)
 
     def _create_attachments(self, msg):
-        if self.attachments:
+        if not self.attachments:
+            return msg
+        with profile_step('_create_attachments'):
             encoding = self.encoding or self.mailman.default_charset
             body_msg = msg
             msg = SafeMIMEMultipart(_subtype=self.mixed_subtype, encoding=encoding)
@@ -392,9 +900,7 @@ class EmailMessage:
             attachment = SafeMIMEMessage(content, subtype)
         else:
             # Encode non-text attachments with base64.
-            attachment = MIMEBase(basetype, subtype)
-            attachment.set_payload(content)
-            Encoders.encode_base64(attachment)
+            attachment = SafeMIMEAttachment(content, basetype, subtype)
         return attachment
 
     def _create_attachment(self, filename, content, mimetype=None):
@@ -420,7 +926,12 @@ class EmailMessage:
             try:
                 value = self.extra_headers[header]
             except KeyError:
-                value = ', '.join(str(v) for v in values)
+                value = ', '.join(
+                    # Validated addresses are already encoded, so the header
+                    # doesn't parse them again.
+                    sanitize_address(v, msg.encoding, msg.smtputf8) if isinstance(v, SanitizedAddress) else str(v)
+                    for v in values
+                )
             msg[header] = value
 
 
@@ -429,9 +940,16 @@ class EmailMultiAlternatives(EmailMessage):
     A version of EmailMessage that makes it easy to send multipart/alternative
     messages. For example, including text and HTML versions of the text is
     made easier.
+
+    Images attached with attach_inline_image() are embedded in a
+    multipart/related part with the HTML alternative.
     """
 
     alternative_subtype = 'alternative'
+    related_subtype = 'related'
+    # Whether attach_alternative() inlines the CSS of HTML alternatives, when
+    # enabled with Mail.enable_css_inlining().
+    inline_css = True
 
     def __init__(
         self,
@@ -446,7 +964,7 @@ class EmailMultiAlternatives(EmailMessage):
         headers: t.Optional[t.Dict[str, t.Any]] = None,
         alternatives: t.Optional[list] = None,
         connection: t.Type["BaseEmailBackend"] = None,
-        mailman: t.Optional["Mailman"] = None,
+        mailman: t.Union["Mailman", str, None] = None,
     ):
         """
         Initialize a single email message (which can be sent to multiple
@@ -456,23 +974,398 @@ class EmailMultiAlternatives(EmailMessage):
             subject, body, from_email, to, cc, bcc, reply_to, attachments, headers, connection, mailman
         )
         self.alternatives = alternatives or []
+        self.inline_images = []
 
     def attach_alternative(self, content, mimetype):
-        """Attach an alternative content representation."""
+        """
+        Attach an alternative content representation. The CSS of HTML content
+        is inlined if enabled with Mail.enable_css_inlining().
+        """
         if content is None or mimetype is None:
             raise ValueError('Both content and mimetype must be provided.')
+        inliner = getattr(self.mailman, 'css_inliner', None)
+        if inliner is not None and self.inline_css and mimetype == 'text/html':
+            content = inliner.inline(content)
         self.alternatives.append((content, mimetype))
 
+    def attach_alternative_file(self, path, mimetype=None):
+        """
+        Attach an alternative content representation read from a text file,
+        decoded as UTF-8. The mimetype is guessed from the filename if it isn't
+        specified.
+        """
+        self.attach_alternative(*self._read_alternative_file(path, mimetype))
+
+    async def aattach_alternative_file(self, path, mimetype=None, executor=None):
+        """
+        Like attach_alternative_file(), but read the file in ``executor`` (the
+        loop's default executor if None), without blocking the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        self.attach_alternative(*await loop.run_in_executor(executor, self._read_alternative_file, path, mimetype))
+
+    def _read_alternative_file(self, path, mimetype=None):
+        path = Path(path)
+        return path.read_text(encoding='utf-8'), mimetype or guess_mimetype(path.name)
+
+    def attach_inline_image(self, content, filename=None, mimetype=None, cid=None):
+        """
+        Embed an image in the HTML alternative (or the HTML body without one)
+        and return its Content-ID, to reference as ``<img src="cid:...">``.
+
+        The mimetype is guessed from the filename if it isn't specified. The
+        Content-ID is derived from the SHA-256 of the content if it isn't
+        specified, so that an image has the same Content-ID in every message
+        and is embedded once per message. The base64 encoding of the images
+        is cached by content and shared by the messages embedding them.
+        """
+        if content is None:
+            raise ValueError('content must be provided.')
+        if filename is None and mimetype is None:
+            raise ValueError('A filename or a mimetype must be provided.')
+        mimetype = mimetype or guess_mimetype(filename)
+        if cid is None:
+            # bytes() doesn't copy bytes, only the other bytes-like objects.
+            digest, _ = _encode_inline_image(bytes(content))
+            cid = '%s@%s' % (digest[:32], DNS_NAME)
+        if not any(image[0] == cid for image in self.inline_images):
+            self.inline_images.append((cid, filename, content, mimetype))
+        return cid
+
+    def attach_inline_image_file(self, path, mimetype=None, cid=None):
+        """
+        Embed an image read from the filesystem, see attach_inline_image().
+        """
+        return self.attach_inline_image(*self._read_inline_image_file(path, mimetype), cid=cid)
+
+    async def aattach_inline_image_file(self, path, mimetype=None, cid=None, executor=None):
+        """
+        Like attach_inline_image_file(), but read the file in ``executor`` (the
+        loop's default executor if None), without blocking the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        image = await loop.run_in_executor(executor, self._read_inline_image_file, path, mimetype)
+        return self.attach_inline_image(*image, cid=cid)
+
+    def _read_inline_image_file(self, path, mimetype=None):
+        path = Path(path)
+        return path.read_bytes(), path.name, mimetype
+
     def _create_message(self, msg):
         return self._create_attachments(self._create_alternatives(msg))
 
     def _create_alternatives(self, msg):
-        encoding = self.encoding or self.mailman.default_charset
-        if self.alternatives:
-            body_msg = msg
+        if not self.alternatives:
+            return self._create_related(msg)
+        with profile_step('_create_alternatives'):
+            encoding = self.encoding or self.mailman.default_charset
+            # The inline images go with the last HTML alternative, the one
+            # displayed by clients, or with the body without one.
+            html = None
+            for index, (content, mimetype) in enumerate(self.alternatives):
+                if mimetype == 'text/html':
+                    html = index
+            body_msg = msg if html is not None else self._create_related(msg)
             msg = SafeMIMEMultipart(_subtype=self.alternative_subtype, encoding=encoding)
             if self.body:
                 msg.attach(body_msg)
-            for alternative in self.alternatives:
-                msg.attach(self._create_mime_attachment(*alternative))
+            for index, alternative in enumerate(self.alternatives):
+                part = self._create_mime_attachment(*alternative)
+                msg.attach(self._create_related(part) if index == html else part)
         return msg
+
+    def _create_related(self, msg):
+        if not self.inline_images:
+            return msg
+        encoding = self.encoding or self.mailman.default_charset
+        related = SafeMIMEMultipart(_subtype=self.related_subtype, encoding=encoding)
+        related.attach(msg)
+        for image in self.inline_images:
+            related.attach(self._create_inline_image(*image))
+        return related
+
+    def _create_inline_image(self, cid, filename, content, mimetype):
+        """
+        Convert an inline image into a MIME part, with the cached base64
+        encoding of its content.
+        """
+        basetype, subtype = mimetype.split('/', 1)
+        image = SafeMIMEAttachment(None, basetype, subtype)
+        _, image._payload = _encode_inline_image(bytes(content))
+        image['Content-ID'] = '<%s>' % cid
+        if filename:
+            try:
+                filename.encode('ascii')
+            except UnicodeEncodeError:
+                filename = ('utf-8', '', filename)
+            image.add_header('Content-Disposition', 'inline', filename=filename)
+        else:
+            image['Content-Disposition'] = 'inline'
+        return image
+
+
+# Compact binary encoding of messages, see encode_message().
+MESSAGE_FORMAT_MAGIC = b'\x93FMM'
+MESSAGE_FORMAT_VERSION = 2
+
+_CONTENT_BYTES = 0
+_CONTENT_TEXT = 1
+_CONTENT_REFERENCE = 2
+_CONTENT_MIME = 3
+
+
+class _ParsedMIMEBase(MIMEMixin, MIMEBase):
+    """A MIME part parsed back from its bytes by decode_message()."""
+
+    def __init__(self, policy=compat32):
+        Message.__init__(self, policy=policy)
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _encode_bytes(value, out):
+    _encode_varint(len(value), out)
+    out += value
+
+
+def _encode_str(value, out):
+    _encode_bytes(force_str(value).encode('utf-8', 'surrogatepass'), out)
+
+
+def _encode_optional_str(value, out):
+    if value is None:
+        out.append(0)
+    else:
+        out.append(1)
+        _encode_str(value, out)
+
+
+def _encode_strs(values, out):
+    _encode_varint(len(values), out)
+    for value in values:
+        _encode_str(value, out)
+
+
+def _encode_content(content, out, store_attachment=None):
+    if isinstance(content, EmailMessage):
+        content = content.message()
+    if isinstance(content, Message):
+        out.append(_CONTENT_MIME)
+        _encode_bytes(content.as_bytes(), out)
+    elif isinstance(content, str):
+        out.append(_CONTENT_TEXT)
+        _encode_str(content, out)
+    else:
+        if hasattr(content, 'read'):
+            content.seek(0)
+            content = content.read()
+        if store_attachment is None:
+            out.append(_CONTENT_BYTES)
+            _encode_bytes(content, out)
+        else:
+            out.append(_CONTENT_REFERENCE)
+            _encode_str(store_attachment(content), out)
+
+
+class _Reader:
+    __slots__ = ('data', 'offset')
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def byte(self):
+        if self.offset >= len(self.data):
+            raise ValueError('Truncated encoded message.')
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self):
+        value = shift = 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def bytes(self):
+        size = self.varint()
+        start, self.offset = self.offset, self.offset + size
+        if self.offset > len(self.data):
+            raise ValueError('Truncated encoded message.')
+        return self.data[start : self.offset].tobytes()
+
+    def str(self):
+        return self.bytes().decode('utf-8', 'surrogatepass')
+
+    def optional_str(self):
+        return self.str() if self.byte() else None
+
+    def strs(self):
+        return tuple(self.str() for _ in range(self.varint()))
+
+    def content(self, load_attachment=None):
+        kind = self.byte()
+        if kind == _CONTENT_BYTES:
+            return self.bytes()
+        if kind == _CONTENT_TEXT:
+            return self.str()
+        if kind == _CONTENT_MIME:
+            return BytesParser(_ParsedMIMEBase, policy=compat32).parsebytes(self.bytes())
+        if kind == _CONTENT_REFERENCE:
+            reference = self.str()
+            if load_attachment is None:
+                raise ValueError('The message references attachments, load_attachment is required.')
+            return load_attachment(reference)
+        raise ValueError('Unknown content kind %d.' % kind)
+
+
+def encode_message(message, store_attachment=None):
+    """
+    Encode an EmailMessage or a MessageSpec into a compact, versioned binary
+    format, for queues and spools. decode_message() reverses it.
+
+    The format is the magic bytes ``\\x93FMM`` and a version byte (currently
+    2), then the fields of the message in MessageSpec order. Integers are
+    unsigned LEB128 varints, strings are UTF-8 prefixed with their length,
+    optional strings are prefixed with a 0 (None) or 1 byte, and sequences
+    with their number of items. Headers are (name, value) string pairs,
+    alternatives (content, mimetype) pairs. Attachments are a 1 byte followed
+    by a MIME part, or a 0 byte followed by the optional filename, the content
+    and the optional mimetype. Contents are a kind byte followed by raw bytes,
+    a string, a reference or the bytes of a MIME part. Inline images (added in
+    version 2) are the Content-ID, the optional filename, the content and the
+    mimetype.
+
+    :param store_attachment: an optional callable taking the bytes of a binary
+        attachment and returning a string reference to store in their place,
+        e.g. a path or a hash (see AttachmentStore).
+    """
+    spec = message.to_spec() if isinstance(message, EmailMessage) else message
+    out = bytearray(MESSAGE_FORMAT_MAGIC)
+    out.append(MESSAGE_FORMAT_VERSION)
+    _encode_str(spec.subject, out)
+    _encode_str(spec.body, out)
+    _encode_optional_str(spec.from_email, out)
+    for addresses in (spec.to, spec.cc, spec.bcc, spec.reply_to):
+        _encode_strs(addresses, out)
+    _encode_varint(len(spec.headers), out)
+    for name, value in spec.headers:
+        _encode_str(name, out)
+        _encode_str(value, out)
+    _encode_varint(len(spec.attachments), out)
+    for attachment in spec.attachments:
+        if isinstance(attachment, MIMEBase):
+            out.append(1)
+            _encode_content(attachment, out)
+        else:
+            filename, content, mimetype = attachment
+            out.append(0)
+            _encode_optional_str(filename, out)
+            _encode_content(content, out, store_attachment)
+            _encode_optional_str(mimetype, out)
+    _encode_varint(len(spec.alternatives), out)
+    for content, mimetype in spec.alternatives:
+        _encode_content(content, out)
+        _encode_str(mimetype, out)
+    _encode_str(spec.content_subtype, out)
+    _encode_str(spec.mixed_subtype, out)
+    _encode_str(spec.alternative_subtype, out)
+    _encode_optional_str(spec.encoding, out)
+    _encode_varint(len(spec.inline_images), out)
+    for cid, filename, content, mimetype in spec.inline_images:
+        _encode_str(cid, out)
+        _encode_optional_str(filename, out)
+        _encode_content(content, out, store_attachment)
+        _encode_str(mimetype, out)
+    return bytes(out)
+
+
+def decode_message(data, load_attachment=None):
+    """
+    Decode the output of encode_message() into a MessageSpec.
+
+    :param load_attachment: a callable taking an attachment reference stored by
+        encode_message() and returning its content, as bytes or a binary file
+        object. Required if the message references attachments.
+    """
+    if data[: len(MESSAGE_FORMAT_MAGIC)] != MESSAGE_FORMAT_MAGIC:
+        raise ValueError('Not an encoded message.')
+    reader = _Reader(data)
+    reader.offset = len(MESSAGE_FORMAT_MAGIC)
+    version = reader.byte()
+    # Version 1 is version 2 without the inline images.
+    if version not in (1, MESSAGE_FORMAT_VERSION):
+        raise ValueError('Unsupported message format version %d.' % version)
+    subject = reader.str()
+    body = reader.str()
+    from_email = reader.optional_str()
+    to, cc, bcc, reply_to = reader.strs(), reader.strs(), reader.strs(), reader.strs()
+    headers = tuple((reader.str(), reader.str()) for _ in range(reader.varint()))
+    attachments = []
+    for _ in range(reader.varint()):
+        if reader.byte():
+            attachments.append(reader.content())
+        else:
+            attachments.append((reader.optional_str(), reader.content(load_attachment), reader.optional_str()))
+    alternatives = tuple((reader.content(), reader.str()) for _ in range(reader.varint()))
+    subtypes = reader.str(), reader.str(), reader.str()
+    encoding = reader.optional_str()
+    inline_images = []
+    for _ in range(reader.varint() if version > 1 else 0):
+        cid, filename, content = reader.str(), reader.optional_str(), reader.content(load_attachment)
+        if hasattr(content, 'read'):
+            # Inline images are cached by content, see _encode_inline_image().
+            with content:
+                content = content.read()
+        inline_images.append((cid, filename, content, reader.str()))
+    return MessageSpec(
+        subject,
+        body,
+        from_email,
+        to,
+        cc,
+        bcc,
+        reply_to,
+        headers,
+        attachments,
+        alternatives,
+        *subtypes,
+        encoding,
+        inline_images,
+    )
+
+
+class AttachmentStore:
+    """
+    A content-addressed store of attachments in a directory, to pass as
+    ``store_attachment`` to encode_message() and ``load_attachment`` to
+    decode_message(): each content is written once, under its SHA-256 hash,
+    and loaded back as an open file, so that it's read from disk when the
+    message is serialized.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def store(self, content):
+        reference = hashlib.sha256(content).hexdigest()
+        path = self.directory / reference
+        if not path.exists():
+            temporary = path.with_suffix('.tmp%d' % os.getpid())
+            temporary.write_bytes(content)
+            temporary.replace(path)
+        return reference
+
+    def load(self, reference):
+        if not reference.isalnum():
+            raise ValueError('Invalid attachment reference %r.' % reference)
+        return (self.directory / reference).open('rb')
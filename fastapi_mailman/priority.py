@@ -0,0 +1,241 @@
+"""
+Priority lanes keeping transactional mail ahead of bulk traffic.
+"""
+import asyncio
+import collections
+import typing as t
+
+from fastapi_mailman.tracing import capture_context, run_in_context
+from fastapi_mailman.utils import aiterate
+
+if t.TYPE_CHECKING:
+    import contextvars
+
+    from . import Mail
+    from .backends.base import BaseEmailBackend
+    from .message import EmailMessage
+
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_BULK = 'bulk'
+
+
+class Lane:
+    """
+    A priority class of messages, with its own budgets: at most
+    ``concurrency`` messages of the lane are in flight, and at most
+    ``connections`` connections are kept open for the lane between messages.
+
+    :param name: the priority of the messages sent in this lane.
+
+    :param concurrency: the number of messages sent at the same time.
+
+    :param connections: the number of connections kept open, defaults to
+        ``concurrency``. Messages in flight beyond it use a connection of their
+        own.
+    """
+
+    def __init__(self, name: str, concurrency: int = 4, connections: t.Optional[int] = None):
+        if concurrency < 1:
+            raise ValueError('A lane must allow at least one message in flight.')
+        self.name = name
+        self.concurrency = concurrency
+        self.connections = concurrency if connections is None else connections
+        self.queue: t.Deque[t.Tuple["EmailMessage", asyncio.Future, t.Optional["contextvars.Context"]]]
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.idle: t.List["BaseEmailBackend"] = []
+
+    def __repr__(self) -> str:
+        return '<Lane %s: %d queued, %d in flight>' % (self.name, len(self.queue), self.in_flight)
+
+
+def default_lanes() -> t.List[Lane]:
+    return [Lane(PRIORITY_HIGH, 4), Lane(PRIORITY_NORMAL, 4), Lane(PRIORITY_BULK, 2)]
+
+
+class PriorityScheduler:
+    """
+    Queue messages in priority lanes and send them over per-lane connections.
+
+    Lanes are listed from the highest priority to the lowest. Each lane has
+    its own concurrency and connection budgets, so a bulk campaign can't take
+    the connections that transactional mail needs. When ``max_concurrency``
+    also caps the messages in flight across lanes, every free slot goes to the
+    highest priority lane with queued messages.
+
+    A message is queued in the lane named by its ``priority`` attribute, or in
+    the ``default_lane``.
+
+    :param mailman: the Mail object whose backend sends the messages.
+
+    :param lanes: the lanes, from the highest priority to the lowest, defaults
+        to high, normal and bulk lanes.
+
+    :param max_concurrency: the number of messages in flight across lanes,
+        unlimited if None.
+
+    :param default_lane: the lane of messages without a priority.
+
+    :param backend: the backend to send with, defaults to the MAIL_BACKEND of
+        the Mail object.
+
+    Other keyword arguments are passed to the backend. Connections are kept
+    alive between messages unless ``keep_alive=False`` is passed.
+    """
+
+    def __init__(
+        self,
+        mailman: "Mail",
+        lanes: t.Optional[t.List[Lane]] = None,
+        max_concurrency: t.Optional[int] = None,
+        default_lane: str = PRIORITY_NORMAL,
+        backend: t.Any = None,
+        **kwargs: t.Any,
+    ):
+        self.mailman = mailman
+        self.lanes = default_lanes() if lanes is None else lanes
+        self._lanes = {lane.name: lane for lane in self.lanes}
+        if default_lane not in self._lanes:
+            raise ValueError('Unknown default lane %r.' % default_lane)
+        self.max_concurrency = max_concurrency
+        self.default_lane = default_lane
+        self.backend = backend
+        kwargs.setdefault('keep_alive', True)
+        self.backend_kwargs = kwargs
+        self.in_flight = 0
+        self._tasks: t.Set[asyncio.Future] = set()
+        self._idle_event: t.Optional[asyncio.Event] = None
+
+    def get_lane(self, priority: t.Optional[str]) -> Lane:
+        """Return the lane of the given priority, the default lane for None."""
+        try:
+            return self._lanes[priority or self.default_lane]
+        except KeyError:
+            raise ValueError('Unknown priority %r.' % priority)
+
+    def submit(self, message: "EmailMessage", priority: t.Optional[str] = None) -> asyncio.Future:
+        """
+        Queue a message in the lane of ``priority``, or of the message's own
+        priority. Return a future resolving to the number of messages sent (0
+        or 1).
+        """
+        lane = self.get_lane(priority or message.priority)
+        future = asyncio.get_event_loop().create_future()
+        lane.queue.append((message, future, capture_context(self.mailman)))
+        self._dispatch()
+        return future
+
+    async def send_messages(
+        self,
+        email_messages: t.Union[t.Iterable["EmailMessage"], t.AsyncIterable["EmailMessage"]],
+        priority: t.Optional[str] = None,
+        fail_silently: bool = False,
+    ) -> int:
+        """
+        Send the messages in the lane of ``priority`` and return the number of
+        messages sent. Messages are queued as the lane makes progress, so a
+        large campaign doesn't sit in memory all at once.
+        """
+        lane = self.get_lane(priority)
+        futures: t.Deque[asyncio.Future] = collections.deque()
+        num_sent = 0
+        try:
+            async for message in aiterate(email_messages):
+                futures.append(self.submit(message, lane.name))
+                # Keep a bounded backlog queued ahead of the lane.
+                while len(futures) > 2 * lane.concurrency:
+                    num_sent += await self._result(futures.popleft(), fail_silently)
+            while futures:
+                num_sent += await self._result(futures.popleft(), fail_silently)
+        finally:
+            for future in futures:
+                future.cancel()
+        return num_sent
+
+    async def _result(self, future: asyncio.Future, fail_silently: bool) -> int:
+        try:
+            return await future
+        except Exception:
+            if not fail_silently:
+                raise
+            return 0
+
+    async def flush(self, timeout: t.Optional[float] = None) -> bool:
+        """
+        Wait up to ``timeout`` seconds for the queued messages to be sent.
+        Return False if some were still queued or in flight at the deadline.
+        """
+        if self._is_idle():
+            return True
+        if self._idle_event is None:
+            self._idle_event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._idle_event = None
+        return True
+
+    async def close(self) -> None:
+        """Close the connections kept open by the lanes."""
+        for lane in self.lanes:
+            idle, lane.idle = lane.idle, []
+            for connection in idle:
+                await self._close(connection)
+
+    def _is_idle(self) -> bool:
+        return not self.in_flight and not any(lane.queue for lane in self.lanes)
+
+    def _dispatch(self) -> None:
+        """Start the queued messages the budgets allow, highest priority first."""
+        for lane in self.lanes:
+            while lane.queue and lane.in_flight < lane.concurrency:
+                if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                    return
+                message, future, context = lane.queue.popleft()
+                if future.done():
+                    # The caller stopped waiting for it.
+                    continue
+                lane.in_flight += 1
+                self.in_flight += 1
+                # Sent in the context of its caller, for tracing.
+                task = run_in_context(context, asyncio.ensure_future, self._send(lane, message, future))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        if self._idle_event is not None and self._is_idle():
+            self._idle_event.set()
+
+    async def _send(self, lane: Lane, message: "EmailMessage", future: asyncio.Future) -> None:
+        try:
+            with self.mailman.track_send():
+                connection = lane.idle.pop() if lane.idle else self._get_connection()
+                try:
+                    sent = await connection.send_messages([message])
+                except Exception:
+                    await self._close(connection)
+                    raise
+                if len(lane.idle) < lane.connections:
+                    lane.idle.append(connection)
+                else:
+                    await self._close(connection)
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(sent)
+        finally:
+            lane.in_flight -= 1
+            self.in_flight -= 1
+            self._dispatch()
+
+    def _get_connection(self) -> "BaseEmailBackend":
+        return self.mailman.get_connection(backend=self.backend, **self.backend_kwargs)
+
+    async def _close(self, connection: "BaseEmailBackend") -> None:
+        try:
+            await connection.close()
+        except Exception:
+            pass
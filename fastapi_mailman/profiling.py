@@ -0,0 +1,255 @@
+"""
+Sampling profiler catching the messages that are slow to send.
+"""
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import random
+import time
+import typing as t
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6, where sends aren't profiled.
+    contextvars = None
+
+if t.TYPE_CHECKING:
+    from . import Mail
+    from .message import EmailMessage
+
+
+class SlowMessageReport:
+    """
+    The timing breakdown of a sampled send that exceeded the threshold of the
+    profiler.
+
+    ``steps`` maps each profiled step (``message``, ``_create_alternatives``,
+    ``_create_attachments``, ``as_bytes``) to its total duration in seconds,
+    and ``stats`` is the cProfile report of the synchronous steps, if enabled.
+    """
+
+    __slots__ = ('subject', 'recipients', 'size', 'started_at', 'duration', 'steps', 'stats')
+
+    def __init__(
+        self,
+        subject: str,
+        recipients: int,
+        size: t.Optional[int],
+        started_at: float,
+        duration: float,
+        steps: t.Dict[str, float],
+        stats: t.Optional[str],
+    ):
+        self.subject = subject
+        self.recipients = recipients
+        self.size = size
+        self.started_at = started_at
+        self.duration = duration
+        self.steps = steps
+        self.stats = stats
+
+    def __repr__(self) -> str:
+        return '<SlowMessageReport %r: %.3fs>' % (self.subject, self.duration)
+
+    def as_dict(self) -> t.Dict[str, t.Any]:
+        """Return the report as a dict, e.g. to serve it as JSON."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Profile:
+    """The measures of one sampled send."""
+
+    __slots__ = ('steps', 'profile', 'depth', 'size')
+
+    def __init__(self, cprofile: bool):
+        self.steps: t.Dict[str, float] = {}
+        self.profile = cProfile.Profile() if cprofile else None
+        self.depth = 0
+        self.size: t.Optional[int] = None
+
+
+class _NoProfile:
+    """Stands for the context variable of the current profile without contextvars."""
+
+    def get(self) -> None:
+        return None
+
+
+_current_profile: "contextvars.ContextVar[t.Optional[_Profile]]" = (
+    _NoProfile() if contextvars is None else contextvars.ContextVar('fastapi_mailman_profile', default=None)
+)
+
+
+class _NullContext:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class _Step:
+    """Time a synchronous step of a sampled send, and run cProfile in it."""
+
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile: _Profile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self) -> None:
+        profile = self.profile
+        if profile.depth == 0 and profile.profile is not None:
+            try:
+                profile.profile.enable()
+            except ValueError:
+                # Another profiler is active, only time the steps.
+                profile.profile = None
+        profile.depth += 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        profile = self.profile
+        profile.steps[self.name] = profile.steps.get(self.name, 0.0) + time.perf_counter() - self.start
+        profile.depth -= 1
+        if profile.depth == 0 and profile.profile is not None:
+            profile.profile.disable()
+
+
+def profile_step(name: str) -> t.ContextManager[None]:
+    """
+    Return a context manager timing the step ``name`` of the send being
+    profiled, a no-op outside sampled sends. Steps must not await, so that
+    the profile only covers the send.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        return _NULL_CONTEXT
+    return _Step(profile, name)
+
+
+def record_size(size: int) -> None:
+    """Record the size of the message being profiled, if any."""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.size = size
+
+
+class _Send:
+    """Profile a sampled send, and report it to the profiler if slow."""
+
+    __slots__ = ('profiler', 'message', 'profile', 'token', 'started_at', 'start')
+
+    def __init__(self, profiler: "MessageProfiler", message: "EmailMessage"):
+        self.profiler = profiler
+        self.message = message
+
+    def __enter__(self) -> None:
+        self.profile = _Profile(self.profiler.cprofile)
+        self.token = _current_profile.set(self.profile)
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        duration = time.perf_counter() - self.start
+        _current_profile.reset(self.token)
+        if duration >= self.profiler.threshold:
+            self.profiler.add_report(self._report(duration))
+
+    def _report(self, duration: float) -> SlowMessageReport:
+        stats = None
+        if self.profile.profile is not None and self.profile.steps:
+            output = io.StringIO()
+            profile_stats = pstats.Stats(self.profile.profile, stream=output)
+            profile_stats.sort_stats('cumulative').print_stats(self.profiler.stats_limit)
+            stats = output.getvalue()
+        message = self.message
+        return SlowMessageReport(
+            str(getattr(message, 'subject', '')),
+            len(message.recipients()),
+            self.profile.size,
+            self.started_at,
+            duration,
+            self.profile.steps,
+            stats,
+        )
+
+
+class MessageProfiler:
+    """
+    Sample a fraction of the sends, and keep a report of the slowest of them.
+
+    A sampled send that takes ``threshold`` seconds or more is reported with
+    the time spent in each step of building the message (message(),
+    _create_alternatives(), _create_attachments() and as_bytes()), and with a
+    cProfile report of these steps if ``cprofile`` is set. The ``top_n``
+    slowest reports are kept in memory, see reports().
+
+    :param sample_rate: the fraction of sends profiled, between 0 and 1.
+
+    :param threshold: the duration in seconds from which a send is reported.
+
+    :param top_n: the number of reports kept.
+
+    :param cprofile: whether to run cProfile during the steps.
+
+    :param stats_limit: the number of functions listed in cProfile reports.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.01,
+        threshold: float = 1.0,
+        top_n: int = 20,
+        cprofile: bool = True,
+        stats_limit: int = 25,
+    ):
+        if contextvars is None:
+            raise RuntimeError('Profiling requires Python 3.7 or later.')
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.top_n = top_n
+        self.cprofile = cprofile
+        self.stats_limit = stats_limit
+        self._reports: t.List[t.Tuple[float, int, SlowMessageReport]] = []
+        self._counter = itertools.count()
+
+    def profile_send(self, message: "EmailMessage") -> t.ContextManager[None]:
+        """Return a context manager profiling the send of a message, if sampled."""
+        if random.random() >= self.sample_rate or _current_profile.get() is not None:
+            return _NULL_CONTEXT
+        return _Send(self, message)
+
+    def add_report(self, report: SlowMessageReport) -> None:
+        """Keep a report if it's among the ``top_n`` slowest."""
+        entry = (report.duration, next(self._counter), report)
+        if len(self._reports) < self.top_n:
+            heapq.heappush(self._reports, entry)
+        elif report.duration > self._reports[0][0]:
+            heapq.heapreplace(self._reports, entry)
+
+    def reports(self) -> t.List[SlowMessageReport]:
+        """Return the kept reports, the slowest first."""
+        return [report for _, _, report in sorted(self._reports, reverse=True)]
+
+    def clear(self) -> None:
+        """Drop the kept reports."""
+        self._reports = []
+
+
+def profile_send(mailman: t.Optional["Mail"], message: "EmailMessage") -> t.ContextManager[None]:
+    """
+    Return a context manager profiling the send of a message with the profiler
+    of the Mail object, a no-op unless profiling was enabled with
+    Mail.enable_profiling().
+    """
+    profiler = getattr(mailman, 'profiler', None)
+    if profiler is None:
+        return _NULL_CONTEXT
+    return profiler.profile_send(message)
@@ -0,0 +1,140 @@
+"""
+Load balancing and failover between several SMTP relays.
+"""
+import time
+import typing as t
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class Relay:
+    """
+    An SMTP relay of a RelayPool, with its weight and health.
+
+    A relay that fails is unhealthy for ``retry_interval`` seconds, doubled
+    after each consecutive failure up to ``max_retry_interval``. It's probed
+    again by the next connection after that.
+    """
+
+    def __init__(self, host: str, port: int = 25, weight: int = 1):
+        if weight < 1:
+            raise ValueError('The weight of a relay must be at least 1.')
+        self.host = host
+        self.port = port
+        self.weight = weight
+        # The connections currently open to the relay.
+        self.outstanding = 0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.current_weight = 0
+
+    def __repr__(self) -> str:
+        return '<Relay %s:%d weight=%d>' % (self.host, self.port, self.weight)
+
+    @classmethod
+    def parse(cls, spec: str, default_port: int = 25) -> "Relay":
+        """Parse a relay written ``host[:port][;weight=N]``, e.g. ``smtp1.example.com:587;weight=3``."""
+        address, _, options = spec.partition(';')
+        host, _, port = address.strip().partition(':')
+        weight = 1
+        for option in filter(None, (option.strip() for option in options.split(';'))):
+            name, _, value = option.partition('=')
+            if name.strip() != 'weight':
+                raise ValueError('Unknown relay option %r in %r.' % (name, spec))
+            weight = int(value)
+        return cls(host, int(port) if port else default_port, weight)
+
+    def is_healthy(self, now: t.Optional[float] = None) -> bool:
+        return self.unhealthy_until <= (time.monotonic() if now is None else now)
+
+
+class RelayPool:
+    """
+    The relays a Mail object sends through, shared by its SMTP backends so
+    that they share the health of the relays.
+
+    Each new connection goes to a healthy relay picked by ``strategy``:
+
+    - ``round_robin``: smooth weighted round-robin, spreading connections in
+      proportion to the weights of the relays.
+    - ``least_outstanding``: the relay with the fewest open connections
+      relative to its weight.
+
+    The other relays follow as fallbacks, the healthy ones first, so that a
+    connection fails over to the next relay when one is down. When every
+    relay is unhealthy, they are all tried anyway.
+
+    :param relays: Relay objects, or strings parsed by Relay.parse().
+
+    :param strategy: ``round_robin`` or ``least_outstanding``.
+
+    :param retry_interval: how many seconds a failed relay is skipped.
+
+    :param max_retry_interval: the longest a relay that keeps failing is
+        skipped.
+    """
+
+    def __init__(
+        self,
+        relays: t.Iterable[t.Union[Relay, str]],
+        strategy: str = ROUND_ROBIN,
+        retry_interval: float = 30.0,
+        max_retry_interval: float = 300.0,
+        default_port: int = 25,
+    ):
+        self.relays = [relay if isinstance(relay, Relay) else Relay.parse(relay, default_port) for relay in relays]
+        if not self.relays:
+            raise ValueError('A relay pool needs at least one relay.')
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError('Unknown relay strategy %r.' % strategy)
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+    def candidates(self) -> t.List[Relay]:
+        """Return the relays to try for a new connection, in order."""
+        now = time.monotonic()
+        healthy = [relay for relay in self.relays if relay.is_healthy(now)]
+        unhealthy = sorted((relay for relay in self.relays if not relay.is_healthy(now)), key=self._recovery)
+        if not healthy:
+            return unhealthy
+        first = self._pick(healthy)
+        fallbacks = sorted((relay for relay in healthy if relay is not first), key=self._load)
+        return [first] + fallbacks + unhealthy
+
+    def find(self, host: str, port: int) -> t.Optional[Relay]:
+        """Return the relay at the given address, if any."""
+        for relay in self.relays:
+            if relay.host == host and relay.port == port:
+                return relay
+        return None
+
+    def mark_failed(self, relay: Relay) -> None:
+        """Skip a relay for a while, longer after each consecutive failure."""
+        relay.failures += 1
+        interval = min(self.retry_interval * 2 ** (relay.failures - 1), self.max_retry_interval)
+        relay.unhealthy_until = time.monotonic() + interval
+
+    def mark_healthy(self, relay: Relay) -> None:
+        relay.failures = 0
+        relay.unhealthy_until = 0.0
+
+    def _pick(self, relays: t.List[Relay]) -> Relay:
+        if self.strategy == LEAST_OUTSTANDING:
+            return min(relays, key=self._load)
+        # Smooth weighted round-robin: every pick raises each relay's current
+        # weight by its weight, and takes the total from the one picked.
+        total = 0
+        for relay in relays:
+            relay.current_weight += relay.weight
+            total += relay.weight
+        picked = max(relays, key=lambda relay: relay.current_weight)
+        picked.current_weight -= total
+        return picked
+
+    def _load(self, relay: Relay) -> t.Tuple[float, int]:
+        return relay.outstanding / relay.weight, -relay.weight
+
+    def _recovery(self, relay: Relay) -> float:
+        return relay.unhealthy_until
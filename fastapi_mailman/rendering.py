@@ -0,0 +1,256 @@
+"""
+Rendering of messages to their wire format in worker processes.
+"""
+import asyncio
+import collections
+import typing as t
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from fastapi_mailman.message import EmailMessage, sanitize_address, unspool_attachments
+from fastapi_mailman.results import SendResult
+from fastapi_mailman.utils import achunks, aiterate
+
+if t.TYPE_CHECKING:
+    from . import Mail
+    from .backends.base import BaseEmailBackend
+
+
+class RenderSettings:
+    """
+    The settings of a Mail object that rendering a message depends on. It
+    stands in for the Mail object in worker processes.
+    """
+
+    __slots__ = ('default_charset', 'default_sender', 'use_localtime')
+
+    def __init__(self, default_charset: str, default_sender: t.Optional[str], use_localtime: bool):
+        self.default_charset = default_charset
+        self.default_sender = default_sender
+        self.use_localtime = use_localtime
+
+    def __getstate__(self):
+        return (self.default_charset, self.default_sender, self.use_localtime)
+
+    def __setstate__(self, state):
+        self.default_charset, self.default_sender, self.use_localtime = state
+
+    @classmethod
+    def from_mailman(cls, mailman: "Mail") -> "RenderSettings":
+        return cls(mailman.default_charset, mailman.default_sender, mailman.use_localtime)
+
+
+class RenderedMessage:
+    """
+    A message rendered to the bytes sent in the DATA phase, along with its
+    sanitized envelope addresses.
+
+    Backends with ``accepts_rendered_messages`` set accept it in
+    send_messages() in place of an EmailMessage.
+    """
+
+    __slots__ = ('from_email', 'to', 'data', 'smtputf8')
+
+    def __init__(self, from_email: str, to: t.List[str], data: bytes, smtputf8: bool = False):
+        self.from_email = from_email
+        self.to = to
+        self.data = data
+        self.smtputf8 = smtputf8
+
+    def __getstate__(self):
+        return (self.from_email, self.to, self.data, self.smtputf8)
+
+    def __setstate__(self, state):
+        self.from_email, self.to, self.data, self.smtputf8 = state
+
+    def recipients(self) -> t.List[str]:
+        return self.to
+
+    @classmethod
+    def from_message(cls, message: EmailMessage, smtputf8: bool = False) -> "RenderedMessage":
+        encoding = message.encoding or message.mailman.default_charset
+        return cls(
+            sanitize_address(message.from_email, encoding, smtputf8),
+            [sanitize_address(addr, encoding, smtputf8) for addr in message.recipients()],
+            message.message(smtputf8=smtputf8).as_bytes(linesep='\r\n'),
+            smtputf8,
+        )
+
+
+def message_spec(message: EmailMessage) -> t.Tuple[type, t.Dict[str, t.Any]]:
+    """
+    Return the class and the state of a message, without its Mail object and
+    connection, which neither can nor need to cross process boundaries.
+    """
+    state = {key: value for key, value in message.__dict__.items() if key not in ('mailman', 'connection')}
+    state['attachments'] = unspool_attachments(message.attachments)
+    return type(message), state
+
+
+def render_messages(
+    settings: RenderSettings,
+    specs: t.List[t.Tuple[type, t.Dict[str, t.Any]]],
+    smtputf8: bool = False,
+) -> t.List[t.Union[RenderedMessage, Exception]]:
+    """
+    Rebuild the messages from their specs and render them. A message that
+    fails to render (e.g. because of a bad header) is returned as its
+    exception, so that the results stay aligned with the specs.
+    """
+    results: t.List[t.Union[RenderedMessage, Exception]] = []
+    for klass, state in specs:
+        message = klass.__new__(klass)
+        message.__dict__.update(state)
+        message.mailman = settings
+        message.connection = None
+        try:
+            results.append(RenderedMessage.from_message(message, smtputf8))
+        except Exception as exc:
+            results.append(exc)
+    return results
+
+
+class RenderPipeline:
+    """
+    Render messages in a pool of worker processes and send them as they come
+    back, so that building MIME for large campaigns uses every core instead of
+    one.
+
+    Messages are shipped to the workers in chunks of ``chunk_size``. At most
+    ``max_pending`` chunks are rendered ahead of the sender, which bounds the
+    memory held by a job whatever its size, and chunks are sent in the order of
+    the messages.
+
+    The pool is only used with backends that accept rendered messages (the SMTP
+    backend), other backends are handed the messages themselves.
+
+    :param mailman: the Mail object whose settings and backend are used.
+
+    :param executor: the executor to render in, defaults to a
+        ProcessPoolExecutor of ``max_workers`` processes owned by the pipeline.
+
+    :param max_workers: the number of worker processes, defaults to the number
+        of CPUs.
+
+    :param chunk_size: the number of messages rendered per task.
+
+    :param max_pending: the number of chunks rendered ahead of the sender,
+        defaults to twice the number of workers.
+
+    :param smtputf8: whether to render non-ASCII headers and addresses as raw
+        UTF-8, for servers supporting SMTPUTF8.
+    """
+
+    def __init__(
+        self,
+        mailman: "Mail",
+        executor: t.Optional[Executor] = None,
+        max_workers: t.Optional[int] = None,
+        chunk_size: int = 50,
+        max_pending: t.Optional[int] = None,
+        smtputf8: bool = False,
+    ):
+        self.mailman = mailman
+        self.executor = executor
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.smtputf8 = smtputf8
+        self._owns_executor = executor is None
+
+    def get_executor(self) -> Executor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    def close(self) -> None:
+        """Shut down the worker processes started by the pipeline."""
+        if self._owns_executor and self.executor is not None:
+            executor, self.executor = self.executor, None
+            executor.shutdown()
+
+    def __enter__(self) -> "RenderPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    async def render(
+        self, messages: t.Union[t.Iterable[EmailMessage], t.AsyncIterable[EmailMessage]]
+    ) -> t.AsyncIterator[t.List[t.Union[RenderedMessage, Exception]]]:
+        """
+        Render messages in the worker processes. Yield the results chunk by
+        chunk, in order.
+        """
+        loop = asyncio.get_event_loop()
+        executor = self.get_executor()
+        settings = RenderSettings.from_mailman(self.mailman)
+        max_pending = self.max_pending or 2 * (getattr(executor, '_max_workers', None) or 1)
+        pending: t.Deque[asyncio.Future] = collections.deque()
+        try:
+            async for chunk in achunks(messages, self.chunk_size):
+                specs = [message_spec(message) for message in chunk]
+                pending.append(loop.run_in_executor(executor, render_messages, settings, specs, self.smtputf8))
+                if len(pending) >= max_pending:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def send_messages(
+        self,
+        messages: t.Union[t.Iterable[EmailMessage], t.AsyncIterable[EmailMessage]],
+        connection: t.Optional["BaseEmailBackend"] = None,
+    ) -> int:
+        """
+        Render the messages in the worker processes and send them over one
+        connection. Return the number of messages sent, as a SendResult with
+        the result of each message.
+
+        A message that failed to render is skipped if the connection fails
+        silently, its exception is raised otherwise.
+        """
+        connection = connection or self.mailman.get_connection()
+        if not getattr(connection, 'accepts_rendered_messages', False):
+            with self.mailman.track_send():
+                return await connection.send_messages(messages)
+        message_results = []
+        with self.mailman.track_send():
+            async with connection:
+                async for results in self.render(messages):
+                    rendered = []
+                    for result in results:
+                        if isinstance(result, Exception):
+                            if not connection.fail_silently:
+                                raise result
+                        else:
+                            rendered.append(result)
+                    sent = await connection.send_messages(rendered)
+                    message_results.extend(getattr(sent, 'results', ()))
+        return SendResult(message_results)
+
+    async def send_mass_mail(
+        self,
+        datatuple: t.Union[
+            t.Iterable[t.Tuple[str, str, str, t.List[str]]], t.AsyncIterable[t.Tuple[str, str, str, t.List[str]]]
+        ],
+        fail_silently: bool = False,
+        auth_user: t.Optional[str] = None,
+        auth_password: t.Optional[str] = None,
+        connection: t.Optional["BaseEmailBackend"] = None,
+    ) -> int:
+        """
+        Like Mail.send_mass_mail(), but render the messages in the worker
+        processes. The datatuple is consumed lazily.
+        """
+        connection = connection or self.mailman.get_connection(
+            username=auth_user,
+            password=auth_password,
+            fail_silently=fail_silently,
+        )
+        messages = (
+            EmailMessage(subject, message, sender, recipient, mailman=self.mailman)
+            async for subject, message, sender, recipient in aiterate(datatuple)
+        )
+        return await self.send_messages(messages, connection=connection)
@@ -0,0 +1,109 @@
+"""
+Per-message and per-recipient results of sending messages.
+"""
+import typing as t
+
+if t.TYPE_CHECKING:
+    from .message import EmailMessage
+
+
+class RecipientResult:
+    """
+    The status of a recipient of a message: the ``code`` and ``reply`` of the
+    server for the recipient, e.g. 250 once the message was accepted, or the
+    4xx or 5xx reply refusing the recipient. Backends that don't talk to a
+    server accept every recipient with the code None.
+    """
+
+    __slots__ = ('address', 'code', 'reply')
+
+    def __init__(self, address: str, code: t.Optional[int] = None, reply: str = ''):
+        self.address = address
+        self.code = code
+        self.reply = reply
+
+    def __repr__(self) -> str:
+        return '<RecipientResult %s: %s %s>' % (self.address, self.code, self.reply)
+
+    @property
+    def ok(self) -> bool:
+        return self.code is None or 200 <= self.code < 300
+
+    @property
+    def transient(self) -> bool:
+        """Whether the recipient was refused temporarily, and worth retrying."""
+        return self.code is not None and 400 <= self.code < 500
+
+
+class MessageResult:
+    """
+    The result of sending a message: the RecipientResult of each of its
+    recipients, the ``reply`` of the server to the message, the ``error`` that
+    failed the message when it failed silently, and the ``duration`` of the
+    send in seconds. ``sent`` tells whether the message was accepted for one
+    recipient at least.
+
+    When the error happened before the recipients were known to the server
+    (e.g. the connection was lost), ``recipients`` is empty.
+    """
+
+    __slots__ = ('message', 'recipients', 'reply', 'error', 'duration', 'sent')
+
+    def __init__(
+        self,
+        message: "EmailMessage",
+        recipients: t.Optional[t.List[RecipientResult]] = None,
+        reply: str = '',
+        error: t.Optional[Exception] = None,
+        duration: float = 0.0,
+        sent: t.Optional[bool] = None,
+    ):
+        self.message = message
+        self.recipients = [] if recipients is None else recipients
+        self.reply = reply
+        self.error = error
+        self.duration = duration
+        if sent is None:
+            sent = error is None and any(recipient.ok for recipient in self.recipients)
+        self.sent = sent
+
+    def __repr__(self) -> str:
+        return '<MessageResult %s: %d/%d recipients>' % (
+            'sent' if self.sent else 'failed',
+            len(self.recipients) - len(self.failed_recipients),
+            len(self.recipients),
+        )
+
+    @classmethod
+    def accepted(cls, message: "EmailMessage", duration: float = 0.0) -> "MessageResult":
+        """The result of a message accepted for all its recipients by a backend without a server."""
+        recipients = [RecipientResult(address) for address in message.recipients()]
+        return cls(message, recipients, duration=duration, sent=True)
+
+    @property
+    def failed_recipients(self) -> t.List[RecipientResult]:
+        return [recipient for recipient in self.recipients if not recipient.ok]
+
+
+class SendResult(int):
+    """
+    What send_messages() returns: the number of messages sent, as it always
+    was, with the MessageResult of each message in ``results``, so that only
+    the messages and recipients that failed are retried.
+    """
+
+    results: t.List[MessageResult]
+
+    def __new__(cls, results: t.Iterable[MessageResult] = ()) -> "SendResult":
+        results = list(results)
+        self = super().__new__(cls, sum(result.sent for result in results))
+        self.results = results
+        return self
+
+    def __getnewargs__(self) -> t.Tuple[t.List[MessageResult]]:
+        return (self.results,)
+
+    @property
+    def failed(self) -> t.List[MessageResult]:
+        """The results of the messages that failed for one recipient at least."""
+        return [result for result in self.results if not result.sent or result.failed_recipients]
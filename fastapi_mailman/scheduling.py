@@ -0,0 +1,320 @@
+"""
+Sending messages at a given time, from an in-process timer heap.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import os
+import struct
+import time
+import typing as t
+import uuid
+from pathlib import Path
+
+from fastapi_mailman.message import EmailMultiAlternatives, decode_message, encode_message
+from fastapi_mailman.tracing import capture_context, run_in_context
+
+if t.TYPE_CHECKING:
+    import contextvars
+
+    from . import Mail
+    from .message import AttachmentStore, EmailMessage
+
+# The longest a timer sleeps at once. Scheduled times are wall clock times, a
+# bounded sleep notices when the system clock is adjusted.
+MAX_TIMER_DELAY = 60.0
+
+
+def to_timestamp(
+    send_at: t.Union[datetime.datetime, float, None] = None,
+    delay: t.Union[datetime.timedelta, float, None] = None,
+) -> float:
+    """
+    Return the POSIX timestamp of ``send_at`` (a datetime, naive datetimes are
+    local time, or a timestamp), or of ``delay`` (a timedelta or seconds) from
+    now.
+    """
+    if send_at is not None and delay is not None:
+        raise ValueError('send_at and delay are mutually exclusive.')
+    if isinstance(send_at, datetime.datetime):
+        return send_at.timestamp()
+    if send_at is not None:
+        return float(send_at)
+    if isinstance(delay, datetime.timedelta):
+        delay = delay.total_seconds()
+    return time.time() + (delay or 0)
+
+
+class ScheduledMessage:
+    """
+    A message waiting in a DelayedSender. ``result`` is a future resolving to
+    the number of messages sent (0 or 1), or to the exception raised when the
+    message was sent or written to the store.
+    """
+
+    __slots__ = ('id', 'send_at', 'message', 'result', 'cancelled', 'released', 'context', 'stored', '_sender')
+
+    def __init__(
+        self,
+        id: str,
+        send_at: float,
+        message: "EmailMessage",
+        sender: "DelayedSender",
+        context: t.Optional["contextvars.Context"] = None,
+    ):
+        self.id = id
+        self.send_at = send_at
+        self.message = message
+        # The context of the caller, to trace the send in it.
+        self.context = context
+        self.result: asyncio.Future = asyncio.get_event_loop().create_future()
+        # Failures are reported through the future, whether or not somebody
+        # awaits it.
+        self.result.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.cancelled = False
+        # Whether the timer released it, it's being sent or was sent then.
+        self.released = False
+        # The write of the message to the store, if it's being persisted.
+        self.stored: t.Optional[asyncio.Future] = None
+        self._sender = sender
+
+    def __repr__(self) -> str:
+        return '<ScheduledMessage %s at %s>' % (self.id, datetime.datetime.fromtimestamp(self.send_at).isoformat())
+
+    def cancel(self) -> bool:
+        """Unschedule the message. Return False if it was already released."""
+        return self._sender.cancel(self)
+
+
+class ScheduleStore:
+    """
+    Persist scheduled messages in a directory, one file per message, so that
+    they survive restarts. Messages are written with encode_message(), with
+    their attachments in ``attachment_store`` if given.
+    """
+
+    _header = struct.Struct('>dB')
+
+    def __init__(self, directory, attachment_store: t.Optional["AttachmentStore"] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.attachment_store = attachment_store
+
+    def add(self, id: str, send_at: float, message: "EmailMessage") -> None:
+        priority = (message.priority or '').encode('ascii')
+        store_attachment = self.attachment_store.store if self.attachment_store else None
+        data = self._header.pack(send_at, len(priority)) + priority + encode_message(message, store_attachment)
+        path = self.directory / id
+        temporary = path.with_suffix('.tmp%d' % os.getpid())
+        temporary.write_bytes(data)
+        temporary.replace(path)
+
+    def remove(self, id: str) -> None:
+        try:
+            (self.directory / id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def load(self, mailman: "Mail") -> t.List[t.Tuple[str, float, "EmailMessage"]]:
+        """Return the (id, send_at, message) of every stored message."""
+        load_attachment = self.attachment_store.load if self.attachment_store else None
+        entries = []
+        for path in self.directory.iterdir():
+            if not path.name.isalnum():
+                # Interrupted writes.
+                continue
+            data = path.read_bytes()
+            send_at, length = self._header.unpack_from(data)
+            offset = self._header.size
+            message = EmailMultiAlternatives.from_spec(
+                decode_message(data[offset + length :], load_attachment), mailman=mailman
+            )
+            message.priority = data[offset : offset + length].decode('ascii') or None
+            entries.append((path.name, send_at, message))
+        return entries
+
+
+class DelayedSender:
+    """
+    Hold messages until the time they are scheduled for, then send them with
+    EmailMessage.send(), so through priority lanes or batching if enabled.
+
+    Pending messages are kept in a heap, scheduling and releasing a message
+    costs O(log n), and a single timer is armed for the earliest one, however
+    many are pending. Cancelled messages are dropped lazily.
+
+    :param mailman: the Mail object the messages are sent with.
+
+    :param store: a ScheduleStore persisting the pending messages, which
+        restore() schedules again after a restart.
+
+    :param max_rate: the number of messages released per second at most.
+        Messages due at the same time (e.g. at the top of the hour) are spread
+        out at this rate instead of being sent in one burst.
+
+    :param fail_silently: whether the messages are sent failing silently.
+    """
+
+    def __init__(
+        self,
+        mailman: "Mail",
+        store: t.Optional[ScheduleStore] = None,
+        max_rate: t.Optional[float] = None,
+        fail_silently: bool = False,
+    ):
+        self.mailman = mailman
+        self.store = store
+        self.max_rate = max_rate
+        self.fail_silently = fail_silently
+        self._heap: t.List[t.Tuple[float, int, ScheduledMessage]] = []
+        self._counter = itertools.count()
+        self._pending = 0
+        self._timer: t.Optional[asyncio.TimerHandle] = None
+        self._timer_at: t.Optional[float] = None
+        self._last_release = float('-inf')
+        # The sends and the writes to the store in progress.
+        self._tasks: t.Set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        """The number of messages waiting to be released."""
+        return self._pending
+
+    def schedule(
+        self,
+        message: "EmailMessage",
+        send_at: t.Union[datetime.datetime, float, None] = None,
+        delay: t.Union[datetime.timedelta, float, None] = None,
+    ) -> ScheduledMessage:
+        """
+        Schedule a message for ``send_at`` (a datetime or a timestamp), or
+        ``delay`` (a timedelta or seconds) from now. With a store, the message
+        is written in the loop's default executor, encoding it and reading its
+        spooled attachments without blocking the event loop, and it's sent
+        once written.
+        """
+        scheduled = ScheduledMessage(
+            uuid.uuid4().hex, to_timestamp(send_at, delay), message, self, capture_context(self.mailman)
+        )
+        if self.store is not None:
+            loop = asyncio.get_event_loop()
+            scheduled.stored = self._track(
+                loop.run_in_executor(None, self.store.add, scheduled.id, scheduled.send_at, message)
+            )
+            # Reported through the result when the message is released.
+            scheduled.stored.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self._push(scheduled)
+        return scheduled
+
+    def cancel(self, scheduled: ScheduledMessage) -> bool:
+        """Unschedule a message. Return False if it was already released."""
+        if scheduled.cancelled or scheduled.released or scheduled._sender is not self:
+            return False
+        scheduled.cancelled = True
+        scheduled.result.cancel()
+        self._pending -= 1
+        if self.store is not None:
+            self._track(asyncio.ensure_future(self._unstore(scheduled)))
+        return True
+
+    async def restore(self) -> int:
+        """
+        Schedule the messages of the store again, e.g. after a restart.
+        Messages already due are released right away. Return their number.
+        """
+        if self.store is None:
+            return 0
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(None, self.store.load, self.mailman)
+        for id, send_at, message in entries:
+            self._push(ScheduledMessage(id, send_at, message, self))
+        return len(entries)
+
+    def close(self) -> None:
+        """
+        Stop releasing messages. Messages still pending are kept in the store,
+        if any, and lost otherwise.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_at = None
+
+    async def flush(self, timeout: t.Optional[float] = None) -> bool:
+        """
+        Wait up to ``timeout`` seconds for the messages being sent and the
+        writes to the store. Return False if some were still running at the
+        deadline.
+        """
+        if not self._tasks:
+            return True
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        return not pending
+
+    def _track(self, future: asyncio.Future) -> asyncio.Future:
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+        return future
+
+    def _push(self, scheduled: ScheduledMessage) -> None:
+        heapq.heappush(self._heap, (scheduled.send_at, next(self._counter), scheduled))
+        self._pending += 1
+        self._arm()
+
+    def _arm(self) -> None:
+        """Arm the timer for the next message to release, if it isn't already."""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            self.close()
+            return
+        at = self._heap[0][0]
+        if self.max_rate:
+            at = max(at, self._last_release + 1 / self.max_rate)
+        if self._timer is not None:
+            if self._timer_at <= at:
+                return
+            self._timer.cancel()
+        self._timer_at = at
+        delay = min(max(at - time.time(), 0), MAX_TIMER_DELAY)
+        self._timer = asyncio.get_event_loop().call_later(delay, self._release)
+
+    def _release(self) -> None:
+        self._timer = self._timer_at = None
+        now = time.time()
+        if self.max_rate and now < self._last_release + 1 / self.max_rate:
+            # Woken up early by the loop's clock resolution.
+            self._arm()
+            return
+        while self._heap and self._heap[0][0] <= now:
+            _, _, scheduled = heapq.heappop(self._heap)
+            if scheduled.cancelled:
+                continue
+            scheduled.released = True
+            self._pending -= 1
+            self._last_release = now
+            self._track(run_in_context(scheduled.context, asyncio.ensure_future, self._send(scheduled)))
+            if self.max_rate:
+                break
+        self._arm()
+
+    async def _send(self, scheduled: ScheduledMessage) -> None:
+        try:
+            if scheduled.stored is not None:
+                # Don't read the message while it's being encoded.
+                await scheduled.stored
+            sent = await scheduled.message.send(self.fail_silently)
+        except Exception as exc:
+            if not scheduled.result.done():
+                scheduled.result.set_exception(exc)
+        else:
+            if not scheduled.result.done():
+                scheduled.result.set_result(sent)
+        finally:
+            if self.store is not None:
+                await self._unstore(scheduled)
+
+    async def _unstore(self, scheduled: ScheduledMessage) -> None:
+        """Remove a message from the store, once it's written, in the loop's default executor."""
+        if scheduled.stored is not None:
+            await asyncio.wait({scheduled.stored})
+        await asyncio.get_event_loop().run_in_executor(None, self.store.remove, scheduled.id)
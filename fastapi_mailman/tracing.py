@@ -0,0 +1,80 @@
+"""
+Optional tracing of the send pipeline, with OpenTelemetry compatible tracers.
+"""
+import typing as t
+
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6, where messages sent later are traced without the context of
+    # their caller.
+    contextvars = None
+
+if t.TYPE_CHECKING:
+    from . import Mail
+
+
+class NonRecordingSpan:
+    """The span yielded when tracing is disabled, which records nothing."""
+
+    def set_attribute(self, key: str, value: t.Any) -> None:
+        pass
+
+    def set_attributes(self, attributes: t.Dict[str, t.Any]) -> None:
+        pass
+
+    def __enter__(self) -> "NonRecordingSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+NON_RECORDING_SPAN = NonRecordingSpan()
+
+
+def get_tracer(tracer: t.Any = None) -> t.Any:
+    """
+    Return ``tracer``, or the OpenTelemetry tracer of this library if None.
+    Any object with OpenTelemetry's start_as_current_span() method will do.
+    """
+    if tracer is not None:
+        return tracer
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        raise RuntimeError('Tracing requires a tracer, or the opentelemetry-api package to be installed.')
+    return trace.get_tracer('fastapi_mailman')
+
+
+def start_span(mailman: t.Optional["Mail"], name: str, **attributes: t.Any) -> t.ContextManager[t.Any]:
+    """
+    Return a context manager opening a span named ``name`` as the current span,
+    with the tracer of the Mail object. It's a no-op unless tracing was enabled
+    with Mail.enable_tracing().
+    """
+    tracer = getattr(mailman, 'tracer', None)
+    if tracer is None:
+        return NON_RECORDING_SPAN
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def capture_context(mailman: t.Optional["Mail"]) -> t.Optional["contextvars.Context"]:
+    """
+    Return a copy of the current context if tracing is enabled, for a message
+    sent later or by another task to be traced in the context of its caller.
+    """
+    if contextvars is None or getattr(mailman, 'tracer', None) is None:
+        return None
+    return contextvars.copy_context()
+
+
+def run_in_context(context: t.Optional["contextvars.Context"], function: t.Callable, *args: t.Any) -> t.Any:
+    """
+    Call ``function`` in ``context``, e.g. to create a task that sends a
+    message in the context of the caller that submitted it, so that its spans
+    are children of the caller's span.
+    """
+    if context is None:
+        return function(*args)
+    return context.run(function, *args)
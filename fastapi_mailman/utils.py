@@ -2,7 +2,9 @@
 Email message and email sending related helper functions.
 """
 import datetime
+import functools
 import socket
+import ssl
 from decimal import Decimal
 
 
@@ -21,6 +23,38 @@ class CachedDnsName:
 DNS_NAME = CachedDnsName()
 
 
+class ResumableSSLContext(ssl.SSLContext):
+    """
+    A client SSL context that resumes the last TLS session saved for a server,
+    so reconnecting to the same relay skips the full handshake.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sessions = {}
+
+    def save_session(self, server_hostname, ssl_object):
+        """Remember the session of an established connection for later reuse."""
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[server_hostname] = ssl_object.session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+def create_ssl_context(keyfile=None, certfile=None, validate_certs=True):
+    """Build a client SSL context, loading the client certificate if any."""
+    context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    if not validate_certs:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile=keyfile)
+    return context
+
+
 class FastapiUnicodeDecodeError(UnicodeDecodeError):
     def __init__(self, obj, *args):
         self.obj = obj
@@ -69,6 +103,29 @@ def force_str(s, encoding='utf-8', strings_only=False, errors='strict'):
     return s
 
 
+@functools.lru_cache(maxsize=1024)
 def punycode(domain):
     """Return the Punycode of the given domain if it's non-ASCII."""
     return domain.encode('idna').decode('ascii')
+
+
+async def aiterate(iterable):
+    """Iterate over a sync or async iterable asynchronously."""
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def achunks(iterable, size):
+    """Yield lists of up to ``size`` items of a sync or async iterable."""
+    chunk = []
+    async for item in aiterate(iterable):
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
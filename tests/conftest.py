@@ -1,3 +1,7 @@
+import asyncio
+import typing as t
+from pathlib import Path
+
 import pytest as pt
 from fastapi import FastAPI
 
@@ -35,3 +39,132 @@ def mail(config: "ConnectionConfig") -> "Mail":
 @pt.fixture(autouse=True)
 def capsys(capsys: "pt.CaptureFixture") -> "pt.CaptureFixture":
     return capsys
+
+
+class SMTPServer:
+    """
+    A minimal ESMTP server speaking just enough of the protocol for the SMTP
+    backend, recording the commands and messages it receives. With ``lmtp``,
+    it replies to the end of DATA once per recipient, with the reply of
+    ``data_replies`` for the recipient if any.
+    """
+
+    def __init__(self, extensions: t.Optional[t.List[str]] = None, lmtp: bool = False):
+        self.extensions = ["AUTH PLAIN LOGIN"] if extensions is None else extensions
+        self.lmtp = lmtp
+        self.data_replies: t.Dict[str, str] = {}
+        self.commands: t.List[str] = []
+        self.messages: t.List[bytes] = []
+        self.connections = 0
+        self.replies: t.Dict[str, str] = {}
+        self.server: t.Optional[asyncio.AbstractServer] = None
+        self.writers: t.List[asyncio.StreamWriter] = []
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0, limit=2**24)
+
+    async def start_unix(self, path: str) -> None:
+        self.server = await asyncio.start_unix_server(self.handle, path, limit=2**24)
+
+    def disconnect(self) -> None:
+        """Drop every client connection."""
+        for writer in self.writers:
+            writer.close()
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        self.writers.append(writer)
+        writer.write(b"220 localhost ESMTP\r\n")
+        recipients: t.List[str] = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode("utf-8", "replace").rstrip("\r\n")
+            self.commands.append(command)
+            verb = command.split(" ", 1)[0].upper()
+            if verb in self.replies:
+                writer.write(self.replies[verb].encode() + b"\r\n")
+                if self.replies[verb].startswith("421"):
+                    await writer.drain()
+                    break
+            elif verb in ("EHLO", "LHLO"):
+                lines = ["localhost"] + self.extensions
+                reply = "".join("250-%s\r\n" % line for line in lines[:-1]) + "250 %s\r\n" % lines[-1]
+                writer.write(reply.encode())
+            elif verb == "AUTH":
+                writer.write(b"235 Authentication successful\r\n")
+            elif verb == "DATA":
+                writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data = await reader.readuntil(b"\r\n.\r\n")
+                self.messages.append(data[: -len(b".\r\n")])
+                if self.lmtp:
+                    for recipient in recipients:
+                        writer.write(self.data_replies.get(recipient, "250 OK delivered").encode() + b"\r\n")
+                else:
+                    writer.write(b"250 OK queued\r\n")
+            elif verb == "QUIT":
+                writer.write(b"221 Bye\r\n")
+                await writer.drain()
+                break
+            else:
+                if verb == "MAIL":
+                    recipients = []
+                elif verb == "RCPT":
+                    recipients.append(command.split(":", 1)[1].split(">")[0].strip(" <"))
+                writer.write(b"250 OK\r\n")
+            await writer.drain()
+        writer.close()
+
+
+@pt.fixture
+async def smtp_server() -> t.AsyncIterator[SMTPServer]:
+    server = SMTPServer()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pt.fixture
+async def other_smtp_server() -> t.AsyncIterator[SMTPServer]:
+    server = SMTPServer()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pt.fixture
+async def dead_port() -> int:
+    """A local port nothing listens on."""
+    server = SMTPServer()
+    await server.start()
+    port = server.port
+    await server.stop()
+    return port
+
+
+@pt.fixture
+async def lmtp_server(tmp_path: "Path") -> t.AsyncIterator[SMTPServer]:
+    """An LMTP server listening on the Unix socket ``lmtp.sock`` of tmp_path."""
+    server = SMTPServer(extensions=["PIPELINING"], lmtp=True)
+    await server.start_unix(str(tmp_path / "lmtp.sock"))
+    yield server
+    await server.stop()
+
+
+@pt.fixture
+def smtp_mail(mail: "Mail", smtp_server: SMTPServer) -> "Mail":
+    mail.backend = "smtp"
+    mail.server = "127.0.0.1"
+    mail.port = smtp_server.port
+    mail.use_tls = False
+    mail.use_ssl = False
+    return mail
@@ -0,0 +1,63 @@
+import pickle
+import typing as t
+from unittest import mock
+
+from fastapi_mailman import EmailMessage, SanitizedAddress, validate_recipients
+from fastapi_mailman.message import sanitize_address
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+
+def test_validate_recipients():
+    result = validate_recipients(
+        [
+            "to@example.com",
+            "Jöhn <john@exämple.com>",
+            ("Other", "other@example.com"),
+            "Again <to@EXAMPLE.com>",
+            "no-domain",
+            "to@-example.com",
+            "two words@example.com",
+            ("Two", "two words@example.com"),
+            ("Angle", "<x>@example.com"),
+            ("Named", "Name <named@example.com>"),
+            ("Jö", "jö@example.com"),
+        ]
+    )
+    assert result.valid == [
+        "to@example.com",
+        "Jöhn <john@exämple.com>",
+        "Other <other@example.com>",
+        "Jö <jö@example.com>",
+    ]
+    assert [entry for entry, reason in result.invalid] == [
+        "no-domain",
+        "to@-example.com",
+        "two words@example.com",
+        ("Two", "two words@example.com"),
+        ("Angle", "<x>@example.com"),
+        ("Named", "Name <named@example.com>"),
+    ]
+    assert result.duplicates == 1
+
+    john = result.valid[1]
+    assert (john.display_name, john.local_part, john.idna_domain) == ("Jöhn", "john", "xn--exmple-cua.com")
+    for smtputf8 in (False, True):
+        assert sanitize_address(john, "utf-8", smtputf8) == sanitize_address(str(john), "utf-8", smtputf8)
+    assert pickle.loads(pickle.dumps(john)).idna_domain == "xn--exmple-cua.com"
+    assert validate_recipients(["a@example.com", "a@example.com"], dedupe=False).valid == ["a@example.com"] * 2
+
+
+def test_validated_addresses_are_not_parsed_again(mail: "Mail"):
+    recipients = validate_recipients(["to@example.com", "Jöhn <john@exämple.com>"]).valid
+    message = EmailMessage(subject="testing", body="testing", to=recipients, mailman=mail)
+    with mock.patch("fastapi_mailman.message.parser.get_mailbox") as get_mailbox:
+        msg = message.message()
+        assert [sanitize_address(addr, "utf-8") for addr in message.recipients()] == [
+            "to@example.com",
+            "=?utf-8?b?SsO2aG4=?= <john@xn--exmple-cua.com>",
+        ]
+    get_mailbox.assert_not_called()
+    assert msg["To"] == "to@example.com, =?utf-8?b?SsO2aG4=?= <john@xn--exmple-cua.com>"
+    assert isinstance(SanitizedAddress.validate(recipients[0]), SanitizedAddress)
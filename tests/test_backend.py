@@ -27,6 +27,17 @@ async def test_console_backend(mail: "Mail", capsys: "pt.CaptureFixture"):
     assert "To: to@example.com" in captured.out
 
 
+@pt.mark.anyio
+async def test_console_backend_fail_silently(mail: "Mail", capsys: "pt.CaptureFixture"):
+    messages = [EmailMessage(subject=subject, to=["to@example.com"], body="testing") for subject in ("a\nb", "c")]
+    sent = await mail.get_connection('console', fail_silently=True).send_messages(messages)
+
+    assert sent == 1
+    assert [result.sent for result in sent.results] == [False, True]
+    assert isinstance(sent.failed[0].error, ValueError)
+    assert "Subject: c" in capsys.readouterr().out
+
+
 @pt.mark.anyio
 async def test_dummy_backend(mail: "Mail"):
     mail.backend = 'dummy'
@@ -65,7 +76,9 @@ async def test_locmem_backend(mail: "Mail"):
         to=["to@example.com"],
         body="testing",
     )
-    await msg.send()
+    sent = await msg.send()
+    assert sent == 1
+    assert [recipient.address for recipient in sent.results[0].recipients] == ["to@example.com"]
 
     assert len(mail.outbox) == 1
     sent_msg = mail.outbox[0]
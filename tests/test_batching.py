@@ -0,0 +1,103 @@
+import asyncio
+import typing as t
+from unittest import mock
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage
+from fastapi_mailman.backends import locmem
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pt.mark.anyio
+async def test_concurrent_send_mail_share_a_connection(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_mail.enable_batching(max_delay=0.01)
+    results = await asyncio.gather(
+        *(smtp_mail.send_mail("testing", "testing %d" % i, None, ["to@example.com"]) for i in range(5))
+    )
+
+    assert results == [1, 1, 1, 1, 1]
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 5
+
+
+@pt.mark.anyio
+async def test_batch_flushed_when_full(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_mail.enable_batching(max_batch_size=2, max_delay=10)
+    results = await asyncio.gather(
+        *(smtp_mail.send_mail("testing", "testing", None, ["to@example.com"]) for i in range(4))
+    )
+
+    assert results == [1, 1, 1, 1]
+    assert smtp_server.connections == 2
+
+
+@pt.mark.anyio
+async def test_batch_failure_reaches_every_caller(mail: "Mail"):
+    mail.backend = "locmem"
+    sender = mail.enable_batching(max_delay=0.01)
+    ok = sender.submit(_message(mail, "testing"))
+    bad = sender.submit(_message(mail, "testing\n"))
+
+    assert await ok == 1
+    with pt.raises(ValueError):
+        await bad
+
+
+@pt.mark.anyio
+async def test_shutdown_flushes_pending_batch(mail: "Mail"):
+    mail.backend = "locmem"
+    sender = mail.enable_batching(max_delay=10)
+    future = sender.submit(_message(mail, "testing"))
+
+    assert await mail.shutdown(timeout=1) is True
+    assert future.result() == 1
+    assert len(mail.outbox) == 1
+
+
+@pt.mark.anyio
+async def test_batch_caller_cancelled_while_sending(mail: "Mail"):
+    sending = asyncio.Event()
+    send_messages = locmem.EmailBackend.send_messages
+
+    async def slow_send_messages(self, messages):
+        sending.set()
+        await asyncio.sleep(0.01)
+        return await send_messages(self, messages)
+
+    mail.enable_batching(max_delay=0.01)
+    with mock.patch.object(locmem.EmailBackend, "send_messages", slow_send_messages):
+        callers = [
+            asyncio.ensure_future(mail.send_mail("testing %d" % i, "testing", None, ["to@example.com"]))
+            for i in range(3)
+        ]
+        await sending.wait()
+        callers[0].cancel()
+
+        assert await asyncio.wait_for(asyncio.gather(*callers[1:]), 1) == [1, 1]
+    assert [message.subject for message in mail.outbox] == ["testing 0", "testing 1", "testing 2"]
+
+
+def _message(mail: "Mail", subject: str) -> EmailMessage:
+    return EmailMessage(subject=subject, to=["to@example.com"], body="testing", mailman=mail)
+
+
+@pt.mark.anyio
+async def test_keep_alive_connection_kept_between_batches(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_mail.keep_alive = True
+    smtp_mail.enable_batching(max_delay=0.01)
+    assert await smtp_mail.send_mail("testing", "testing", None, ["to@example.com"]) == 1
+    assert await smtp_mail.send_mail("testing", "testing", None, ["to@example.com"]) == 1
+
+    assert smtp_server.connections == 1
+    await smtp_mail.shutdown()
+    assert "QUIT" in smtp_server.commands
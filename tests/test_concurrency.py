@@ -0,0 +1,81 @@
+import typing as t
+
+import aiosmtplib
+import pytest as pt
+
+from fastapi_mailman import AIMDLimiter, EmailMessage
+from fastapi_mailman.concurrency import is_throttling
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def test_limiter_increase():
+    limiter = AIMDLimiter(initial_limit=2, max_limit=4)
+    for _ in range(3):
+        limiter.on_success(0.1)
+    assert limiter.limit == 3
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.limit == 4
+
+
+def test_limiter_decrease():
+    limiter = AIMDLimiter(initial_limit=16)
+    limiter.on_success(60)
+    limiter.on_throttle()
+    assert limiter.limit == 8
+    # Part of the same congestion event.
+    limiter.on_throttle()
+    assert limiter.limit == 8
+
+
+def test_limiter_latency():
+    limiter = AIMDLimiter(initial_limit=16)
+    limiter.on_success(0.01)
+    limiter.on_success(1)
+    assert limiter.limit == 8
+
+
+def test_is_throttling():
+    assert is_throttling(aiosmtplib.SMTPResponseException(421, "Too many connections"))
+    assert is_throttling(aiosmtplib.SMTPSenderRefused(451, "Try again later", "from@example.com"))
+    assert is_throttling(aiosmtplib.SMTPTimeoutError("Timed out"))
+    assert not is_throttling(aiosmtplib.SMTPResponseException(550, "No such user"))
+    assert not is_throttling(ValueError())
+    refused = [aiosmtplib.SMTPRecipientRefused(452, "Too many recipients", "to@example.com")]
+    assert is_throttling(aiosmtplib.SMTPRecipientsRefused(refused))
+
+
+@pt.mark.anyio
+async def test_adaptive_sender(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    sender = smtp_mail.adaptive_sender(limiter=AIMDLimiter(initial_limit=2, latency_tolerance=None))
+    messages = (EmailMessage("subject %d" % i, "body", to=["to@example.com"], mailman=smtp_mail) for i in range(10))
+
+    assert await sender.send_messages(messages) == 10
+    assert len(smtp_server.messages) == 10
+    assert 1 < smtp_server.connections <= 4
+    assert sender.limit == 4
+    assert sender.limiter.in_flight == 0
+
+
+@pt.mark.anyio
+async def test_adaptive_sender_throttled(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_server.replies["MAIL"] = "451 Try again later"
+    messages = [EmailMessage("subject", "body", to=["to@example.com"], mailman=smtp_mail) for _ in range(3)]
+    sender = smtp_mail.adaptive_sender(limiter=AIMDLimiter(initial_limit=8), max_retries=1)
+
+    with pt.raises(aiosmtplib.SMTPSenderRefused):
+        await sender.send_messages(messages)
+    assert sender.limit < 8
+    assert sender.limiter.in_flight == 0
+
+    sender.fail_silently = True
+    assert await sender.send_messages(messages) == 0
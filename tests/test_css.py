@@ -0,0 +1,77 @@
+import typing as t
+
+from fastapi_mailman import CSSInliner, EmailMultiAlternatives
+from fastapi_mailman.css import parse_stylesheet
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+
+def test_inline_css():
+    document = (
+        "<html><head><style>"
+        "p, td.cell { color: #333; font-family: 'Helvetica Neue', Arial }"
+        ".content > p { font-size: 14px }"
+        "#main p.lead { font-size: 18px !important }"
+        "a:hover { color: red }"
+        "@media (max-width: 600px) { .content { padding: 0 } }"
+        "</style></head><body>"
+        '<div id="main" class="content"><p class="lead" style="font-size: 12px; color: blue">Hi</p>'
+        "<div><p>Nested<br/></p></div><!-- <p>Commented</p> --><script>var p = '<p>';</script></div>"
+        "</body></html>"
+    )
+    assert CSSInliner().inline(document) == (
+        '<html><head><style type="text/css">a:hover { color: red }\n'
+        "@media (max-width: 600px) { .content { padding: 0 } }</style></head><body>"
+        '<div id="main" class="content">'
+        '<p class="lead" style="color: blue; font-family: &#x27;Helvetica Neue&#x27;, Arial; font-size: 18px">Hi</p>'
+        '<div><p style="color: #333; font-family: &#x27;Helvetica Neue&#x27;, Arial">Nested<br/></p></div>'
+        "<!-- <p>Commented</p> --><script>var p = '<p>';</script></div>"
+        "</body></html>"
+    )
+
+
+def test_inline_css_implied_end_tags():
+    inliner = CSSInliner(
+        stylesheets=["ul > li { color: red }", "tr > td { padding: 0 }", "div > p { margin: 0 }", "p span { a: b }"]
+    )
+    assert inliner.inline("<ul><li>one<li>two<ul><li>three</ul><li>four</ul>") == (
+        '<ul><li style="color: red">one<li style="color: red">two'
+        '<ul><li style="color: red">three</ul><li style="color: red">four</ul>'
+    )
+    assert inliner.inline("<table><tr><td>1<td>2<tr><td>3</table>") == (
+        '<table><tr><td style="padding: 0">1<td style="padding: 0">2<tr><td style="padding: 0">3</table>'
+    )
+    assert inliner.inline("<div><p>one<p>two<div><span>three</span></div></div>") == (
+        '<div><p style="margin: 0">one<p style="margin: 0">two<div><span>three</span></div></div>'
+    )
+
+
+def test_inline_css_cached():
+    inliner = CSSInliner(stylesheets=["td.price { text-align: right }", "td[data-total] { font-weight: bold }"])
+
+    def render(price: str) -> str:
+        return '<table><tr><td class="price" data-total>%s</td><td>Total</td></tr></table>' % price
+
+    assert inliner.inline(render("1.00")) == (
+        '<table><tr><td class="price" data-total style="text-align: right; font-weight: bold">1.00</td>'
+        "<td>Total</td></tr></table>"
+    )
+    stylesheet = parse_stylesheet(inliner.stylesheets)
+    cached = stylesheet._nodes
+    assert "2.00" in inliner.inline(render("2.00"))
+    # The elements were matched with the first document.
+    assert stylesheet._nodes == cached
+
+
+def test_attach_alternative_inlines_css(mail: "Mail"):
+    message = EmailMultiAlternatives(to=["to@example.com"], mailman=mail)
+    message.attach_alternative("<style>p { margin: 0 }</style><p>Hi</p>", "text/html")
+    assert message.alternatives[-1][0] == "<style>p { margin: 0 }</style><p>Hi</p>"
+
+    mail.enable_css_inlining()
+    message.attach_alternative("<style>p { margin: 0 }</style><p>Hi</p>", "text/html")
+    assert message.alternatives[-1][0] == '<p style="margin: 0">Hi</p>'
+    message.inline_css = False
+    message.attach_alternative("<style>p { margin: 0 }</style><p>Hi</p>", "text/html")
+    assert message.alternatives[-1][0] == "<style>p { margin: 0 }</style><p>Hi</p>"
@@ -1,7 +1,10 @@
 import typing as t
 
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, Mail, get_mail, mail_dependency
+
 if t.TYPE_CHECKING:
-    from fastapi_mailman import Mail
     from fastapi_mailman.config import ConnectionConfig
 
 
@@ -9,3 +12,31 @@ def test_init_mail(mail: "Mail", config: "ConnectionConfig"):
     new_mail = mail.init_mail(config)
 
     assert mail.state.__dict__ == new_mail.__dict__
+
+
+def test_named_mail_is_registered(mail: "Mail", config: "ConnectionConfig"):
+    tenant = Mail(config, name="tenant-a")
+
+    assert get_mail("tenant-a") is tenant
+    assert get_mail() is mail
+    assert mail_dependency("tenant-a")() is tenant
+
+
+def test_unknown_mail_name(mail: "Mail"):
+    with pt.raises(RuntimeError):
+        get_mail("unknown-tenant")
+
+
+@pt.mark.anyio
+async def test_send_with_named_mail(mail: "Mail", config: "ConnectionConfig"):
+    tenant = Mail(config, name="tenant-b")
+    tenant.backend = "locmem"
+    tenant.default_sender = "tenant@example.com"
+
+    msg = EmailMessage(subject="testing", to=["to@example.com"], body="testing", mailman="tenant-b")
+    await msg.send()
+    await tenant.send_mail("testing", "testing", None, ["to@example.com"])
+
+    assert len(tenant.outbox) == 2
+    assert tenant.outbox[0].from_email == "tenant@example.com"
+    assert not hasattr(mail, "outbox")
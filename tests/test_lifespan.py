@@ -0,0 +1,67 @@
+import asyncio
+import typing as t
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, MailLifespan
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pt.mark.anyio
+async def test_lifespan_warms_up_connections(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    async with smtp_mail.lifespan(app=None):
+        assert smtp_server.connections == 1
+        assert any(command.startswith("AUTH") for command in smtp_server.commands)
+
+        msg = EmailMessage(subject="testing", to=["to@example.com"], body="testing")
+        assert await msg.send() == 1
+
+        # The message went through the warm connection, no new one was opened.
+        assert smtp_server.connections == 1
+        assert len(smtp_server.messages) == 1
+
+
+@pt.mark.anyio
+async def test_lifespan_closes_unused_warm_connections(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    async with MailLifespan(smtp_mail, warm_connections=2):
+        assert sum(len(conns) for conns in smtp_mail.warm_connections.values()) == 2
+
+    assert smtp_mail.warm_connections == {}
+    assert smtp_server.commands.count("QUIT") == 2
+
+
+@pt.mark.anyio
+async def test_shutdown_waits_for_pending_sends(mail: "Mail"):
+    finished = []
+
+    async def slow_send():
+        with mail.track_send():
+            await asyncio.sleep(0.05)
+            finished.append(True)
+
+    task = asyncio.ensure_future(slow_send())
+    await asyncio.sleep(0)
+    assert await mail.shutdown(timeout=1) is True
+    assert finished == [True]
+    await task
+
+
+@pt.mark.anyio
+async def test_shutdown_deadline(mail: "Mail"):
+    async def stuck_send():
+        with mail.track_send():
+            await asyncio.sleep(1)
+
+    task = asyncio.ensure_future(stuck_send())
+    await asyncio.sleep(0)
+    assert await mail.shutdown(timeout=0.01) is False
+    task.cancel()
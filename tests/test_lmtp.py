@@ -0,0 +1,59 @@
+import typing as t
+
+import aiosmtplib
+import pytest as pt
+
+from fastapi_mailman import EmailMessage
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def make_message(mail: "Mail", **kwargs) -> EmailMessage:
+    kwargs.setdefault("to", ["to@example.com"])
+    return EmailMessage(subject="testing", body="testing", mailman=mail, **kwargs)
+
+
+@pt.mark.anyio
+async def test_send_over_unix_socket(mail: "Mail", lmtp_server: "SMTPServer", tmp_path: "Path"):
+    conn = mail.get_connection("lmtp", socket_path=str(tmp_path / "lmtp.sock"), lmtp=False)
+    assert await conn.send_messages([make_message(mail)]) == 1
+
+    assert lmtp_server.commands[0].startswith("EHLO ")
+    # No STARTTLS nor AUTH over the local socket.
+    assert not [command for command in lmtp_server.commands if command.startswith(("STARTTLS", "AUTH"))]
+    assert b"To: to@example.com" in lmtp_server.messages[0]
+
+
+@pt.mark.anyio
+@pt.mark.parametrize("streaming", [False, True])
+async def test_lmtp_recipient_status(mail: "Mail", lmtp_server: "SMTPServer", tmp_path: "Path", streaming: bool):
+    lmtp_server.data_replies["full@example.com"] = "452 4.2.2 Mailbox full"
+    mail.socket_path = str(tmp_path / "lmtp.sock")
+    mail.use_lmtp = True
+    conn = mail.get_connection("lmtp", streaming=streaming)
+    async with conn:
+        sent = await conn.send_messages([make_message(mail, to=["to@example.com", "full@example.com"])])
+        assert sent == 1
+        [result] = sent.results
+        assert [(recipient.address, recipient.code) for recipient in result.recipients] == [
+            ("to@example.com", 250),
+            ("full@example.com", 452),
+        ]
+        assert result.failed_recipients[0].reply == "4.2.2 Mailbox full"
+        assert sent.failed == [result]
+        assert await conn.send_messages([make_message(mail, to=["to@example.com"])]) == 1
+        with pt.raises(aiosmtplib.SMTPRecipientsRefused):
+            await conn.send_messages([make_message(mail, to=["full@example.com"])])
+
+    assert lmtp_server.commands[0].startswith("LHLO ")
+    assert len(lmtp_server.messages) == 3
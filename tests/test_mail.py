@@ -2,6 +2,8 @@ import typing as t
 
 import pytest as pt
 
+from fastapi_mailman import EmailMessage
+
 if t.TYPE_CHECKING:
     from fastapi_mailman import Mail
     from fastapi_mailman.config import ConnectionConfig
@@ -43,3 +45,31 @@ async def test_send_mass_mail(mail: "Mail"):
     assert msg2.to == ['second@test.com']
     assert msg2.body == "Here is another message"
     assert msg2.from_email == "from@example.com"
+
+
+@pt.mark.anyio
+async def test_send_mass_mail_async_iterable(mail: "Mail"):
+    mail.backend = "locmem"
+
+    async def datatuple():
+        for i in range(5):
+            yield ("Subject %d" % i, "Message %d" % i, "from@example.com", ["to%d@example.com" % i])
+
+    assert await mail.send_mass_mail(datatuple()) == 5
+    assert [msg.subject for msg in mail.outbox] == ["Subject %d" % i for i in range(5)]
+
+
+@pt.mark.anyio
+async def test_iter_send_mass_mail(mail: "Mail"):
+    mail.backend = "locmem"
+    datatuple = (("Subject %d" % i, "Message", "from@example.com", ["to@example.com"]) for i in range(5))
+
+    results = [sent async for sent in mail.iter_send_mass_mail(datatuple, chunk_size=2)]
+    assert results == [2, 2, 1]
+    assert len(mail.outbox) == 5
+
+
+@pt.mark.anyio
+async def test_dummy_backend_generator(mail: "Mail"):
+    connection = mail.get_connection(backend="dummy")
+    assert await connection.send_messages(EmailMessage("Subject", mailman=mail) for _ in range(3)) == 3
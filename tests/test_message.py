@@ -0,0 +1,273 @@
+import pickle
+import typing as t
+from base64 import encodebytes
+from email.mime.base import MIMEBase
+from tempfile import SpooledTemporaryFile
+from unittest import mock
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, EmailMultiAlternatives, MessageSpec
+from fastapi_mailman.message import AttachmentStore, decode_message, encode_message
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from fastapi_mailman import Mail
+
+
+@pt.mark.parametrize("size", [0, 1, 57, 58, 100_000])
+@pt.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_as_stream(mail: "Mail", size: int, linesep: str):
+    email = EmailMultiAlternatives("Grüße", "body\n.dot", to=["to@example.com"], mailman=mail)
+    email.attach_alternative("<p>body</p>", "text/html")
+    email.attach("file.bin", bytes(range(256)) * (size // 256) + b"x" * (size % 256), "application/octet-stream")
+    email.attach("file.txt", "content", "text/plain")
+    message = email.message()
+
+    stream = message.as_stream(linesep, chunk_size=1000)
+    chunks = list(stream)
+
+    assert b"".join(chunks) == message.as_bytes(linesep=linesep)
+    assert len(stream) == sum(len(chunk) for chunk in chunks)
+    assert max(len(chunk) for chunk in chunks) <= 1000 * 2
+
+
+@pt.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_as_stream_encoded_parts(mail: "Mail", linesep: str):
+    email = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", b"content", "application/octet-stream")
+    message = email.message()
+    message.preamble = "This is a multi-part message.\r\nIn MIME format."
+    message.epilogue = "Epilogue\n"
+    # An attachment whose payload was set already encoded.
+    message.get_payload(1)._payload = "Y29udGVu\ndA==\n"
+
+    assert b"".join(message.as_stream(linesep)) == message.as_bytes(linesep=linesep)
+
+
+def test_attachment_payload(mail: "Mail"):
+    email = EmailMultiAlternatives("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", b"\x00\x01\x02", "application/octet-stream")
+    attachment = email.message().get_payload()[1]
+
+    assert attachment.get_payload() == "AAEC\n"
+    assert attachment.get_payload(decode=True) == b"\x00\x01\x02"
+    attachment.content = b"\x03"
+    assert attachment.get_payload() == "Aw==\n"
+
+
+def test_attachment_encoded_once(mail: "Mail"):
+    email = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", b"\x00\x01\x02", "application/octet-stream")
+    message = email.message()
+
+    with mock.patch("fastapi_mailman.message.encodebytes", wraps=encodebytes) as encode:
+        message.as_bytes()
+        message.as_string()
+    assert encode.call_count == 1
+
+
+def test_spooled_attachments(mail: "Mail", tmp_path: "Path"):
+    content = bytes(range(256)) * 8
+    path = tmp_path / "report.pdf"
+    path.write_bytes(content)
+    mail.attachment_spool_threshold = 1000
+    email = EmailMultiAlternatives("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("small.bin", content[:1000], "application/octet-stream")
+    email.attach("large.bin", content, "application/octet-stream")
+    email.attach("large.txt", "x" * 2000, "text/plain")
+    email.attach_file(path)
+
+    small, large, text, report = email.attachments
+    assert small[1] == content[:1000]
+    assert isinstance(large[1], SpooledTemporaryFile) and large[1]._rolled
+    assert text[1] == "x" * 2000
+    assert isinstance(report[1], SpooledTemporaryFile) and report == ("report.pdf", report[1], "application/pdf")
+
+    message = email.message()
+    parts = message.get_payload()
+    assert parts[2].get_payload(decode=True) == content
+    assert parts[4].get_payload(decode=True) == content
+    assert b"".join(message.as_stream()) == message.as_bytes()
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pt.mark.anyio
+async def test_aattach_files(mail: "Mail", tmp_path: "Path"):
+    paths = [tmp_path / "report.pdf", tmp_path / "notes.txt", tmp_path / "data"]
+    paths[0].write_bytes(b"%PDF")
+    paths[1].write_text("notes")
+    paths[2].write_bytes(b"\xff")
+    (tmp_path / "body.html").write_text("<p>body</p>")
+    email = EmailMultiAlternatives("subject", "body", to=["to@example.com"], mailman=mail)
+
+    await email.aattach_files(paths)
+    await email.aattach_file(paths[1], "text/csv")
+    await email.aattach_alternative_file(tmp_path / "body.html")
+
+    assert email.attachments == [
+        ("report.pdf", b"%PDF", "application/pdf"),
+        ("notes.txt", "notes", "text/plain"),
+        ("data", b"\xff", "application/octet-stream"),
+        ("notes.txt", "notes", "text/csv"),
+    ]
+    assert email.alternatives == [("<p>body</p>", "text/html")]
+
+
+def test_message_spec(mail: "Mail"):
+    email = EmailMultiAlternatives(
+        "subject", "body", cc=["cc@example.com"], headers={"X-Tag": "1"}, to=["to@example.com"], mailman=mail
+    )
+    email.attach_alternative("<p>body</p>", "text/html")
+    email.attach("file.bin", b"content", "application/octet-stream")
+    spec = email.to_spec()
+
+    assert spec.to == ("to@example.com",)
+    assert spec.headers == (("X-Tag", "1"),)
+    with pt.raises(AttributeError):
+        spec.subject = "other"
+    assert not hasattr(spec, "__dict__")
+    assert pickle.loads(pickle.dumps(spec)) == spec
+
+    copy = EmailMultiAlternatives.from_spec(spec, mailman=mail)
+    assert copy.to_spec() == spec
+    assert copy.message().as_bytes().count(b"Content-Type") == email.message().as_bytes().count(b"Content-Type")
+    with pt.raises(ValueError):
+        EmailMessage.from_spec(spec, mailman=mail)
+
+
+def test_message_spec_spooled_attachment(mail: "Mail"):
+    mail.attachment_spool_threshold = 10
+    email = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", b"spooled content", "application/octet-stream")
+    spec = email.to_spec()
+
+    assert isinstance(spec.attachments[0][1], SpooledTemporaryFile)
+    [attachment] = pickle.loads(pickle.dumps(spec)).attachments
+    assert attachment == ("file.bin", b"spooled content", "application/octet-stream")
+
+
+def test_encode_message(mail: "Mail"):
+    email = EmailMultiAlternatives(
+        "Grüße", "body", to=["to@example.com"], bcc=["bcc@example.com"], headers={"X-Tag": "1"}, mailman=mail
+    )
+    email.attach_alternative("<p>body</p>", "text/html")
+    email.attach("file.bin", bytes(range(256)), "application/octet-stream")
+    email.attach("file.txt", "text", "text/plain")
+    part = MIMEBase("application", "x-custom")
+    part.set_payload("payload")
+    email.attach(part)
+
+    spec = decode_message(encode_message(email))
+
+    assert spec.attachments[:2] == email.to_spec().attachments[:2]
+    assert spec.attachments[2].get_content_type() == "application/x-custom"
+    assert spec.attachments[2].get_payload() == "payload"
+    for name in MessageSpec.__slots__:
+        if name != "attachments":
+            assert getattr(spec, name) == getattr(email.to_spec(), name)
+    assert b"x-custom" in EmailMultiAlternatives.from_spec(spec, mailman=mail).message().as_bytes()
+
+
+def test_encode_message_attachment_store(mail: "Mail", tmp_path: "Path"):
+    content = bytes(range(256)) * 100
+    email = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", content, "application/octet-stream")
+    store = AttachmentStore(tmp_path)
+
+    data = encode_message(email, store_attachment=store.store)
+    assert len(data) < 200
+    with pt.raises(ValueError):
+        decode_message(data)
+
+    spec = decode_message(data, load_attachment=store.load)
+    with spec.attachments[0][1] as file:
+        assert file.read() == content
+    assert encode_message(email, store_attachment=store.store) == data
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_decode_message_version(mail: "Mail"):
+    data = encode_message(EmailMessage("subject", mailman=mail))
+
+    with pt.raises(ValueError, match="version"):
+        decode_message(data[:4] + b"\x03" + data[5:])
+    # Version 1 had no inline images.
+    assert decode_message(data[:4] + b"\x01" + data[5:-1]) == decode_message(data)
+    with pt.raises(ValueError):
+        decode_message(b"garbage")
+
+
+def test_decode_message_truncated(mail: "Mail"):
+    email = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    email.attach("file.bin", b"content", "application/octet-stream")
+    data = encode_message(email)
+
+    for size in range(5, len(data)):
+        with pt.raises(ValueError, match="Truncated"):
+            decode_message(data[:size])
+
+
+def test_inline_images(mail: "Mail"):
+    logo = b"\x89PNG" + bytes(range(256)) * 10
+    messages = []
+    for name in ("one", "two"):
+        email = EmailMultiAlternatives("subject", "body", to=["%s@example.com" % name], mailman=mail)
+        cid = email.attach_inline_image(logo, "logo.png")
+        assert email.attach_inline_image(logo, "logo.png") == cid
+        email.attach_alternative('<img src="cid:%s">' % cid, "text/html")
+        email.attach("file.txt", "text", "text/plain")
+        messages.append(email)
+
+    assert messages[0].inline_images == messages[1].inline_images
+    message = messages[0].message()
+    assert [part.get_content_type() for part in message.walk()] == [
+        "multipart/mixed",
+        "multipart/alternative",
+        "text/plain",
+        "multipart/related",
+        "text/html",
+        "image/png",
+        "text/plain",
+    ]
+    image = list(message.walk())[5]
+    assert image["Content-ID"] == "<%s>" % cid
+    assert image["Content-Disposition"] == 'inline; filename="logo.png"'
+    assert image.get_payload(decode=True) == logo
+    # The encoded image is shared by the messages.
+    assert image._payload is list(messages[1].message().walk())[5]._payload
+    assert b"".join(message.as_stream("\r\n")) == message.as_bytes(linesep="\r\n")
+
+    spec = decode_message(encode_message(messages[0]))
+    assert spec == messages[0].to_spec()
+    with pt.raises(ValueError):
+        EmailMessage.from_spec(spec, mailman=mail)
+    copy = EmailMultiAlternatives.from_spec(spec, mailman=mail)
+    assert copy.message().as_bytes().count(b"Content-ID") == 1
+
+
+def test_inline_images_bytes_like(mail: "Mail"):
+    logo = b"GIF89a" + bytes(range(256))
+    email = EmailMultiAlternatives("subject", "body", to=["to@example.com"], mailman=mail)
+    cid = email.attach_inline_image(bytearray(logo), "logo.gif")
+    assert email.attach_inline_image(memoryview(logo), "logo.gif") == cid
+    email.attach_alternative('<img src="cid:%s">' % cid, "text/html")
+
+    [image] = [part for part in email.message().walk() if part.get_content_type() == "image/gif"]
+    assert image.get_payload(decode=True) == logo
+
+
+def test_inline_images_html_body(mail: "Mail"):
+    email = EmailMultiAlternatives("subject", mailman=mail, to=["to@example.com"])
+    email.content_subtype = "html"
+    cid = email.attach_inline_image(b"GIF89a", mimetype="image/gif", cid="logo")
+    email.body = '<img src="cid:%s">' % cid
+    message = email.message()
+    assert message.get_content_type() == "multipart/related"
+    assert [part.get_content_type() for part in message.get_payload()] == ["text/html", "image/gif"]
+    assert message.get_payload(1)["Content-ID"] == "<logo>"
@@ -0,0 +1,58 @@
+import asyncio
+import typing as t
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, Lane
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pt.mark.anyio
+async def test_high_priority_first(mail: "Mail"):
+    scheduler = mail.enable_priority_lanes(max_concurrency=1)
+    messages = [EmailMessage("bulk %d" % i, "body", to=["to@example.com"], mailman=mail) for i in range(3)]
+    futures = [scheduler.submit(message, "bulk") for message in messages]
+    urgent = EmailMessage("reset", "body", to=["to@example.com"], mailman=mail)
+    urgent.priority = "high"
+    futures.append(scheduler.submit(urgent))
+
+    assert await asyncio.gather(*futures) == [1, 1, 1, 1]
+    assert [message.subject for message in mail.outbox] == ["bulk 0", "reset", "bulk 1", "bulk 2"]
+
+
+@pt.mark.anyio
+async def test_lane_budgets(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    scheduler = smtp_mail.enable_priority_lanes([Lane("high", 2), Lane("bulk", 1)], default_lane="bulk")
+    messages = (EmailMessage("bulk %d" % i, "body", to=["to@example.com"], mailman=smtp_mail) for i in range(5))
+
+    sent, _ = await asyncio.gather(
+        scheduler.send_messages(messages),
+        smtp_mail.send_mail("reset", "body", None, ["to@example.com"], priority="high"),
+    )
+
+    assert sent == 5
+    assert len(smtp_server.messages) == 6
+    assert smtp_server.connections == 2
+    assert [len(lane.idle) for lane in scheduler.lanes] == [1, 1]
+    assert await smtp_mail.shutdown()
+    assert [len(lane.idle) for lane in scheduler.lanes] == [0, 0]
+
+
+@pt.mark.anyio
+async def test_unknown_priority(mail: "Mail"):
+    mail.enable_priority_lanes()
+    message = EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)
+    message.priority = "urgent"
+
+    with pt.raises(ValueError):
+        await message.send()
+    assert await message.send(fail_silently=True) == 0
@@ -0,0 +1,65 @@
+import io
+import typing as t
+
+import pytest as pt
+
+from fastapi_mailman import EmailMultiAlternatives, MessageProfiler, SlowMessageReport
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def make_message(mail: "Mail", subject: str = "subject") -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(subject, "body", to=["to@example.com"], mailman=mail)
+    message.attach_alternative("<p>body</p>", "text/html")
+    message.attach("file.bin", b"content", "application/octet-stream")
+    return message
+
+
+@pt.mark.anyio
+async def test_slow_message_report(smtp_mail: "Mail"):
+    profiler = smtp_mail.enable_profiling(sample_rate=1, threshold=0)
+    assert await make_message(smtp_mail).send() == 1
+
+    [report] = profiler.reports()
+    assert report.subject == "subject" and report.recipients == 1
+    assert set(report.steps) == {"message", "_create_alternatives", "_create_attachments", "as_bytes"}
+    assert report.steps["message"] >= report.steps["_create_attachments"]
+    assert report.size > 0 and report.duration >= sum(report.steps.values()) - report.steps["message"]
+    assert "(_build_message)" in report.stats
+    assert report.as_dict()["subject"] == "subject"
+
+
+@pt.mark.anyio
+async def test_sampling(mail: "Mail"):
+    mail.backend = "console"
+    profiler = mail.enable_profiling(sample_rate=0, threshold=0)
+    connection = mail.get_connection(stream=io.StringIO())
+    assert await connection.send_messages([make_message(mail)]) == 1
+    assert profiler.reports() == []
+
+    profiler.sample_rate = 1
+    profiler.threshold = 3600
+    assert await connection.send_messages([make_message(mail)]) == 1
+    assert profiler.reports() == []
+
+    profiler.threshold = 0
+    profiler.cprofile = False
+    assert await connection.send_messages([make_message(mail)]) == 1
+    [report] = profiler.reports()
+    assert "as_bytes" in report.steps and report.stats is None
+
+
+def test_top_n():
+    profiler = MessageProfiler(top_n=2)
+    for duration in [0.5, 3, 1, 2]:
+        profiler.add_report(SlowMessageReport("subject", 1, None, 0, duration, {}, None))
+
+    assert [report.duration for report in profiler.reports()] == [3, 2]
+    profiler.clear()
+    assert profiler.reports() == []
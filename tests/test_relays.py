@@ -0,0 +1,121 @@
+import typing as t
+
+import aiosmtplib
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, Relay, RelayPool
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def make_message(mail: "Mail") -> EmailMessage:
+    return EmailMessage(subject="testing", body="testing", to=["to@example.com"], mailman=mail)
+
+
+def test_parse_relay():
+    relay = Relay.parse("smtp1.example.com:587;weight=3")
+    assert (relay.host, relay.port, relay.weight) == ("smtp1.example.com", 587, 3)
+    relay = Relay.parse("smtp2.example.com", default_port=2525)
+    assert (relay.host, relay.port, relay.weight) == ("smtp2.example.com", 2525, 1)
+    with pt.raises(ValueError):
+        Relay.parse("smtp3.example.com;priority=1")
+
+
+def test_weighted_round_robin():
+    pool = RelayPool(["a;weight=3", "b"])
+    picks = [pool.candidates()[0].host for _ in range(8)]
+    # Smooth: the lighter relay isn't starved until the heavier one is done.
+    assert picks == ["a", "a", "b", "a"] * 2
+
+
+def test_least_outstanding():
+    pool = RelayPool(["a;weight=2", "b", "c"], strategy="least_outstanding")
+    a, b, c = pool.relays
+    a.outstanding, b.outstanding, c.outstanding = 3, 1, 2
+    assert pool.candidates() == [b, a, c]
+    pool.mark_failed(b)
+    assert pool.candidates() == [a, c, b]
+
+
+@pt.mark.anyio
+async def test_failover_on_connection_error(smtp_mail: "Mail", smtp_server: "SMTPServer", dead_port: int):
+    relays = RelayPool(["127.0.0.1:%d" % dead_port, "127.0.0.1:%d" % smtp_server.port])
+    dead, alive = relays.relays
+    conn = smtp_mail.get_connection(relays=relays)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert len(smtp_server.messages) == 1
+    assert not dead.is_healthy() and alive.is_healthy()
+    assert alive.outstanding == 0
+
+    # The dead relay is skipped until its retry interval elapses.
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert dead.failures == 1
+    assert len(smtp_server.messages) == 2
+
+
+@pt.mark.anyio
+async def test_failover_on_transient_reply(
+    smtp_mail: "Mail", smtp_server: "SMTPServer", other_smtp_server: "SMTPServer"
+):
+    smtp_server.replies["MAIL"] = "451 Try again later"
+    smtp_mail.relay_pool = RelayPool(["127.0.0.1:%d" % smtp_server.port, "127.0.0.1:%d" % other_smtp_server.port])
+    conn = smtp_mail.get_connection(host=None)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert not smtp_server.messages
+    assert len(other_smtp_server.messages) == 1
+    assert not smtp_mail.relay_pool.relays[0].is_healthy()
+
+
+@pt.mark.anyio
+async def test_failover_on_transient_recipient_replies(
+    smtp_mail: "Mail", smtp_server: "SMTPServer", other_smtp_server: "SMTPServer"
+):
+    smtp_server.replies["RCPT"] = "451 Local error in processing"
+    relays = RelayPool(["127.0.0.1:%d" % smtp_server.port, "127.0.0.1:%d" % other_smtp_server.port])
+    conn = smtp_mail.get_connection(relays=relays)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert not smtp_server.messages
+    assert len(other_smtp_server.messages) == 1
+    assert not relays.relays[0].is_healthy()
+
+
+@pt.mark.anyio
+async def test_permanent_reply_does_not_fail_over(
+    smtp_mail: "Mail", smtp_server: "SMTPServer", other_smtp_server: "SMTPServer"
+):
+    smtp_server.replies["MAIL"] = "550 Sender rejected"
+    relays = RelayPool(["127.0.0.1:%d" % smtp_server.port, "127.0.0.1:%d" % other_smtp_server.port])
+    conn = smtp_mail.get_connection(relays=relays, fail_silently=True)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 0
+    assert other_smtp_server.connections == 0
+    assert relays.relays[0].is_healthy()
+
+
+@pt.mark.anyio
+async def test_permanent_reply_closes_connection(
+    smtp_mail: "Mail", smtp_server: "SMTPServer", other_smtp_server: "SMTPServer"
+):
+    smtp_server.replies["AUTH"] = "535 Authentication failed"
+    relays = RelayPool(["127.0.0.1:%d" % smtp_server.port, "127.0.0.1:%d" % other_smtp_server.port])
+    conn = smtp_mail.get_connection(relays=relays)
+    with pt.raises(aiosmtplib.SMTPAuthenticationError):
+        await conn.open()
+    assert conn.connection is None
+    assert other_smtp_server.connections == 0
+
+
+@pt.mark.anyio
+async def test_every_relay_down(smtp_mail: "Mail", dead_port: int):
+    relays = ["127.0.0.1:%d" % dead_port, "127.0.0.1:%d" % dead_port]
+    with pt.raises(OSError):
+        await smtp_mail.get_connection(relays=relays).send_messages([make_message(smtp_mail)])
+    conn = smtp_mail.get_connection(relays=relays, fail_silently=True)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 0
@@ -0,0 +1,85 @@
+import pickle
+import typing as t
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, EmailMultiAlternatives, RenderedMessage
+from fastapi_mailman.rendering import RenderSettings, message_spec, render_messages
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def test_render_messages(mail: "Mail"):
+    message = EmailMultiAlternatives("subject", "body", to=["to@example.com"], bcc=["bcc@example.com"], mailman=mail)
+    message.attach_alternative("<p>body</p>", "text/html")
+    message.attach("file.txt", "content", "text/plain")
+    mail.attachment_spool_threshold = 10
+    message.attach("file.bin", b"binary content", "application/octet-stream")
+    settings = pickle.loads(pickle.dumps(RenderSettings.from_mailman(mail)))
+    specs = pickle.loads(pickle.dumps([message_spec(message)]))
+
+    [rendered] = pickle.loads(pickle.dumps(render_messages(settings, specs)))
+
+    assert isinstance(rendered, RenderedMessage)
+    assert rendered.from_email == mail.default_sender
+    assert rendered.to == ["to@example.com", "bcc@example.com"]
+    assert b"<p>body</p>" in rendered.data
+    assert b'filename="file.txt"' in rendered.data
+    assert b"YmluYXJ5IGNvbnRlbnQ=" in rendered.data
+    assert b"Bcc" not in rendered.data
+
+
+def test_render_messages_error(mail: "Mail"):
+    message = EmailMessage("bad\nsubject", "body", to=["to@example.com"], mailman=mail)
+    [result] = render_messages(RenderSettings.from_mailman(mail), [message_spec(message)])
+
+    assert isinstance(result, ValueError)
+
+
+@pt.mark.anyio
+async def test_send_mass_mail(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    datatuple = (("subject %d" % i, "body %d" % i, None, ["to%d@example.com" % i]) for i in range(7))
+    with smtp_mail.render_pipeline(max_workers=2, chunk_size=2, max_pending=2) as pipeline:
+        assert await pipeline.send_mass_mail(datatuple) == 7
+
+    assert smtp_server.connections == 1
+    assert [b"Subject: subject %d" % i in data for i, data in enumerate(smtp_server.messages)] == [True] * 7
+    rcpt = ["RCPT TO:<to%d@example.com>" % i for i in range(7)]
+    assert [c for c in smtp_server.commands if c.startswith("RCPT")] == rcpt
+
+
+@pt.mark.anyio
+async def test_send_messages_fail_silently(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    messages = [
+        EmailMessage("subject", "body", to=["to@example.com"], mailman=smtp_mail),
+        EmailMessage("bad\nsubject", "body", to=["to@example.com"], mailman=smtp_mail),
+    ]
+    with smtp_mail.render_pipeline(max_workers=1) as pipeline:
+        with pt.raises(ValueError):
+            await pipeline.send_messages(messages)
+        assert await pipeline.send_messages(messages, smtp_mail.get_connection(fail_silently=True)) == 1
+
+    smtp_server.replies["RCPT"] = "550 No such user"
+    messages = [EmailMessage("subject", "body", to=["to@example.com"], mailman=smtp_mail) for _ in range(3)]
+    with smtp_mail.render_pipeline(max_workers=1, chunk_size=2) as pipeline:
+        sent = await pipeline.send_messages(messages, smtp_mail.get_connection(fail_silently=True))
+    assert sent == 0
+    assert len(sent.failed) == 3
+
+
+@pt.mark.anyio
+async def test_send_messages_other_backend(mail: "Mail"):
+    messages = [EmailMessage("subject", "body", to=["to@example.com"], mailman=mail) for _ in range(3)]
+    with mail.render_pipeline() as pipeline:
+        assert await pipeline.send_messages(iter(messages)) == 3
+        assert pipeline.executor is None
+
+    assert mail.outbox == messages
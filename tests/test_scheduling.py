@@ -0,0 +1,134 @@
+import asyncio
+import datetime
+import threading
+import time
+import typing as t
+from unittest import mock
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage, ScheduleStore
+from fastapi_mailman.backends import locmem
+from fastapi_mailman.scheduling import to_timestamp
+
+if t.TYPE_CHECKING:
+    from pathlib import Path
+
+    from fastapi_mailman import Mail
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def test_to_timestamp():
+    when = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    assert to_timestamp(when) == when.timestamp()
+    assert to_timestamp(12.5) == 12.5
+    assert abs(to_timestamp(delay=datetime.timedelta(minutes=1)) - time.time() - 60) < 1
+    with pt.raises(ValueError):
+        to_timestamp(12.5, 10)
+
+
+@pt.mark.anyio
+async def test_schedule_order(mail: "Mail"):
+    now = time.time()
+    late = mail.schedule_mail("late", "body", None, ["to@example.com"], send_at=now + 0.04)
+    cancelled = mail.schedule_mail("cancelled", "body", None, ["to@example.com"], delay=0.01)
+    early = mail.schedule_mail("early", "body", None, ["to@example.com"], delay=datetime.timedelta(seconds=0.02))
+    assert len(mail.delayed_sender) == 3
+    assert cancelled.cancel()
+    assert not cancelled.cancel()
+    assert len(mail.delayed_sender) == 2
+
+    assert await asyncio.gather(early.result, late.result) == [1, 1]
+    assert [message.subject for message in mail.outbox] == ["early", "late"]
+    assert len(mail.delayed_sender) == 0
+
+
+@pt.mark.anyio
+async def test_cancel_while_sending(mail: "Mail"):
+    sending = asyncio.Event()
+    send_messages = locmem.EmailBackend.send_messages
+
+    async def slow_send_messages(self, messages):
+        sending.set()
+        await asyncio.sleep(0.01)
+        return await send_messages(self, messages)
+
+    with mock.patch.object(locmem.EmailBackend, "send_messages", slow_send_messages):
+        scheduled = mail.schedule_mail("released", "body", None, ["to@example.com"])
+        other = mail.schedule_mail("abandoned", "body", None, ["to@example.com"])
+        await sending.wait()
+        assert not scheduled.cancel()
+        assert len(mail.delayed_sender) == 0
+        # Nobody waits for it anymore.
+        other.result.cancel()
+
+        sends = set(mail.delayed_sender._tasks)
+        assert await scheduled.result == 1
+        assert await mail.delayed_sender.flush()
+    assert not any(send.exception() for send in sends)
+    assert [message.subject for message in mail.outbox] == ["released", "abandoned"]
+
+
+@pt.mark.anyio
+async def test_smooth_release(mail: "Mail"):
+    mail.enable_delayed_sending(max_rate=100)
+    scheduled = [mail.schedule(EmailMessage("subject", "body", to=["to@example.com"], mailman=mail)) for _ in range(5)]
+    start = time.monotonic()
+    await asyncio.gather(*(s.result for s in scheduled))
+
+    assert len(mail.outbox) == 5
+    assert time.monotonic() - start >= 0.035
+
+
+@pt.mark.anyio
+async def test_persistence(mail: "Mail", tmp_path: "Path"):
+    mail.enable_delayed_sending(store=ScheduleStore(tmp_path))
+    message = EmailMessage("digest", "body", to=["to@example.com"], mailman=mail)
+    message.priority = "bulk"
+    mail.schedule(message, delay=3600)
+    mail.schedule(EmailMessage("due", "body", to=["to@example.com"], mailman=mail), delay=0.01)
+    assert await mail.shutdown()
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # After a restart.
+    delayed_sender = mail.enable_delayed_sending(store=ScheduleStore(tmp_path))
+    await mail.startup(warm_connections=0)
+    assert len(delayed_sender) == 2
+    await asyncio.sleep(0.05)
+
+    assert [message.subject for message in mail.outbox] == ["due"]
+    [(_, _, digest)] = delayed_sender._heap
+    assert digest.message.subject == "digest" and digest.message.priority == "bulk"
+    assert len(list(tmp_path.iterdir())) == 1
+    delayed_sender.close()
+
+
+@pt.mark.anyio
+async def test_store_in_executor(mail: "Mail", tmp_path: "Path"):
+    threads = []
+
+    class Store(ScheduleStore):
+        def add(self, *args):
+            threads.append(threading.get_ident())
+            super().add(*args)
+
+        def remove(self, id):
+            threads.append(threading.get_ident())
+            super().remove(id)
+
+    mail.enable_delayed_sending(store=Store(tmp_path))
+    mail.attachment_spool_threshold = 10
+    message = EmailMessage("due", "body", to=["to@example.com"], mailman=mail)
+    message.attach("file.bin", b"spooled content", "application/octet-stream")
+    cancelled = mail.schedule(EmailMessage("cancelled", "body", to=["to@example.com"], mailman=mail), delay=3600)
+    assert cancelled.cancel()
+    assert await mail.schedule(message).result == 1
+    assert await mail.delayed_sender.flush()
+
+    assert len(threads) == 4 and threading.get_ident() not in threads
+    assert not list(tmp_path.iterdir())
+    assert mail.outbox == [message]
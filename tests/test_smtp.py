@@ -0,0 +1,217 @@
+import asyncio
+import email
+import typing as t
+
+import aiosmtplib
+import pytest as pt
+
+from fastapi_mailman import EmailMessage
+from fastapi_mailman.errors import MessageTooLarge
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def make_message(mail: "Mail", **kwargs) -> EmailMessage:
+    kwargs.setdefault("subject", "testing")
+    kwargs.setdefault("to", ["to@example.com"])
+    kwargs.setdefault("body", "testing")
+    return EmailMessage(mailman=mail, **kwargs)
+
+
+@pt.mark.anyio
+async def test_send_messages(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection()
+    assert await conn.send_messages([make_message(smtp_mail), make_message(smtp_mail)]) == 2
+
+    assert len(smtp_server.messages) == 2
+    assert b"To: to@example.com" in smtp_server.messages[0]
+    assert "QUIT" in smtp_server.commands
+    assert conn.connection is None
+
+
+@pt.mark.anyio
+async def test_keep_alive_reuses_connection(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(keep_alive=True)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    assert "RSET" in smtp_server.commands
+    assert "QUIT" not in smtp_server.commands
+    await conn.close()
+    assert "QUIT" in smtp_server.commands
+
+
+@pt.mark.anyio
+async def test_keep_alive_reconnects(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(keep_alive=True)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+
+    smtp_server.replies["RSET"] = "421 Closing connection"
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 2
+    await conn.close()
+
+
+@pt.mark.anyio
+async def test_keep_alive_reconnects_dropped_connection(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(keep_alive=True)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+
+    smtp_server.disconnect()
+    await asyncio.sleep(0.01)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert smtp_server.connections == 2
+    await conn.close()
+
+
+@pt.mark.anyio
+async def test_keep_alive_idle_timeout(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(keep_alive=True, idle_timeout=0.1, noop_interval=0.03)
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+
+    await asyncio.sleep(0.2)
+    assert "NOOP" in smtp_server.commands
+    assert "QUIT" in smtp_server.commands
+    assert conn.connection is None
+
+
+@pt.mark.anyio
+async def test_smtputf8(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_server.extensions.extend(["8BITMIME", "SMTPUTF8"])
+    conn = smtp_mail.get_connection(use_smtputf8=True)
+    message = make_message(smtp_mail, subject="Grüße", body="Grüße", to=["jörg@exämple.com"])
+    assert await conn.send_messages([message]) == 1
+
+    data = smtp_server.messages[0]
+    assert "Subject: Grüße".encode() in data
+    assert "To: jörg@exämple.com".encode() in data
+    assert b"Content-Transfer-Encoding: 8bit" in data
+    assert "Grüße".encode() in data
+    assert "RCPT TO:<jörg@exämple.com>" in smtp_server.commands
+    assert any(c.startswith("MAIL FROM:") and "SMTPUTF8" in c and "BODY=8BITMIME" in c for c in smtp_server.commands)
+
+
+@pt.mark.anyio
+async def test_smtputf8_unsupported(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(use_smtputf8=True)
+    assert await conn.send_messages([make_message(smtp_mail, subject="Grüße")]) == 1
+
+    data = smtp_server.messages[0]
+    assert b"Subject: =?utf-8?" in data
+    assert all("SMTPUTF8" not in c and "8BITMIME" not in c for c in smtp_server.commands)
+
+
+@pt.mark.anyio
+async def test_size_limit(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_server.extensions.append("SIZE 1000")
+    conn = smtp_mail.get_connection()
+    assert await conn.send_messages([make_message(smtp_mail)]) == 1
+    assert any(c.startswith("MAIL FROM:") and "SIZE=" in c.upper() for c in smtp_server.commands)
+
+    smtp_server.commands.clear()
+    with pt.raises(MessageTooLarge) as excinfo:
+        await conn.send_messages([make_message(smtp_mail, body="x" * 1000)])
+    assert excinfo.value.limit == 1000
+    assert excinfo.value.size > 1000
+    assert not any(c.startswith("MAIL FROM:") for c in smtp_server.commands)
+    assert len(smtp_server.messages) == 1
+
+    conn = smtp_mail.get_connection(fail_silently=True)
+    assert await conn.send_messages([make_message(smtp_mail, body="x" * 1000)]) == 0
+
+
+@pt.mark.anyio
+async def test_send_results(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    conn = smtp_mail.get_connection(fail_silently=True)
+    sent = await conn.send_messages([make_message(smtp_mail, to=["a@example.com", "b@example.com"])])
+    assert sent == 1
+    [result] = sent.results
+    assert result.sent and result.reply == "OK queued"
+    assert [(r.address, r.code) for r in result.recipients] == [("a@example.com", 250), ("b@example.com", 250)]
+    assert result.duration > 0
+    assert not sent.failed
+
+    smtp_server.replies["RCPT"] = "450 Mailbox unavailable"
+    message = make_message(smtp_mail)
+    sent = await conn.send_messages([message])
+    assert sent == 0
+    [result] = sent.failed
+    assert result.message is message
+    assert isinstance(result.error, aiosmtplib.SMTPRecipientsRefused)
+    [recipient] = result.failed_recipients
+    assert (recipient.address, recipient.code, recipient.transient) == ("to@example.com", 450, True)
+
+
+@pt.mark.anyio
+async def test_send_results_open_failed(smtp_mail: "Mail", dead_port: int):
+    messages = [make_message(smtp_mail), make_message(smtp_mail)]
+    sent = await smtp_mail.get_connection(port=dead_port, fail_silently=True).send_messages(messages)
+    assert sent == 0
+    assert [result.message for result in sent.failed] == messages
+    assert all(isinstance(result.error, OSError) for result in sent.results)
+
+
+@pt.mark.anyio
+async def test_iter_send_mass_mail_failed_chunk(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_server.replies["RCPT"] = "550 No such user"
+    datatuple = [("subject %d" % i, "body", None, ["to@example.com"]) for i in range(3)]
+
+    results = [sent async for sent in smtp_mail.iter_send_mass_mail(datatuple, fail_silently=True, chunk_size=2)]
+
+    assert results == [0, 0]
+    assert [len(sent.failed) for sent in results] == [2, 1]
+
+
+@pt.mark.anyio
+async def test_iter_send_mass_mail(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    async def datatuple():
+        for i in range(5):
+            yield ("subject %d" % i, "body", None, ["to@example.com"])
+
+    results = [sent async for sent in smtp_mail.iter_send_mass_mail(datatuple(), chunk_size=2)]
+
+    assert results == [2, 2, 1]
+    assert len(smtp_server.messages) == 5
+    assert smtp_server.connections == 1
+    assert smtp_server.commands.count("QUIT") == 1
+
+
+@pt.mark.anyio
+async def test_streaming(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    smtp_server.extensions.append("SIZE 10000000")
+    content = bytes(range(256)) * 4000
+    message = make_message(smtp_mail, body=".leading dot\n..two\nend.")
+    message.attach("file.bin", content, "application/octet-stream")
+    conn = smtp_mail.get_connection(streaming=True)
+    assert await conn.send_messages([message]) == 1
+
+    data = smtp_server.messages[0]
+    assert b"\r\n..leading dot\r\n...two\r\nend.\r\n" in data
+    parsed = email.message_from_bytes(data.replace(b"\r\n..", b"\r\n."))
+    assert parsed.get_payload()[1].get_payload(decode=True) == content
+    [mail_from] = [c for c in smtp_server.commands if c.startswith("MAIL FROM:")]
+    assert "SIZE=%d" % len(data.replace(b"\r\n..", b"\r\n.")) in mail_from
+
+    smtp_server.extensions[-1] = "SIZE 1000"
+    with pt.raises(MessageTooLarge):
+        await conn.send_messages([message])
+
+
+def test_ssl_context_cached(mail: "Mail"):
+    context = mail.get_ssl_context()
+
+    assert mail.get_ssl_context() is context
+    assert mail.get_ssl_context(validate_certs=False) is not context
+    assert mail.get_connection(backend="smtp").tls_context is context
+    assert mail.get_connection(backend="smtp", validate_certs=False).tls_context is not context
@@ -0,0 +1,88 @@
+import asyncio
+import contextlib
+import contextvars
+import typing as t
+
+import pytest as pt
+
+from fastapi_mailman import EmailMessage
+
+if t.TYPE_CHECKING:
+    from fastapi_mailman import Mail
+
+    from .conftest import SMTPServer
+
+
+@pt.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+class Span:
+    def __init__(self, name: str, attributes: t.Dict[str, t.Any], parent: t.Optional["Span"]):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.parent = parent
+
+    def set_attribute(self, key: str, value: t.Any) -> None:
+        self.attributes[key] = value
+
+
+class Tracer:
+    """Records spans like an OpenTelemetry tracer, with their parents."""
+
+    def __init__(self):
+        self.spans: t.List[Span] = []
+        self.current: contextvars.ContextVar[t.Optional[Span]] = contextvars.ContextVar("span", default=None)
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name: str, attributes: t.Dict[str, t.Any]) -> t.Iterator[Span]:
+        span = Span(name, attributes, self.current.get())
+        self.spans.append(span)
+        token = self.current.set(span)
+        try:
+            yield span
+        finally:
+            self.current.reset(token)
+
+    def names(self, parent: t.Optional[Span] = None) -> t.List[str]:
+        return [span.name for span in self.spans if span.parent is parent]
+
+
+@pt.mark.anyio
+async def test_send_spans(smtp_mail: "Mail"):
+    tracer = smtp_mail.enable_tracing(Tracer())
+    message = EmailMessage("subject", "body", to=["to@example.com"], cc=["cc@example.com"], mailman=smtp_mail)
+    assert await message.send() == 1
+
+    [send] = tracer.spans[:1]
+    assert send.name == "mail.send" and send.attributes == {"mail.recipients": 2}
+    assert tracer.names(send) == ["mail.get_connection", "smtp.open", "mail.message", "smtp.sendmail"]
+    [sendmail] = [span for span in tracer.spans if span.name == "smtp.sendmail"]
+    assert sendmail.attributes["mail.recipients"] == 2
+    assert sendmail.attributes["mail.size"] > 0
+    [open_] = [span for span in tracer.spans if span.name == "smtp.open"]
+    assert tracer.names(open_) == ["smtp.connect", "smtp.login"]
+
+
+@pt.mark.anyio
+async def test_batched_send_context(smtp_mail: "Mail", smtp_server: "SMTPServer"):
+    tracer = smtp_mail.enable_tracing(Tracer())
+    smtp_mail.enable_batching(max_delay=0.01)
+
+    async def request(i: int) -> int:
+        with tracer.start_as_current_span("request %d" % i, {}):
+            return await smtp_mail.send_mail("subject", "body", None, ["to@example.com"])
+
+    assert await asyncio.gather(request(0), request(1)) == [1, 1]
+    assert smtp_server.connections == 1
+    # The batch is sent in the context of the request that started it, and
+    # each message in the context of its own request.
+    assert tracer.names(tracer.spans[0]) == ["mail.get_connection", "smtp.open", "mail.message", "smtp.sendmail"]
+    [second] = [span for span in tracer.spans if span.name == "request 1"]
+    assert tracer.names(second) == ["mail.message", "smtp.sendmail"]
+
+
+def test_disabled(mail: "Mail"):
+    assert mail.tracer is None
+    EmailMessage("subject", "body", to=["to@example.com"], mailman=mail).message()